@@ -1,4 +1,9 @@
 import sys
-from .pynx import cli
 if __name__ == '__main__':
-    cli(sys.argv[1:])
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == '--complete':
+        # shell completion runs on every <TAB>. Keep it clear of pynx.py / util.py imports
+        from .complete import main_complete
+        main_complete(sys.argv[2:])
+    else:
+        from .pynx import cli
+        cli(sys.argv[1:])
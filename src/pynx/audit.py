@@ -0,0 +1,142 @@
+#########################################
+# .: audit.py :.
+# gixy security / performance analysis of site configs
+#
+# % pynx audit [site ...] [--ndjson]
+#
+# Each site config is analyzed with all gixy plugins. Sites are spread over a process
+# pool (gixy is pure python and cpu bound) and findings are cached in C_.FILE_AUDIT
+# by sha256 of the config content, gixy version and VERSION. Re-audits only analyze
+# sites whose content changed.
+#########################################
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import multiprocessing
+import concurrent.futures
+from collections import OrderedDict
+import gixy
+from gixy.core.manager import Manager
+from gixy.core.config import Config
+from . import util
+from .util import pc, C_, assertNotBlank
+
+VERSION = 1
+SEVERITIES = ('HIGH', 'MEDIUM', 'LOW', 'UNSPECIFIED') # output order
+ERROR = 'ERROR' # config could not be parsed
+
+
+def content_hash(content:bytes) -> str:
+    h = hashlib.sha256()
+    h.update(f"{VERSION}:{gixy.version}:".encode('utf-8'))
+    h.update(content)
+    return h.hexdigest()
+
+
+# Runs in pool workers. Returns a list of findings (dicts)
+def analyze(path:str, content:bytes) -> list:
+    try:
+        with Manager(config=Config(allow_includes=False)) as manager:
+            manager.audit(path, io.StringIO(content.decode('utf-8', errors='replace')), is_stdin=True)
+            findings = []
+            for plugin in manager.results:
+                for issue in plugin.issues:
+                    findings.append({'severity': issue.severity or plugin.severity, 'plugin': plugin.name
+                                    ,'summary': issue.summary or plugin.summary, 'reason': issue.reason or ''
+                                    ,'help_url': issue.help_url or plugin.help_url
+                                    ,'directives': [str(d) for d in issue.directives]})
+            return findings
+    except Exception as ex:
+        return [{'severity': ERROR, 'plugin': 'parser', 'summary': f"{util.getClassName(ex)}: {ex}"
+                ,'reason': '', 'help_url': '', 'directives': []}]
+
+
+# site -> findings. Cached sites are not analyzed again. Returns (results, sites analyzed).
+# prune: names are all sites, so findings of content no site has anymore are dropped
+def audit_sites(names:list, parallel:int=None, prune:bool=False) -> tuple:
+    path_cache = util.get_state_path(C_.FILE_AUDIT, cache=True)
+    cache = util.read_json_file(path_cache, {})
+    if cache.get('version') != VERSION: cache = {'version': VERSION, 'findings': {}}
+    cached = cache['findings'] # content hash -> findings
+
+    hashes = OrderedDict()
+    todo = OrderedDict() # hash -> (path, content). Sites with identical content are analyzed once
+    for name in names:
+        path = f"{C_.PATH_SITES_A}/{name}"
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        h = hashes[name] = content_hash(content)
+        if not h in cached and not h in todo: todo[h] = (path, content)
+
+    if len(todo) > 0:
+        parallel = (os.cpu_count() or 1) if parallel is None else parallel
+        assert parallel > 0, f"parallel must be > 0. Got: {parallel}"
+        if parallel == 1 or len(todo) == 1:
+            for h, (path, content) in todo.items(): cached[h] = analyze(path, content)
+        else:
+            ctx = multiprocessing.get_context('fork')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(parallel, len(todo)), mp_context=ctx) as pool:
+                keys = list(todo.keys())
+                chunksize = max(1, len(keys) // (parallel * 4))
+                for h, findings in zip(keys, pool.map(analyze, [todo[k][0] for k in keys], [todo[k][1] for k in keys], chunksize=chunksize)):
+                    cached[h] = findings
+
+    results = OrderedDict([(name, cached[h]) for name, h in hashes.items()])
+    if prune and len(cached) > len(set(hashes.values())):
+        cache['findings'] = {h: cached[h] for h in set(hashes.values())}
+    elif len(todo) == 0:
+        return (results, 0)
+    util.write_json_file(path_cache, cache)
+    return (results, len([h for h in hashes.values() if h in todo]))
+
+
+# [(severity, site, finding)] in SEVERITIES order, then site order
+def by_severity(results:OrderedDict) -> list:
+    order = {s: i for i, s in enumerate((ERROR,) + SEVERITIES)}
+    rows = [(f['severity'], name, f) for name, findings in results.items() for f in findings]
+    rows.sort(key=lambda r: order.get(r[0], len(order)))
+    return rows
+
+
+def main_audit(args:list):
+    bNdjson = util.pop_flag(args, '--ndjson')
+    parallel = util.pop_opt(args, '--parallel')
+    parallel = None if parallel is None else int(parallel)
+    sites = util.Sites()
+    bAll = len(args) == 0
+    if bAll:
+        names = list(sites.Enabled.keys()) + list(sites.Avail.keys())
+    else:
+        names = []
+        for name in args:
+            assertNotBlank('site', name)
+            assert name in sites.Enabled or name in sites.Avail, f"Site not found or bad: {name}"
+            if not name in names: names.append(name)
+
+    t0 = time.monotonic()
+    (results, analyzed) = audit_sites(names, parallel, prune=bAll)
+    rows = by_severity(results)
+
+    if bNdjson:
+        for (severity, name, f) in rows:
+            print(json.dumps(OrderedDict([('site', name)] + list(f.items()))))
+        sys.stdout.flush()
+        return
+
+    counts = OrderedDict()
+    for (severity, name, f) in rows: counts[severity] = counts.get(severity, 0) + 1
+    if len(rows) > 0:
+        table = util.build_grid(['Severity', 'Site', 'Plugin', 'Summary', 'Reason']
+                               ,['l'       , 'l'   , 'l'     , 'l'      , 'l'])
+        prev = None
+        for (severity, name, f) in rows:
+            table.add_row([severity if severity != prev else '', name, f['plugin'], f['summary'], f['reason'] or '-'])
+            prev = severity
+        pc(f"\n{table.draw()}\n")
+    found = ', '.join([f"{n} {s.lower()}" for s, n in counts.items()]) if len(counts) > 0 else 'no issues'
+    pc(f"audit of {len(names)} sites: {found} ({analyzed} analyzed, {len(names) - analyzed} cached, {time.monotonic() - t0:.2f}s)")
+    if bAll and len(sites.Bad) > 0:
+        pc(f"skipped bad sites: {', '.join(sites.Bad.keys())}")
@@ -0,0 +1,221 @@
+#########################################
+# .: bench.py :.
+# HTTP load benchmark of a site against its local listeners or its wsgi socket
+#
+# % pynx <site> bench [-c <conns>] [-d <s>] [--path <uri>] [--listen <addr:port|port>] [--wsgi]
+#
+# The target is a `listen` of the site (the first one or --listen), with `*` / `[::]` as
+# the loopback address, or with --wsgi the site's wsgi unix socket (SiteConfig.wsgi_sockets),
+# which skips nginx. Only local targets are allowed: a listen address must be one this
+# host can bind. Requests carry the site's first plain server_name as Host (and SNI).
+#
+# One asyncio loop runs `conns` keep-alive connections, each sending its next GET as soon
+# as the previous response is read, for `duration` seconds. Latency is from request write
+# to the end of the response body, connects not included. Being one process, the client
+# can be the bottleneck: its cpu use is reported and results are flagged when it was busy.
+# The last run per site, target and path is kept in C_.FILE_BENCH and the next run is
+# compared with it.
+#########################################
+import ssl
+import time
+import socket
+import asyncio
+import datetime
+import ipaddress
+from . import util
+from .util import pc, C_
+
+
+class Target():
+    def __init__(self, label:str, kind:str, addr:str, port:int=None, tls:bool=False):
+        self.label = label
+        self.kind = kind # 'tcp' | 'unix'
+        self.addr = addr
+        self.port = port
+        self.tls = tls
+
+    def __str__(self):
+        if self.kind == 'unix': return f"unix:{self.addr}"
+        return f"{'https' if self.tls else 'http'}://{self.addr if self.addr.find(':') == -1 else f'[{self.addr}]'}:{self.port}"
+
+
+# Loopback for wildcard listens. Other addresses must be local: only those can be bound
+def _local_addr(addr:str) -> str:
+    if addr == '*': return '127.0.0.1'
+    if addr == '[::]': return '::1'
+    host = addr.strip('[]')
+    if host == 'localhost': return '127.0.0.1'
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        raise AssertionError(f"listen {addr} is not an ip address. Only local listeners can be benchmarked")
+    with socket.socket(socket.AF_INET6 if ip.version == 6 else socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind((host, 0))
+        except OSError:
+            raise AssertionError(f"listen {addr} is not an address of this host. Only local listeners can be benchmarked")
+    return host
+
+
+def get_target(site_cfg, listen:str=None, bWsgi:bool=False) -> Target:
+    assert not site_cfg is None and site_cfg.parse_ok, "Site config could not be parsed"
+    if bWsgi:
+        socks = sorted(set([sock for (sock, exists) in site_cfg.wsgi_sockets]))
+        assert len(socks) > 0, f"{site_cfg.name} has no wsgi socket (proxy_pass http://unix:...)"
+        return Target(f"wsgi {socks[0]}", 'unix', socks[0])
+
+    listens = site_cfg.listens
+    if not listen is None:
+        (q_addr, q_port, ds) = util.parse_listen([listen])
+        listens = [a for a in listens if util.parse_listen(a)[1] == q_port
+                   and (listen.find(':') == -1 or util.parse_listen(a)[0] == q_addr)]
+        assert len(listens) > 0, f"{site_cfg.name} has no listen {listen}. Listens: {', '.join([a[0] for a in site_cfg.listens])}"
+    for args in listens:
+        (addr, port, ds) = util.parse_listen(args)
+        if port is None: return Target(f"listen {' '.join(args)}", 'unix', addr[5:])
+        if port > 0: return Target(f"listen {' '.join(args)}", 'tcp', _local_addr(addr), port, 'ssl' in args[1:])
+    raise AssertionError(f"No usable listen found for {site_cfg.name}")
+
+
+async def _connect(target:Target, host:str) -> tuple:
+    if target.kind == 'unix':
+        return await asyncio.wait_for(asyncio.open_unix_connection(target.addr), C_.BENCH_TIMEOUT)
+    ctx = None
+    if target.tls:
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE # local benchmark, the certificate is not the point
+    return await asyncio.wait_for(asyncio.open_connection(target.addr, target.port, ssl=ctx
+                                  ,server_hostname=host if target.tls else None), C_.BENCH_TIMEOUT)
+
+
+# Reads one response. Returns (status, keep_alive)
+async def _read_response(reader) -> tuple:
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    status = int(head[0].split(' ', 2)[1])
+    headers = {}
+    for line in head[1:]:
+        (k, sep, v) = line.partition(':')
+        if sep: headers[k.strip().lower()] = v.strip().lower()
+    keep = headers.get('connection') != 'close' and head[0].find('HTTP/1.0') != 0
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding', '').find('chunked') > -1:
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                while not (await reader.readline()) in (b'\r\n', b'\n', b''): pass # trailers
+                break
+            await reader.readexactly(size + 2)
+    elif not (status < 200 or status in (204, 304)):
+        await reader.read() # body ends with the connection
+        keep = False
+    return (status, keep)
+
+
+async def _client(target:Target, host:str, request:bytes, deadline:float, res:dict):
+    conn = None
+    while time.monotonic() < deadline:
+        try:
+            if conn is None:
+                conn = await _connect(target, host)
+                res['connects'] += 1
+            (reader, writer) = conn
+            t0 = time.monotonic()
+            writer.write(request)
+            (status, keep) = await asyncio.wait_for(_read_response(reader), C_.BENCH_TIMEOUT)
+        except (OSError, EOFError, ValueError, IndexError, asyncio.TimeoutError, asyncio.LimitOverrunError) as ex:
+            res['errors'] += 1
+            res['last_error'] = f"{util.getClassName(ex)}: {ex}"
+            if not conn is None: conn[1].close()
+            conn = None
+            await asyncio.sleep(C_.BENCH_ERROR_DELAY) # refused connections fail fast, do not spin
+            continue
+        res['latencies'].append(time.monotonic() - t0)
+        res['status'][min(status // 100, 5)] += 1
+        if not keep:
+            writer.close()
+            conn = None
+    if not conn is None: conn[1].close()
+
+
+# Runs the benchmark. Returns the summary saved per site
+def run(target:Target, host:str, path:str, conns:int, duration:float) -> dict:
+    request = (f"GET {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: pynx-bench\r\nAccept: */*\r\n\r\n").encode('latin-1')
+    res = {'latencies': [], 'status': [0] * 6, 'errors': 0, 'connects': 0, 'last_error': None}
+
+    async def _main():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*[_client(target, host, request, deadline, res) for i in range(conns)])
+
+    (t0, cpu0) = (time.monotonic(), time.process_time())
+    asyncio.run(_main())
+    (elapsed, cpu) = (time.monotonic() - t0, time.process_time() - cpu0)
+
+    ms = sorted([t * 1000 for t in res['latencies']])
+    summary = {'ts': time.time(), 'target': str(target), 'path': path, 'conns': conns, 'duration': duration
+              ,'requests': len(ms), 'rps': len(ms) / elapsed, 'errors': res['errors'], 'connects': res['connects']
+              ,'status': {f"{i}xx": n for i, n in enumerate(res['status']) if i > 0 and n > 0}
+              ,'cpu': cpu / elapsed, 'last_error': res['last_error']}
+    for p in C_.BENCH_PERCENTILES:
+        summary[f"p{p}"] = util.percentile(ms, p) if len(ms) > 0 else None
+    summary['max'] = ms[-1] if len(ms) > 0 else None
+    return summary
+
+
+def _fmt(key:str, v) -> str:
+    if v is None: return '-'
+    if key == 'rps': return f"{v:.1f}"
+    if key == 'cpu': return f"{v * 100:.0f}%"
+    if isinstance(v, float): return f"{v:.2f}ms"
+    return str(v)
+
+
+# '+12.5% better'. Lower is better except for req/s
+def _change(key:str, now, last) -> str:
+    if not (key in ('rps', 'max') or key[0] == 'p'): return ''
+    if now is None or last is None or last == 0: return ''
+    pct = (now - last) / last * 100
+    if abs(pct) < C_.BENCH_NOISE_PCT: return f"{pct:+.1f}%"
+    return f"{pct:+.1f}% {'better' if (pct > 0) == (key == 'rps') else 'worse'}"
+
+
+def main_bench(site_info, conns:str=None, duration:str=None, path:str=None, listen:str=None, bWsgi:bool=False):
+    conns = C_.BENCH_CONNS if conns is None else int(conns)
+    duration = C_.BENCH_DURATION if duration is None else float(duration)
+    path = '/' if path is None else path
+    assert conns > 0 and duration > 0, f"-c and -d must be > 0. Got: {conns}, {duration}"
+    assert path.find('/') == 0, f"--path must start with `/`. Got: {path}"
+    target = get_target(site_info.site_cfg, listen, bWsgi)
+    host = util.get_site_host(site_info.site_cfg)
+
+    pc(f"bench {site_info.name}: GET {path} on {target} ({target.label}), Host: {host}, {conns} connections, {duration:g}s")
+    now = run(target, host, path, conns, duration)
+
+    state_path = util.get_state_path(C_.FILE_BENCH)
+    state = util.read_json_file(state_path, default={})
+    key = f"{site_info.name} {target} {path}"
+    last = state.get(key)
+
+    rows = [('rps', 'req/s')] + [(f"p{p}", f"p{p}") for p in C_.BENCH_PERCENTILES] \
+         + [('max', 'max'), ('requests', 'requests'), ('errors', 'errors'), ('connects', 'connects'), ('cpu', 'client cpu')]
+    if last is None:
+        table = util.build_grid(['Metric', 'Now'], ['l', 'r'])
+        for (k, label) in rows: table.add_row([label, _fmt(k, now[k])])
+    else:
+        ts = datetime.datetime.fromtimestamp(last['ts']).strftime('%Y-%m-%d %H:%M')
+        table = util.build_grid(['Metric', 'Now', f"Last ({ts})", 'Change'], ['l', 'r', 'r', 'r'])
+        for (k, label) in rows: table.add_row([label, _fmt(k, now[k]), _fmt(k, last.get(k)), _change(k, now[k], last.get(k))])
+    pc(f"\n{table.draw()}\n")
+
+    pc(f"responses: {', '.join([f'{n} {c}' for c, n in now['status'].items()]) or 'none'}")
+    if now['errors'] > 0: pc(f"{now['errors']} errors, last: {now['last_error']}")
+    if now['connects'] > conns: pc(f"{now['connects'] - conns} reconnects: the server closes keep-alive connections")
+    if now['cpu'] >= C_.BENCH_CPU_BUSY:
+        pc(f"client used {now['cpu'] * 100:.0f}% of a cpu: numbers are a lower bound of what {target} can serve")
+    if not last is None and (last['conns'], last['duration']) != (conns, duration):
+        pc(f"note: last run used -c {last['conns']} -d {last['duration']:g}")
+
+    if now['requests'] > 0:
+        state[key] = now
+        util.write_json_file(state_path, state)
@@ -0,0 +1,238 @@
+#########################################
+# .: cache.py :.
+# proxy_cache zone inspection and targeted purge
+#
+# % pynx cache [zone] [--parallel <n>]
+# % pynx cache purge [zone] --key-pattern <glob> [--dry-run] [--parallel <n>]
+#
+# Zones are the proxy_cache_path (and fastcgi / uwsgi / scgi_cache_path) directives of the
+# effective config (`nginx -T`). A zone directory is split into its level directories
+# (levels=1:2 gives 16 * 256) and those are walked with os.scandir in a process pool, each
+# worker returning counts only, so multi-million file caches stay fast and use little
+# memory. Disk usage is from st_blocks and the age of an entry from its mtime (the time
+# nginx cached the response).
+#
+# Purge reads the `KEY: ` line each cache file has after its binary header (first
+# C_.CACHE_HEADER_READ bytes) and deletes the files whose key matches the glob. A pattern
+# without wildcards is one key: its file is found from md5(key) and the levels, nothing
+# is walked. nginx treats deleted entries as misses and drops them from the zone.
+#########################################
+import os
+import re
+import time
+import fnmatch
+import hashlib
+import multiprocessing
+import concurrent.futures
+from collections import OrderedDict
+from . import util
+from .util import pc, C_, assertNotBlank
+
+CACHE_PATH_DIRECTIVES = ('proxy_cache_path', 'fastcgi_cache_path', 'uwsgi_cache_path', 'scgi_cache_path')
+AGE_LABELS = ('<1m', '<1h', '<1d', '<7d', 'older')
+AGE_LIMITS = (60, 3600, 86400, 7 * 86400)
+KEY_PREFIX = b'\nKEY: '
+
+
+class Zone():
+    def __init__(self, directive:str, args:list):
+        self.directive = directive
+        self.path = args[0].rstrip('/')
+        opts = dict([a.split('=', 1) for a in args[1:] if a.find('=') > -1])
+        assert 'keys_zone' in opts, f"{directive} {self.path} has no keys_zone"
+        (self.name, sep, self.zone_size) = opts['keys_zone'].partition(':')
+        self.levels = [int(l) for l in opts['levels'].split(':')] if 'levels' in opts else []
+        self.max_size = opts.get('max_size')
+        self.inactive = opts.get('inactive', '10m')
+
+    # Path of the cache file of a key
+    def key_path(self, key:str) -> str:
+        h = hashlib.md5(key.encode('utf-8')).hexdigest()
+        parts = []
+        pos = len(h)
+        for width in self.levels:
+            parts.append(h[pos - width:pos])
+            pos -= width
+        return os.path.join(self.path, *parts, h)
+
+
+# name -> Zone
+def get_zones() -> OrderedDict:
+    zones = OrderedDict()
+    def _walk(node):
+        for child in util.dump_children(node):
+            if child.name in CACHE_PATH_DIRECTIVES:
+                zone = Zone(child.name, child.args)
+                zones[zone.name] = zone
+            elif child.is_block:
+                _walk(child)
+    _walk(util.get_nginx_dump())
+    return zones
+
+
+# Key of a cache file or None if it is not one (eg. a temp file)
+def read_key(path:str) -> str:
+    try:
+        with open(path, 'rb') as fp:
+            head = fp.read(C_.CACHE_HEADER_READ)
+            i = head.find(KEY_PREFIX)
+            if i == -1: return None
+            j = head.find(b'\n', i + len(KEY_PREFIX))
+            while j == -1 and len(head) < C_.CACHE_HEADER_MAX: # very long key
+                more = fp.read(C_.CACHE_HEADER_READ)
+                if len(more) == 0: break
+                head += more
+                j = head.find(b'\n', i + len(KEY_PREFIX))
+    except OSError:
+        return None
+    return head[i + len(KEY_PREFIX):j if j > -1 else len(head)].decode('utf-8', errors='replace')
+
+
+def _age_bucket(age:float) -> int:
+    for i, limit in enumerate(AGE_LIMITS):
+        if age < limit: return i
+    return len(AGE_LIMITS)
+
+
+# Runs in pool workers over one directory tree. Only counts (and the first matching
+# keys) are returned. pattern: compiled key regex for purge, None for stats
+def walk(path:str, now:float, pattern=None, delete:bool=False) -> dict:
+    res = {'files': 0, 'bytes': 0, 'ages': [0] * len(AGE_LABELS), 'matched': 0, 'matched_bytes': 0
+          ,'deleted': 0, 'errors': 0, 'keys': []}
+    stack = [path]
+    while len(stack) > 0:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    _account(res, entry, now, pattern, delete)
+        except OSError:
+            res['errors'] += 1
+    return res
+
+
+def _account(res:dict, entry, now:float, pattern, delete:bool):
+    try:
+        st = entry.stat(follow_symlinks=False)
+    except OSError:
+        return # removed by the nginx cache manager meanwhile
+    res['files'] += 1
+    res['bytes'] += st.st_blocks * 512
+    res['ages'][_age_bucket(now - st.st_mtime)] += 1
+    if pattern is None: return
+    key = read_key(entry.path)
+    if key is None or pattern.match(key) is None: return
+    res['matched'] += 1
+    res['matched_bytes'] += st.st_blocks * 512
+    if len(res['keys']) < C_.CACHE_SHOW_KEYS: res['keys'].append(key)
+    if delete:
+        try:
+            os.unlink(entry.path)
+            res['deleted'] += 1
+        except FileNotFoundError:
+            pass
+        except OSError:
+            res['errors'] += 1
+
+
+def _merge(total:dict, res:dict):
+    for k, v in res.items():
+        if k == 'ages': total[k] = [a + b for a, b in zip(total[k], v)]
+        elif k == 'keys': total[k] = (total[k] + v)[:C_.CACHE_SHOW_KEYS]
+        else: total[k] += v
+
+
+# Walks a zone. Its level directories are spread over `parallel` processes
+def scan_zone(zone:Zone, parallel:int, pattern=None, delete:bool=False) -> dict:
+    now = time.time()
+    total = {'files': 0, 'bytes': 0, 'ages': [0] * len(AGE_LABELS), 'matched': 0, 'matched_bytes': 0
+            ,'deleted': 0, 'errors': 0, 'keys': []}
+    # Expand level directories until there are enough tasks. Files met on the way are counted here
+    dirs = [zone.path]
+    depth = 0
+    while depth < max(1, len(zone.levels)) and len(dirs) < parallel * 16:
+        subdirs = []
+        for d in dirs:
+            try:
+                with os.scandir(d) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False): subdirs.append(entry.path)
+                        else: _account(total, entry, now, pattern, delete)
+            except OSError: # eg. removed by the nginx cache manager meanwhile, as in walk
+                total['errors'] += 1
+        (dirs, depth) = (subdirs, depth + 1)
+
+    if parallel == 1 or len(dirs) < 2:
+        for d in dirs: _merge(total, walk(d, now, pattern, delete))
+    else:
+        ctx = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(parallel, len(dirs)), mp_context=ctx) as pool:
+            n = len(dirs)
+            for res in pool.map(walk, dirs, [now] * n, [pattern] * n, [delete] * n, chunksize=max(1, n // (parallel * 4))):
+                _merge(total, res)
+    return total
+
+
+def _pick_zones(args:list) -> OrderedDict:
+    zones = get_zones()
+    assert len(zones) > 0, "No proxy_cache_path (or fastcgi/uwsgi/scgi_cache_path) found in nginx config"
+    if len(args) == 0: return zones
+    for name in args: assert name in zones, f"Cache zone not found: {name}. Zones: {', '.join(zones.keys())}"
+    return OrderedDict([(name, zones[name]) for name in args])
+
+
+def _purge(zone:Zone, key_pattern:str, parallel:int, bDryRun:bool) -> dict:
+    if not any([c in key_pattern for c in '*?[']): # one key: no walk
+        path = zone.key_path(key_pattern)
+        res = {'files': 0, 'matched': 0, 'matched_bytes': 0, 'deleted': 0, 'errors': 0, 'keys': []}
+        if read_key(path) != key_pattern: return res
+        try:
+            st = os.stat(path)
+            res.update({'matched': 1, 'matched_bytes': st.st_blocks * 512, 'keys': [key_pattern]})
+            if not bDryRun:
+                os.unlink(path)
+                res['deleted'] = 1
+        except FileNotFoundError:
+            pass
+        return res
+    return scan_zone(zone, parallel, re.compile(fnmatch.translate(key_pattern)), not bDryRun)
+
+
+def main_cache(args:list):
+    parallel = util.pop_opt(args, '--parallel')
+    parallel = (os.cpu_count() or 1) if parallel is None else int(parallel)
+    assert parallel > 0, f"--parallel must be > 0. Got: {parallel}"
+    t0 = time.monotonic()
+
+    if len(args) > 0 and args[0] == 'purge':
+        args = args[1:]
+        key_pattern = util.pop_opt(args, '--key-pattern')
+        bDryRun = util.pop_flag(args, '--dry-run')
+        assert not key_pattern is None, "purge needs --key-pattern <glob>"
+        assertNotBlank('--key-pattern', key_pattern)
+        zones = _pick_zones(args)
+        for name, zone in zones.items():
+            res = _purge(zone, key_pattern, parallel, bDryRun)
+            for key in res['keys']: pc(f"  {name}: {key}")
+            if res['matched'] > len(res['keys']): pc(f"  {name}: ... {res['matched'] - len(res['keys'])} more")
+            done = f"would delete {res['matched']}" if bDryRun else f"deleted {res['deleted']} of {res['matched']}"
+            notes = [f"{res['files']} files checked"] if res['files'] > 0 else ['key looked up by md5']
+            if res['errors'] > 0: notes.append(f"{res['errors']} errors")
+            pc(f"{name}: {done} matching entries ({util.fmt_size(res['matched_bytes'])}, {', '.join(notes)})")
+        pc(f"purge done in {time.monotonic() - t0:.2f}s")
+        return
+
+    zones = _pick_zones(args)
+    table = util.build_grid(['Zone', 'Path', 'Max Size', 'Inactive', 'Files', 'Disk'] + list(AGE_LABELS)
+                           ,['l'   , 'l'   , 'r'       , 'r'       , 'r'    , 'r'] + ['r' for a in AGE_LABELS])
+    for name, zone in zones.items():
+        if not os.path.isdir(zone.path):
+            table.add_row([name, zone.path, zone.max_size or '-', zone.inactive, 'not found', '-'] + ['-' for a in AGE_LABELS])
+            continue
+        res = scan_zone(zone, parallel)
+        table.add_row([name, zone.path, zone.max_size or '-', zone.inactive, str(res['files']), util.fmt_size(res['bytes'])]
+                      + [str(n) for n in res['ages']])
+    pc(f"\n{table.draw()}\n")
+    pc(f"{len(zones)} cache zones scanned in {time.monotonic() - t0:.2f}s (ages by mtime: time cached)")
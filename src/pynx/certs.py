@@ -0,0 +1,244 @@
+#########################################
+# .: certs.py :.
+# TLS certificate inventory of the ssl_certificate files used by site configs
+#
+# % pynx certs [--ndjson]
+#
+# Paths come from the site index (SiteConfig.ssl_certificates) and are deduplicated, so
+# a cert shared by many sites is read once. Expiry, SANs, subject, issuer and key type
+# are parsed with the `cryptography` package when installed, otherwise with
+# `openssl x509 -text`, several certs at a time. Results are cached in C_.FILE_CERTS
+# keyed by device, inode, mtime and size of the file: repeat runs only stat the files.
+# Server names of a site that none of its certs' SANs (or CN without SANs) cover are flagged.
+#########################################
+import os
+import re
+import json
+import time
+import calendar
+import subprocess
+import concurrent.futures
+from collections import OrderedDict
+from . import util
+from .util import pc, C_
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec, dsa, ed25519, ed448
+except ImportError:
+    x509 = None
+
+VERSION = 1
+
+
+# Absolute path of an ssl_certificate arg. Relative paths are relative to the nginx conf dir.
+# None for paths nginx resolves per request ($ssl_server_name, data:...)
+def resolve_path(path:str) -> str:
+    if path.find('$') > -1 or path.find('data:') == 0 or path.find('engine:') == 0: return None
+    return path if os.path.isabs(path) else os.path.join(os.path.dirname(C_.PATH_NGINX_CONF), path)
+
+
+def _name_cn(name) -> str:
+    attrs = name.get_attributes_for_oid(NameOID.COMMON_NAME)
+    return attrs[0].value if len(attrs) > 0 else None
+
+
+def _parse_cryptography(path:str) -> dict:
+    with open(path, 'rb') as fp:
+        cert = x509.load_pem_x509_certificate(fp.read())
+    not_after = cert.not_valid_after_utc if hasattr(cert, 'not_valid_after_utc') else cert.not_valid_after
+    try:
+        sans = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        sans = []
+    key = cert.public_key()
+    if isinstance(key, rsa.RSAPublicKey): key_type = f"RSA {key.key_size}"
+    elif isinstance(key, ec.EllipticCurvePublicKey): key_type = f"EC {key.curve.name}"
+    elif isinstance(key, dsa.DSAPublicKey): key_type = f"DSA {key.key_size}"
+    elif isinstance(key, ed25519.Ed25519PublicKey): key_type = 'Ed25519'
+    elif isinstance(key, ed448.Ed448PublicKey): key_type = 'Ed448'
+    else: key_type = util.getClassName(key)
+    return {'not_after': calendar.timegm(not_after.timetuple()), 'cn': _name_cn(cert.subject)
+           ,'issuer': _name_cn(cert.issuer), 'sans': list(sans), 'key': key_type}
+
+
+_RE_CN = re.compile(r'CN\s*=\s*([^,/\n]+)')
+
+def _parse_openssl(path:str) -> dict:
+    p = subprocess.run([C_.OPENSSL_BIN, 'x509', '-noout', '-text', '-in', path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        raise Exception(p.stderr.decode('utf-8', errors='replace').strip().split('\n')[0])
+    lines = [l.strip() for l in p.stdout.decode('utf-8', errors='replace').split('\n')]
+    res = {'not_after': None, 'cn': None, 'issuer': None, 'sans': [], 'key': None}
+    (algo, bits, curve) = (None, None, None)
+    for i, line in enumerate(lines):
+        if line.find('Not After') == 0:
+            ts = ' '.join(line.split(':', 1)[1].split())
+            res['not_after'] = calendar.timegm(time.strptime(ts, '%b %d %H:%M:%S %Y GMT'))
+        elif line.find('Subject:') == 0:
+            m = _RE_CN.search(line)
+            if m: res['cn'] = m.group(1).strip()
+        elif line.find('Issuer:') == 0:
+            m = _RE_CN.search(line)
+            if m: res['issuer'] = m.group(1).strip()
+        elif line.find('Public Key Algorithm:') == 0:
+            algo = line.split(':', 1)[1].strip()
+        elif line.find('Public-Key:') > -1 and bits is None:
+            bits = line.split('(', 1)[-1].split(' ')[0]
+        elif line.find('ASN1 OID:') == 0:
+            curve = line.split(':', 1)[1].strip()
+        elif line.find('X509v3 Subject Alternative Name') == 0 and i + 1 < len(lines):
+            res['sans'] = [v.strip()[4:] for v in lines[i + 1].split(',') if v.strip().find('DNS:') == 0]
+    if algo == 'rsaEncryption': res['key'] = f"RSA {bits}"
+    elif algo == 'id-ecPublicKey': res['key'] = f"EC {curve}"
+    elif algo == 'dsaEncryption': res['key'] = f"DSA {bits}"
+    else: res['key'] = algo
+    return res
+
+
+# Cert info dict for a file. Errors are returned in info['error']
+def parse_cert(path:str) -> dict:
+    try:
+        info = _parse_openssl(path) if x509 is None else _parse_cryptography(path)
+        info['error'] = None
+    except Exception as ex:
+        info = {'not_after': None, 'cn': None, 'issuer': None, 'sans': [], 'key': None, 'error': str(ex) or util.getClassName(ex)}
+    return info
+
+
+# nginx server_name covered by a cert's names (sans, or [cn]). None if it can not be
+# checked (regex and `www.example.*` names)
+def name_covered(name:str, cert_names:list) -> bool:
+    name = name.lower()
+    cert_names = [n.lower() for n in cert_names]
+    if name.find('~') == 0 or name.endswith('.*'): return None
+    if name.find('.') == 0: # .example.com: example.com and *.example.com
+        return name[1:] in cert_names and f"*{name}" in cert_names
+    if name in cert_names: return True
+    if name.find('*.') == 0: return False # needs the same wildcard
+    parts = name.split('.', 1)
+    return len(parts) == 2 and f"*.{parts[1]}" in cert_names
+
+
+# path -> {'sites': [site], 'key': stat key, ...cert info}. Cached infos are used when
+# the stat key matches. Returns (certs, parsed count, skipped [(site, arg)])
+def collect(index=None) -> tuple:
+    index = util.SiteIndex() if index is None else index
+    certs = OrderedDict()
+    skipped = []
+    for name, site in index.sites.items():
+        cfg = None if site.status & util.BAD else site.site_cfg
+        if cfg is None or not cfg.parse_ok: continue
+        for arg in (cfg.ssl_certificates or []):
+            path = resolve_path(arg)
+            if path is None:
+                skipped.append((name, arg))
+                continue
+            entry = certs.setdefault(path, {'sites': []})
+            if not name in entry['sites']: entry['sites'].append(name)
+
+    path_cache = util.get_state_path(C_.FILE_CERTS, cache=True)
+    cache = util.read_json_file(path_cache, {})
+    cached = cache.get('certs', {}) if cache.get('version') == VERSION else {}
+
+    todo = OrderedDict() # (dev, ino) -> [paths]. Links to the same file are parsed once
+    for path, entry in certs.items():
+        try:
+            st = os.stat(path)
+        except OSError as ex:
+            entry.update({'key': None, 'not_after': None, 'cn': None, 'issuer': None, 'sans': [], 'key_type': None
+                         ,'error': ex.strerror or str(ex)})
+            continue
+        entry['key'] = [st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size]
+        hit = cached.get(path)
+        if not hit is None and hit['key'] == entry['key']:
+            entry.update({k: v for k, v in hit.items() if k != 'key'})
+        else:
+            todo.setdefault((st.st_dev, st.st_ino), []).append(path)
+
+    if len(todo) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(C_.CERTS_PARALLEL, len(todo))) as pool:
+            infos = pool.map(parse_cert, [paths[0] for paths in todo.values()])
+            for paths, info in zip(todo.values(), infos):
+                info['key_type'] = info.pop('key')
+                for path in paths: certs[path].update(info)
+
+    fresh = {path: {k: v for k, v in e.items() if k != 'sites'} for path, e in certs.items() if not e['key'] is None}
+    if fresh != cached:
+        util.write_json_file(path_cache, {'version': VERSION, 'certs': fresh})
+    return (certs, sum([len(paths) for paths in todo.values()]), skipped)
+
+
+# {site: [server names not covered by any of the site's certs]}. Certs that failed to parse are
+# left out: their names are unknown, the error is reported on their own row
+def uncovered(certs:OrderedDict, index) -> OrderedDict:
+    res = OrderedDict()
+    by_site = OrderedDict()
+    for path, e in certs.items():
+        if not e.get('error') is None: continue
+        for site in e['sites']:
+            by_site.setdefault(site, []).extend(e['sans'] if len(e.get('sans') or []) > 0 else [n for n in [e.get('cn')] if n])
+    for site, cert_names in by_site.items():
+        cfg = index.get(site).site_cfg
+        names = [n for n in cfg.server_names if n not in ('_', '', 'localhost')]
+        missing = [n for n in names if name_covered(n, cert_names) == False]
+        if len(missing) > 0: res[site] = missing
+    return res
+
+
+def _fmt_expiry(not_after, now:float) -> str:
+    if not_after is None: return '-'
+    days = int((not_after - now) // 86400)
+    date = time.strftime('%Y-%m-%d', time.gmtime(not_after))
+    return f"{date} (expired {-days}d ago)" if not_after < now else f"{date} ({days}d)"
+
+
+def main_certs(args:list):
+    bNdjson = util.pop_flag(args, '--ndjson')
+    assert len(args) == 0, f"Unexpected args for certs: {args}"
+    t0 = time.monotonic()
+    index = util.SiteIndex()
+    (certs, parsed, skipped) = collect(index)
+    missing = uncovered(certs, index)
+    now = time.time()
+    rows = sorted(certs.items(), key=lambda kv: (kv[1]['not_after'] is None and kv[1]['error'] is None, kv[1]['not_after'] or 0))
+
+    if bNdjson:
+        for path, e in rows:
+            d = OrderedDict([('path', path)] + [(k, e.get(k)) for k in ('sites', 'not_after', 'cn', 'issuer', 'sans', 'key_type', 'error')])
+            d['uncovered'] = {s: missing[s] for s in e['sites'] if s in missing}
+            print(json.dumps(d))
+        return
+
+    if len(certs) == 0:
+        pc(f"No ssl_certificate found in site configs")
+    else:
+        table = util.build_grid(['Certificate', 'Sites', 'Expires', 'Key', 'SANs', 'Notes']
+                               ,['l'          , 'l'    , 'l'      , 'l'  , 'l'   , 'l'])
+        counts = OrderedDict([('expired', 0), ('expiring', 0), ('uncovered', 0), ('errors', 0)])
+        for path, e in rows:
+            notes = []
+            if e['error'] is None and e['not_after'] is None: e['error'] = 'no expiry date found'
+            if not e['error'] is None:
+                notes.append(f"error: {e['error']}")
+                counts['errors'] += 1
+            elif e['not_after'] < now:
+                notes.append('EXPIRED')
+                counts['expired'] += 1
+            elif e['not_after'] - now < C_.CERTS_WARN_DAYS * 86400:
+                notes.append(f"expires in < {C_.CERTS_WARN_DAYS}d")
+                counts['expiring'] += 1
+            for site in e['sites']:
+                if site in missing and e['error'] is None:
+                    notes.append(f"{site}: not covered: {', '.join(missing[site])}")
+            sans = e.get('sans') or []
+            table.add_row([path, '\n'.join(e['sites']), _fmt_expiry(e['not_after'], now), e.get('key_type') or '-'
+                          ,'\n'.join(sans) if len(sans) > 0 else (e.get('cn') or '-'), '\n'.join(notes) if len(notes) > 0 else '-'])
+        pc(f"\n{table.draw()}\n")
+        counts['uncovered'] = len(missing)
+        issues = ', '.join([f"{n} {k}" for k, n in counts.items() if n > 0]) or 'no issues'
+        pc(f"{len(certs)} certificates: {issues} ({parsed} parsed, {len(certs) - parsed} cached, {time.monotonic() - t0:.2f}s)")
+
+    for (site, arg) in skipped:
+        pc(f"skipped {site}: ssl_certificate {arg} is resolved per request")
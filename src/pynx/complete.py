@@ -0,0 +1,205 @@
+#########################################
+# .: complete.py :.
+# Shell completion for pynx
+#
+# % pynx completion bash > /etc/bash_completion.d/pynx
+# % pynx completion zsh > /usr/local/share/zsh/site-functions/_pynx
+#
+# The completion scripts call `pynx --complete <shell> <line>`, which __main__ dispatches
+# here before importing anything else of pynx (no gixy, no subprocesses). Names come from
+# PATH_NAMES: pynx writes the commands and per instance site dirs there on each run and
+# this module refreshes the site and unit names when the mtime of a site dir or of the
+# wsgi topology cache changes. The names file is marshal data: unlike json it needs no
+# import (json pulls in re and enum, which alone take most of a 10ms budget).
+#########################################
+import os
+import sys
+import marshal
+
+# Same as os.path.join(C_.PATH_CACHE, C_.FILE_NAMES) in util
+PATH_NAMES = '/var/cache/pynx/names.bin'
+VERSION = (1, sys.version_info[:2]) # marshal format can change between python versions
+
+
+def load(path:str=None) -> dict:
+    try:
+        with open(PATH_NAMES if path is None else path, 'rb') as fp:
+            data = marshal.loads(fp.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+    if not isinstance(data, dict): return {}
+    return data if data.get('version') == VERSION else {}
+
+
+def save(data:dict, path:str=None):
+    path = PATH_NAMES if path is None else path
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as fp:
+            marshal.dump(data, fp)
+        os.replace(tmp, path)
+    except OSError:
+        pass # not root. Names are still used from memory
+
+
+def _mtime(path:str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Re-reads site names of an instance when a site dir changed and unit names when the
+# topology cache changed. Returns True if anything was updated
+def _refresh(inst:dict) -> bool:
+    changed = False
+    mtimes = inst.setdefault('mtimes', {})
+    dirs = inst.get('dirs', [])
+    if any([mtimes.get(d) != _mtime(d) for d in dirs]):
+        names = set()
+        for d in dirs:
+            mtimes[d] = _mtime(d)
+            try:
+                names.update([n for n in os.listdir(d) if n[0] != '.'])
+            except OSError:
+                pass
+        inst['sites'] = sorted(names)
+        changed = True
+
+    topology = inst.get('topology')
+    if not topology is None and mtimes.get(topology) != _mtime(topology):
+        import json # only when the topology cache changed
+        mtimes[topology] = _mtime(topology)
+        try:
+            with open(topology) as fp:
+                sites = json.load(fp).get('sites', {})
+        except (OSError, ValueError):
+            sites = {}
+        inst['wsgi_sites'] = sorted([s for s, rows in sites.items() if len(rows) > 0])
+        inst['units'] = sorted(set([row[1] for rows in sites.values() for row in rows]))
+        changed = True
+
+    return changed
+
+
+# Called by pynx (util.update_names_cache). Rewrites the file only when the spec changed
+def update_spec(path:str, commands:dict, instances:dict):
+    data = load(path)
+    if data.get('commands') == commands and {n: i.get('dirs') for n, i in data.get('instances', {}).items()} \
+            == {n: i['dirs'] for n, i in instances.items()}:
+        return
+    old = data.get('instances', {})
+    for name, inst in instances.items():
+        if name in old and old[name].get('dirs') == inst['dirs']:
+            inst.update({k: v for k, v in old[name].items() if not k in inst})
+    save({'version': VERSION, 'commands': commands, 'instances': instances}, path)
+
+
+# Candidates for the last word of line (which may be empty)
+def complete(line:str, data:dict) -> list:
+    words = line.split()
+    if line == '' or line[-1].isspace(): words.append('')
+    words = words[1:] # program name
+    if len(words) == 0: return []
+    cur = words[-1]
+    prev = words[:-1]
+    commands = data.get('commands', {})
+    instances = data.get('instances', {})
+    value_opts = commands.get('value_options', []) # C_.CLI_VALUE_OPTIONS: the next word is their value
+
+    if len(prev) > 0 and prev[-1] == '--instance':
+        return [n for n in instances.keys() if n != '' and n.startswith(cur)]
+    if len(prev) > 0 and prev[-1] in value_opts:
+        return []
+    if cur.find('-') == 0:
+        return [o for o in commands.get('options', []) if o.startswith(cur)]
+
+    # Positional args before the current word and the instance they apply to
+    args = []
+    inst_name = None
+    skip = False
+    for w in prev:
+        if skip:
+            skip = False
+            if inst_name == '': inst_name = w
+            continue
+        if w in value_opts:
+            skip = True
+            if w == '--instance': inst_name = ''
+            continue
+        if w.find('-') == 0: continue
+        args.append(w)
+    insts = [instances[inst_name]] if inst_name in instances else list(instances.values())
+
+    # filter before sorting, there can be thousands of sites
+    if len(args) == 0:
+        if cur.find('wsgi:') == 0:
+            (result, name) = (['wsgi:*'], cur[5:])
+            for inst in insts:
+                result += [f"wsgi:{n}" for n in inst.get('wsgi_sites', []) + inst.get('units', []) if n.startswith(name)]
+            return sorted(set([c for c in result if c.startswith(cur)]))
+        result = [c for c in list(commands.get('server', [])) + ['wsgi:'] if c.startswith(cur)]
+        for inst in insts: result += [n for n in inst.get('sites', []) if n.startswith(cur)]
+        return sorted(set(result))
+
+    if args[0] == 'audit': # pynx audit [site ...]
+        result = []
+        for inst in insts: result += [n for n in inst.get('sites', []) if n.startswith(cur) and not n in args]
+        return sorted(set(result))
+
+    if len(args) == 1:
+        if args[0] == 'completion':
+            result = ['bash', 'zsh']
+        elif args[0].find('wsgi:') == 0:
+            result = commands.get('wsgi', [])
+        elif args[0] in commands.get('server', []):
+            result = []
+        else:
+            result = commands.get('site', [])
+        return [c for c in result if c.startswith(cur)]
+
+    return []
+
+
+def main_complete(args:list):
+    # args: [shell, line]. line is the command line up to the cursor
+    if len(args) < 2: return
+    (shell, line) = (args[0], args[1])
+    data = load()
+    changed = False
+    for inst in data.get('instances', {}).values():
+        changed = _refresh(inst) or changed
+    if changed: save(data)
+
+    words = line.split()
+    cur = '' if line == '' or line[-1].isspace() or len(words) == 0 else words[-1]
+    result = complete(line, data)
+    if shell == 'bash' and cur.find(':') > -1:
+        # bash splits words on `:` (COMP_WORDBREAKS) so only the part after it is replaced
+        result = [c[cur.rfind(':') + 1:] for c in result]
+    sys.stdout.write('\n'.join(result))
+
+
+SCRIPT_BASH = """# pynx bash completion. Install: pynx completion bash > /etc/bash_completion.d/pynx
+_pynx() {
+    local IFS=$'\\n'
+    COMPREPLY=($(pynx --complete bash "${COMP_LINE:0:COMP_POINT}" 2>/dev/null))
+}
+complete -o default -F _pynx pynx
+"""
+
+SCRIPT_ZSH = """#compdef pynx
+# pynx zsh completion. Install: pynx completion zsh > /usr/local/share/zsh/site-functions/_pynx
+_pynx() {
+    local -a names
+    names=("${(@f)$(pynx --complete zsh "${(j: :)words[1,CURRENT]}" 2>/dev/null)}")
+    compadd -Q -- ${names:#}
+}
+compdef _pynx pynx
+"""
+
+
+def script(shell:str) -> str:
+    if shell == 'bash': return SCRIPT_BASH
+    if shell == 'zsh': return SCRIPT_ZSH
+    raise AssertionError(f"Unsupported shell `{shell}`. Use bash or zsh")
@@ -0,0 +1,169 @@
+#########################################
+# .: conns.py :.
+# Live connection counts per listen port and wsgi socket from /proc/net
+#
+# % pynx <site> conns
+# % pynx list --conns
+#
+# /proc/net/tcp, tcp6 and unix are each read once per command with a single read() and
+# parsed with one regex pass over the whole buffer (findall runs in C), counted with
+# Counter. Only ports with a LISTEN socket and unix paths with a listening socket are kept,
+# so outgoing connections on ephemeral ports cost one tuple each and nothing afterwards.
+# Counts are per port (or socket path), so sites sharing a port show the same numbers.
+#########################################
+import os
+import re
+import socket
+from collections import Counter
+from . import util
+from .util import C_
+
+# tcp states (include/net/tcp_states.h)
+ESTABLISHED = b'01'
+SYN_RECV = b'03'
+TIME_WAIT = b'06'
+LISTEN = b'0A'
+
+# /proc/net/tcp[6]: `sl: local_addr:port rem_addr:port st tx_queue:rx_queue ...`
+# For LISTEN sockets rx_queue is the accept queue (connections not yet accepted).
+# Not anchored at line start: `^ *\d+` makes findall about twice as slow
+_RE_TCP = re.compile(rb': [0-9A-F]+:([0-9A-F]{4}) [0-9A-F]+:[0-9A-F]{4} ([0-9A-F]{2}) [0-9A-F]{8}:([0-9A-F]{8})')
+# Remote end and state of every tcp socket, for connections nginx opens to upstreams
+_RE_TCP_REMOTE = re.compile(rb': [0-9A-F]+:[0-9A-F]{4} ([0-9A-F]+:[0-9A-F]{4}) ([0-9A-F]{2}) ')
+# /proc/net/unix: `Num: RefCount Protocol Flags Type St Inode [Path]`. Only bound sockets have a path
+_RE_UNIX = re.compile(rb': [0-9A-F]{8} [0-9A-F]{8} ([0-9A-F]{8}) [0-9A-F]{4} ([0-9A-F]{2}) +\d+ (.+)')
+UNIX_ACCEPTCON = 0x10000 # __SO_ACCEPTCON: listening
+UNIX_CONNECTED = b'03' # SS_CONNECTED
+
+
+def _read(name:str) -> bytes:
+    try:
+        with open(os.path.join(C_.PATH_PROC_NET, name), 'rb') as fp:
+            return fp.read()
+    except OSError:
+        return b'' # eg. no ipv6
+
+
+# Socket counts of one bulk read of /proc/net. Files are read on first use
+class NetStats():
+    def __init__(self):
+        self._ports = None # port -> [listeners, accept queue, established, time_wait, syn_recv]
+        self._paths = None # path -> [listeners, connected]
+        self._remotes = None # (remote addr:port as in /proc/net/tcp, state) -> sockets
+
+    def _load_tcp(self):
+        # (port, state, rx_queue) -> sockets. rx_queue is nearly always 0 so keys stay few
+        counts = Counter()
+        for name in ('tcp', 'tcp6'):
+            counts.update(_RE_TCP.findall(_read(name)))
+        ports = {}
+        for (port, st, rx), n in counts.items():
+            if st == LISTEN:
+                stats = ports.setdefault(port, [0, 0, 0, 0, 0])
+                stats[0] += n
+                stats[1] += int(rx, 16) * n
+        for (port, st, rx), n in counts.items():
+            stats = ports.get(port)
+            if stats is None: continue
+            if st == ESTABLISHED: stats[2] += n
+            elif st == TIME_WAIT: stats[3] += n
+            elif st == SYN_RECV: stats[4] += n
+        self._ports = {int(port, 16): stats for port, stats in ports.items()}
+
+    def _load_unix(self):
+        counts = Counter(_RE_UNIX.findall(_read('unix')))
+        paths = {}
+        for (flags, st, path), n in counts.items():
+            if int(flags, 16) & UNIX_ACCEPTCON: paths.setdefault(path, [0, 0])[0] += n
+        for (flags, st, path), n in counts.items():
+            if st == UNIX_CONNECTED and path in paths: paths[path][1] += n
+        self._paths = {p.decode('utf-8', errors='replace'): stats for p, stats in paths.items()}
+
+    # Reads everything now, eg. before forking workers that share the result
+    def load(self):
+        if self._ports is None: self._load_tcp()
+        if self._paths is None: self._load_unix()
+
+    # (listeners, accept queue, established, time_wait, syn_recv) for a tcp port
+    def port(self, port:int) -> tuple:
+        if self._ports is None: self._load_tcp()
+        return tuple(self._ports.get(port, (0, 0, 0, 0, 0)))
+
+    # (established, time_wait) of sockets connected to ip:port (eg. an upstream server)
+    def remote(self, ip:str, port:int) -> tuple:
+        if self._remotes is None:
+            self._remotes = Counter()
+            for name in ('tcp', 'tcp6'):
+                self._remotes.update(_RE_TCP_REMOTE.findall(_read(name)))
+        res = [0, 0]
+        for key in hex_addrs(ip, port):
+            res[0] += self._remotes.get((key, ESTABLISHED), 0)
+            res[1] += self._remotes.get((key, TIME_WAIT), 0)
+        return tuple(res)
+
+    # (listeners, connected) for a unix socket path
+    def unix(self, path:str) -> tuple:
+        if self._paths is None: self._load_unix()
+        return tuple(self._paths.get(path, (0, 0)))
+
+
+# ip:port as /proc/net/tcp and tcp6 print it (address in host byte order words). ipv4
+# addresses also get their ipv4 mapped tcp6 form
+def hex_addrs(ip:str, port:int) -> list:
+    def _words(packed):
+        return ''.join([packed[i:i+4][::-1].hex().upper() for i in range(0, len(packed), 4)])
+    if ip.find(':') > -1:
+        addrs = [_words(socket.inet_pton(socket.AF_INET6, ip))]
+    else:
+        packed = socket.inet_aton(ip)
+        addrs = [_words(packed), _words(b'\0' * 10 + b'\xff\xff' + packed)]
+    return [f"{a}:{port:04X}".encode('ascii') for a in addrs]
+
+
+# Rows of (label, kind, key) for the listens and wsgi sockets of a site. kind: tcp or unix
+def site_sockets(site_cfg) -> list:
+    if site_cfg is None or not site_cfg.parse_ok: return []
+    res = []
+    for args in site_cfg.listens:
+        (addr, port, ds) = util.parse_listen(args)
+        if port is None:
+            res.append((' '.join(args), 'unix', addr[5:]))
+        elif port > 0:
+            res.append((' '.join(args), 'tcp', port))
+    for sock in sorted(set([sock for (sock, exists) in site_cfg.wsgi_sockets])):
+        res.append((f"wsgi {sock}", 'unix', sock))
+    return res
+
+
+# Cell for the Conns column of `pynx list --conns`. One line per listen and wsgi socket
+def site_cell(net:NetStats, site_cfg) -> str:
+    lines = []
+    for (label, kind, key) in site_sockets(site_cfg):
+        if kind == 'tcp':
+            (listeners, queue, est, tw, syn) = net.port(key)
+            lines.append('not listening' if listeners == 0 else f"{est} est, {tw} tw, {syn} syn, {queue} q")
+        else:
+            (listeners, connected) = net.unix(key)
+            lines.append(f"{'wsgi ' if label.find('wsgi ') == 0 else ''}"
+                         f"{'not listening' if listeners == 0 else f'{connected} conn'}")
+    return '-' if len(lines) == 0 else '\n'.join(lines)
+
+
+def main_conns(site_info, net:NetStats=None):
+    net = NetStats() if net is None else net
+    sockets = site_sockets(site_info.site_cfg)
+    if len(sockets) == 0:
+        util.pc(f"No listens or wsgi sockets found for site {site_info.name}")
+        return
+
+    table = util.build_grid(['Socket', 'Listening', 'Established', 'Time-Wait', 'Syn-Recv', 'Accept Queue']
+                           ,['l'     , 'r'        , 'r'          , 'r'        , 'r'       , 'r'])
+    for (label, kind, key) in sockets:
+        if kind == 'tcp':
+            (listeners, queue, est, tw, syn) = net.port(key)
+            table.add_row([label, str(listeners), str(est), str(tw), str(syn), str(queue)])
+        else:
+            (listeners, connected) = net.unix(key)
+            table.add_row([label, str(listeners), str(connected), '-', '-', '-'])
+    util.pc(f"{site_info.name} connections (per port / socket, shared by all sites using it):")
+    util.pc(f"\n{table.draw()}\n")
@@ -0,0 +1,156 @@
+#########################################
+# .: export.py :.
+# Prometheus exposition format export of nginx, site and wsgi state
+#
+# % pynx export [--textfile /var/lib/node_exporter/pynx.prom]
+#
+# Collection is cheap enough to run every few seconds: systemd state comes from one
+# `systemctl show` per unit group, sites from the SiteIndex parse cache, wsgi units
+# from the cached Topology and `nginx -t` is only run when the config fingerprint or a file of
+# the `nginx -T` include list (or its directory) changes, or C_.NGINX_TEST_TTL passed (certs
+# and other files referenced by the config are not in that list).
+#########################################
+import os
+import time
+from collections import OrderedDict
+from . import util
+from .util import C_, assertNotBlank
+
+
+# name -> (help, type, [(labels, value)])
+class Metrics():
+    def __init__(self):
+        self._families = OrderedDict()
+
+    def add(self, name:str, help:str, value, labels:dict=None, mtype:str='gauge'):
+        if value is None: return
+        fam = self._families.get(name)
+        if fam is None:
+            fam = self._families[name] = (help, mtype, [])
+        labels = OrderedDict() if labels is None else OrderedDict(labels)
+        if not C_.INSTANCE is None: labels['instance_name'] = C_.INSTANCE
+        fam[2].append((labels, value))
+
+    def merge(self, other):
+        for name, (help, mtype, samples) in other.families.items():
+            fam = self._families.get(name)
+            if fam is None:
+                self._families[name] = (help, mtype, list(samples))
+            else:
+                fam[2].extend(samples)
+
+    @property
+    def families(self) -> OrderedDict:
+        return self._families
+
+    @staticmethod
+    def _escape(v:str) -> str:
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def format(self) -> str:
+        sb = []
+        for name, (help, mtype, samples) in self._families.items():
+            sb.append(f"# HELP {name} {help}")
+            sb.append(f"# TYPE {name} {mtype}")
+            for (labels, value) in samples:
+                s_labels = ','.join([f'{k}="{self._escape(v)}"' for k, v in labels.items()])
+                s_labels = f"{{{s_labels}}}" if s_labels else ''
+                sb.append(f"{name}{s_labels} {value}")
+        return '\n'.join(sb) + '\n'
+
+
+def _int_prop(d:dict, key:str) -> int:
+    # systemd reports unset counters as [not set] or UINT64_MAX
+    try:
+        v = int(d.get(key, ''))
+    except ValueError:
+        return None
+    return None if v >= 2**64 - 1 else v
+
+
+CONF_FILE_PREFIX = '# configuration file '
+
+# Files nginx loaded (conf.d, snippets, ...) from the `# configuration file <path>:` lines of `nginx -T`
+def get_conf_files() -> list:
+    with util.PExec(util.get_nginx_cmd('-T')) as p:
+        return [l[len(CONF_FILE_PREFIX):-1] for l in p.out.split('\n') if l.find(CONF_FILE_PREFIX) == 0 and l.endswith(':')]
+
+
+# [[path, mtime_ns]] of the files and their directories (files added to an include glob change the dir)
+def _stat_files(files:list) -> list:
+    res = []
+    for path in sorted(set(files) | set([os.path.dirname(f) for f in files])):
+        try:
+            res.append([path, os.stat(path).st_mtime_ns])
+        except OSError:
+            res.append([path, None])
+    return res
+
+
+# `nginx -t` result, cached until the config fingerprint or an included file changes, at most C_.NGINX_TEST_TTL
+def get_nginx_test_ok(scan=None) -> bool:
+    path = util.get_state_path(C_.FILE_NGINX_TEST, cache=True)
+    fingerprint = util.get_config_fingerprint(scan)
+    cached = util.read_json_file(path, {})
+    if cached.get('fingerprint') == fingerprint and time.time() - cached.get('ts', 0) < C_.NGINX_TEST_TTL \
+            and 'files' in cached and _stat_files([f for (f, mtime) in cached['files']]) == cached['files']:
+        return cached['ok']
+    ok = util.Nginx().ok
+    files = _stat_files(get_conf_files())
+    util.write_json_file(path, {'fingerprint': fingerprint, 'files': files, 'ok': ok, 'ts': time.time()})
+    return ok
+
+
+def collect() -> Metrics:
+    t0 = time.monotonic()
+    m = Metrics()
+
+    d = util.get_units_props([C_.NGINX_UNIT], ['ActiveState', 'MainPID', 'MemoryCurrent', 'TasksCurrent'])[C_.NGINX_UNIT]
+    pid = _int_prop(d, 'MainPID')
+    m.add('pynx_nginx_up', 'nginx unit is active', 1 if d.get('ActiveState') == 'active' else 0)
+    m.add('pynx_nginx_master_pid', 'nginx master process id', pid if pid else None)
+    m.add('pynx_nginx_memory_bytes', 'nginx unit memory', _int_prop(d, 'MemoryCurrent'))
+    m.add('pynx_nginx_tasks', 'nginx unit tasks', _int_prop(d, 'TasksCurrent'))
+    m.add('pynx_nginx_workers', 'nginx worker processes', len(util.get_proc_children(pid)) if pid else 0)
+
+    scan = util.get_scan()
+    sites = util.Sites(scan)
+    gen = util.LoadedGeneration(scan)
+    m.add('pynx_nginx_config_ok', '`nginx -t` passes', 1 if get_nginx_test_ok(scan) else 0)
+    m.add('pynx_nginx_pending_reload', 'configs changed since nginx loaded them', 1 if gen.any else 0)
+
+    index = util.SiteIndex(sites)
+    for name, site in index.sites.items():
+        labels = {'site': name}
+        bad = bool(site.status & util.BAD)
+        cfg = None if bad else site.site_cfg
+        m.add('pynx_site_enabled', 'site is enabled', 1 if site.status == util.ENABLED else 0, labels)
+        m.add('pynx_site_bad', 'site link is broken or foreign', 1 if bad else 0, labels)
+        m.add('pynx_site_parse_ok', 'site config parsed', 1 if not cfg is None and cfg.parse_ok else 0, labels)
+        m.add('pynx_site_listens', 'listen directives in site config', 0 if cfg is None else len(cfg.listens), labels)
+        m.add('pynx_site_pending_reload', 'site changed since nginx loaded it', 0 if gen.site_note(name) is None else 1, labels)
+
+    topology = util.Topology(index)
+    unit_sites = OrderedDict()
+    for site, rows in topology.sites.items():
+        for (sock, unit, via) in rows: unit_sites.setdefault(unit, []).append(site)
+    if len(unit_sites) > 0:
+        props = util.get_units_props(list(unit_sites.keys()), ['ActiveState', 'MemoryCurrent', 'TasksCurrent'])
+        for unit, d in props.items():
+            labels = {'unit': unit, 'site': ','.join(unit_sites[unit])}
+            m.add('pynx_wsgi_up', 'wsgi unit is active', 1 if d.get('ActiveState') == 'active' else 0, labels)
+            m.add('pynx_wsgi_memory_bytes', 'wsgi unit memory', _int_prop(d, 'MemoryCurrent'), labels)
+            m.add('pynx_wsgi_tasks', 'wsgi unit tasks', _int_prop(d, 'TasksCurrent'), labels)
+
+    m.add('pynx_export_duration_seconds', 'time taken to collect metrics', round(time.monotonic() - t0, 6))
+    return m
+
+
+# Atomic write (temp file + rename) so node_exporter never reads a partial file
+def write_textfile(path:str, text:str):
+    assertNotBlank('path', path)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as fp:
+        fp.write(text)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
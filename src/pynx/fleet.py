@@ -0,0 +1,258 @@
+#########################################
+# .: fleet.py :.
+# Run pynx commands on many hosts through pynx agents
+#
+# Agent:  % pynx agent [--listen tcp:0.0.0.0:7801|unix:/run/pynx.sock] [--secret-file <path>]
+# Client: % pynx fleet <hosts-file> <pynx cmd ...> [--parallel 16] [--timeout 30] [--ndjson]
+#
+# Protocol: one json line per connection each way. Requests are authenticated with
+# an HMAC-SHA256 of args, timestamp, nonce and timeout using a shared secret. Agents reject
+# requests outside of C_.FLEET_MAX_SKEW seconds and replayed nonces.
+#########################################
+import os
+import sys
+import json
+import time
+import hmac
+import socket
+import hashlib
+import threading
+import subprocess
+import socketserver
+import concurrent.futures
+from collections import OrderedDict
+from . import util
+from .util import pc, C_, assertNotBlank
+
+
+def get_secret(path:str=None) -> bytes:
+    path = util.get_config().get('fleet', 'secret_file', fallback=C_.FLEET_SECRET_FILE) if path is None else path
+    try:
+        with open(path, 'rb') as fp:
+            secret = fp.read().strip()
+    except OSError as ex:
+        raise AssertionError(f"Could not read fleet secret file {path}: {ex}")
+    assert len(secret) >= 16, f"Fleet secret in {path} must be at least 16 bytes"
+    return secret
+
+
+def sign(secret:bytes, args:list, ts:float, nonce:str, timeout:float) -> str:
+    msg = json.dumps([args, ts, nonce, timeout]).encode('utf-8')
+    return hmac.new(secret, msg, hashlib.sha256).hexdigest()
+
+
+# `tcp:host:port`, `host:port` or `unix:/path` -> (family, address)
+def parse_address(addr:str) -> tuple:
+    assertNotBlank('addr', addr)
+    if addr.find('unix:') == 0: return (socket.AF_UNIX, addr[5:])
+    if addr.find('tcp:') == 0: addr = addr[4:]
+    (host, port) = addr.rsplit(':', 1) if addr.find(':') > -1 else (addr, str(C_.FLEET_PORT))
+    return (socket.AF_INET6 if host.find('[') == 0 else socket.AF_INET, (host.strip('[]'), int(port)))
+
+
+def _read_line(sock, limit:int) -> bytes:
+    buf = b''
+    while buf.find(b'\n') == -1:
+        chunk = sock.recv(65536)
+        if not chunk: break
+        buf += chunk
+        if len(buf) > limit: raise Exception(f"Message exceeds {limit} bytes")
+    return buf.split(b'\n', 1)[0]
+
+
+
+# ==============================================
+# Agent
+# ==============================================
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        agent = self.server.agent
+        self.request.settimeout(C_.FLEET_REQUEST_TIMEOUT) # clients that connect and send nothing
+        try:
+            res = agent.execute(json.loads(_read_line(self.request, C_.FLEET_MAX_REQUEST)))
+        except Exception as ex:
+            res = {'ok': False, 'code': -1, 'out': '', 'err': f"{util.getClassName(ex)}: {ex}", 'elapsed': 0}
+        self.wfile.write(json.dumps(res).encode('utf-8') + b'\n')
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _TCP6Server(_TCPServer):
+    address_family = socket.AF_INET6
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class Agent():
+    def __init__(self, listen:str, secret:bytes):
+        assertNotBlank('listen', listen)
+        self._secret = secret
+        self._nonces = OrderedDict() # nonce -> ts, for replay detection
+        self._lock = threading.Lock()
+        (family, address) = parse_address(listen)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address): os.remove(address)
+            self._server = _UnixServer(address, _AgentHandler)
+            os.chmod(address, 0o600)
+        else:
+            self._server = (_TCP6Server if family == socket.AF_INET6 else _TCPServer)(address, _AgentHandler)
+        self._server.agent = self
+        self._listen = listen
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def _check(self, req:dict):
+        args = req.get('args')
+        assert isinstance(args, list) and len(args) > 0 and all([isinstance(a, str) for a in args]), "args must be a non empty list of str"
+        assert not args[0] in C_.FLEET_DENY_CMD, f"Command `{args[0]}` is not allowed through agent"
+        (ts, nonce, mac, timeout) = (req.get('ts'), req.get('nonce'), req.get('mac'), req.get('timeout'))
+        assert isinstance(ts, (int, float)) and isinstance(nonce, str) and isinstance(mac, str), "Missing ts, nonce or mac"
+        assert isinstance(timeout, (int, float)) and timeout > 0, "Missing or invalid timeout"
+        assert hmac.compare_digest(sign(self._secret, args, ts, nonce, timeout), mac), "Bad signature"
+        now = time.time()
+        assert abs(now - ts) <= C_.FLEET_MAX_SKEW, f"Request timestamp is off by {now - ts:.0f}s"
+        with self._lock:
+            while len(self._nonces) > 0:
+                (n, n_ts) = next(iter(self._nonces.items()))
+                if now - n_ts <= C_.FLEET_MAX_SKEW * 2: break
+                self._nonces.popitem(last=False)
+            assert not nonce in self._nonces, "Replayed request"
+            self._nonces[nonce] = now
+        return args
+
+    def execute(self, req:dict) -> dict:
+        args = self._check(req)
+        timeout = req['timeout'] # signed
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([p for p in sys.path if p])
+        t0 = time.monotonic()
+        try:
+            p = subprocess.run([sys.executable, '-m', 'pynx'] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                              ,stdin=subprocess.DEVNULL, timeout=timeout, env=env)
+        except subprocess.TimeoutExpired:
+            return {'ok': False, 'code': -1, 'out': '', 'err': f"timed out after {timeout}s on agent", 'elapsed': time.monotonic() - t0}
+        return {'ok': p.returncode == 0, 'code': p.returncode, 'elapsed': time.monotonic() - t0
+               ,'out': p.stdout.decode('utf-8', errors='replace'), 'err': p.stderr.decode('utf-8', errors='replace')}
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+
+# ==============================================
+# Client
+# ==============================================
+
+# Hosts file: one host per line as `[name] address`. Address is host:port, tcp:host:port or unix:/path
+# Names and agents must be unique: results are keyed by name and a command must not run twice on a host
+def read_hosts(path:str) -> list:
+    assertNotBlank('path', path)
+    hosts = []
+    seen = {} # name or parsed address -> line
+    with open(path) as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if line == '': continue
+            parts = line.split()
+            assert len(parts) <= 2, f"Invalid line in hosts file {path}: {line}"
+            (name, address) = (parts[0], parts[-1])
+            for key in (('name', name), ('address', parse_address(address))):
+                assert not key in seen, f"Duplicate {key[0]} in hosts file {path}: `{line}` and `{seen[key]}`"
+                seen[key] = line
+            hosts.append((name, address))
+    return hosts
+
+
+def call(address:str, args:list, secret:bytes, timeout:float) -> dict:
+    (family, addr) = parse_address(address)
+    ts = time.time()
+    nonce = os.urandom(16).hex()
+    req = {'args': args, 'ts': ts, 'nonce': nonce, 'mac': sign(secret, args, ts, nonce, timeout), 'timeout': timeout}
+    deadline = time.monotonic() + timeout + C_.FLEET_TIMEOUT_SLACK
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout + C_.FLEET_TIMEOUT_SLACK)
+        sock.connect(addr)
+        sock.sendall(json.dumps(req).encode('utf-8') + b'\n')
+        sock.settimeout(max(0.1, deadline - time.monotonic()))
+        line = _read_line(sock, C_.FLEET_MAX_RESPONSE)
+    assert line != b'', "Agent closed connection without response"
+    return json.loads(line)
+
+
+def _call_host(name:str, address:str, args:list, secret:bytes, timeout:float) -> dict:
+    t0 = time.monotonic()
+    try:
+        res = call(address, args, secret, timeout)
+    except Exception as ex:
+        res = {'ok': False, 'code': -1, 'out': '', 'err': f"{util.getClassName(ex)}: {ex}"}
+    res['host'] = name
+    res['elapsed'] = time.monotonic() - t0
+    return res
+
+
+# Runs args on hosts concurrently. Yields results in order of completion
+def run(hosts:list, args:list, secret:bytes, parallel:int=None, timeout:float=None):
+    parallel = C_.FLEET_PARALLEL if parallel is None else parallel
+    timeout = C_.FLEET_TIMEOUT if timeout is None else timeout
+    assert parallel > 0, f"parallel must be > 0. Got: {parallel}"
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(parallel, max(1, len(hosts)))) as pool:
+        futures = [pool.submit(_call_host, name, address, args, secret, timeout) for (name, address) in hosts]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def main_agent(args:list):
+    listen = util.pop_opt(args, '--listen', default=util.get_config().get('fleet', 'listen', fallback=C_.FLEET_LISTEN))
+    secret = get_secret(util.pop_opt(args, '--secret-file'))
+    assert len(args) == 0, f"Unexpected args for agent: {args}"
+    agent = Agent(listen, secret)
+    pc(f"pynx agent listening on {listen}")
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.shutdown()
+
+
+# Returns (ok, reason). ok is False if the command failed on any host
+def main_fleet(args:list) -> tuple:
+    secret_file = util.pop_opt(args, '--secret-file')
+    parallel = int(util.pop_opt(args, '--parallel', default=str(C_.FLEET_PARALLEL)))
+    timeout = float(util.pop_opt(args, '--timeout', default=str(C_.FLEET_TIMEOUT)))
+    bNdjson = util.pop_flag(args, '--ndjson')
+    assert len(args) >= 2, "Usage: pynx fleet <hosts-file> <pynx cmd ...>"
+    hosts = read_hosts(args[0])
+    cmd_args = args[1:]
+    secret = get_secret(secret_file)
+
+    results = {}
+    failed = 0
+    for res in run(hosts, cmd_args, secret, parallel, timeout):
+        if not res['ok']: failed += 1
+        if bNdjson:
+            print(json.dumps(res), flush=True)
+        else:
+            results[res['host']] = res
+            pc(f"{res['host']}: {'ok' if res['ok'] else 'failed'} ({res['elapsed']:.2f}s) [{len(results)}/{len(hosts)}]")
+
+    status = (True, None) if failed == 0 else (False, f"failed on {failed} of {len(hosts)} hosts")
+    if bNdjson: return status
+
+    table = util.build_grid(['Host', 'Result', 'Time', 'Output'], ['l', 'c', 'r', 'l'])
+    for (name, address) in hosts:
+        res = results[name]
+        out = (res['out'] + res['err']).rstrip('\n')
+        table.add_row([name, 'ok' if res['ok'] else f"failed ({res['code']})", f"{res['elapsed']:.2f}s", out if out else '-'])
+    pc(f"\n{table.draw()}\n")
+    return status
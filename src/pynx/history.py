@@ -0,0 +1,211 @@
+#########################################
+# .: history.py :.
+# Duration history of state changing commands (start/stop/reload/restart/enable/disable)
+#
+# % pynx history [--unit <unit>] [--stats] [--limit <n>]
+#
+# Records are kept in a fixed size ring buffer file (C_.FILE_HISTORY) so it never grows:
+#   header: magic, version, record size, capacity, head (next slot), count
+#   records: C_.HISTORY_CAPACITY fixed size structs (see RECORD)
+# Appends write one record and the header through mmap under flock, so they are O(1)
+# regardless of how much history is kept. Reads unpack the mapped records in one pass.
+# Unit names longer than UNIT_LEN bytes are stored as a prefix and a hash of the full name
+# (see unit_key), so `--unit <full name>` still finds them.
+#########################################
+import os
+import mmap
+import time
+import fcntl
+import hashlib
+import contextlib
+import struct
+from collections import OrderedDict, namedtuple
+from . import util
+from .util import C_, assertNotBlank
+
+MAGIC = b'PYNXHIST'
+VERSION = 2
+HEADER = struct.Struct('<8sHHIII')
+HEADER_SIZE = 64
+UNIT_LEN = 96
+# ts, unit, action, duration (s), outcome, workers before, workers after
+RECORD = struct.Struct(f'<d{UNIT_LEN}s14sfBxHH')
+
+OK = 0
+FAILED = 1
+TIMEOUT = 2
+OUTCOMES = {OK: 'ok', FAILED: 'failed', TIMEOUT: 'timeout'}
+
+Record = namedtuple('Record', ['ts', 'unit', 'action', 'duration', 'outcome', 'workers_before', 'workers_after'])
+
+
+# Unit name as stored: utf-8, or when longer than UNIT_LEN `<prefix>~<sha1 of the name, 16 hex>`
+def unit_key(unit:str) -> bytes:
+    b = unit.encode('utf-8')
+    if len(b) <= UNIT_LEN: return b
+    return b[:UNIT_LEN - 17] + b'~' + hashlib.sha1(b).hexdigest()[:16].encode('ascii')
+
+
+class History():
+    def __init__(self, path:str=None, capacity:int=None):
+        self._path = util.get_state_path(C_.FILE_HISTORY) if path is None else path
+        capacity = C_.HISTORY_CAPACITY if capacity is None else capacity
+        assert capacity > 0, f"capacity must be > 0. Got: {capacity}"
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with self._lock(fcntl.LOCK_EX):
+                self._capacity = self._open(capacity)
+            self._mm = mmap.mmap(self._fd, HEADER_SIZE + self._capacity * RECORD.size)
+        except:
+            os.close(self._fd)
+            raise
+
+    # Returns capacity of existing file or initializes a new one
+    def _open(self, capacity:int) -> int:
+        size = os.fstat(self._fd).st_size
+        if size >= HEADER.size:
+            (magic, version, rsize, cap, head, count) = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+            if magic == MAGIC and version == VERSION and rsize == RECORD.size and size == HEADER_SIZE + cap * rsize:
+                return cap
+        # new, foreign or older format file: start over
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, HEADER_SIZE + capacity * RECORD.size)
+        os.pwrite(self._fd, HEADER.pack(MAGIC, VERSION, RECORD.size, capacity, 0, 0), 0)
+        return capacity
+
+    @contextlib.contextmanager
+    def _lock(self, op):
+        fcntl.flock(self._fd, op)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def append(self, unit:str, action:str, duration:float, outcome:int, workers_before:int=0, workers_after:int=0, ts:float=None):
+        assertNotBlank('unit', unit)
+        assertNotBlank('action', action)
+        assert outcome in OUTCOMES, f"Unknown outcome: {outcome}"
+        rec = RECORD.pack(time.time() if ts is None else ts
+                         ,unit_key(unit), action.encode('utf-8')
+                         ,duration, outcome, min(workers_before, 0xFFFF), min(workers_after, 0xFFFF))
+        with self._lock(fcntl.LOCK_EX):
+            (magic, version, rsize, cap, head, count) = HEADER.unpack_from(self._mm, 0)
+            off = HEADER_SIZE + head * RECORD.size
+            self._mm[off:off + RECORD.size] = rec
+            HEADER.pack_into(self._mm, 0, magic, version, rsize, cap, (head + 1) % cap, min(count + 1, cap))
+
+    # Records oldest first
+    def records(self, unit:str=None) -> list:
+        with self._lock(fcntl.LOCK_SH):
+            (magic, version, rsize, cap, head, count) = HEADER.unpack_from(self._mm, 0)
+            start = (head - count) % cap
+            if start + count <= cap:
+                raw = self._mm[HEADER_SIZE + start * rsize:HEADER_SIZE + (start + count) * rsize]
+            else:
+                raw = self._mm[HEADER_SIZE + start * rsize:HEADER_SIZE + cap * rsize] \
+                    + self._mm[HEADER_SIZE:HEADER_SIZE + head * rsize]
+        b_unit = None if unit is None else unit_key(unit)
+        recs = []
+        for (ts, r_unit, action, duration, outcome, w_before, w_after) in RECORD.iter_unpack(raw):
+            r_unit = r_unit.rstrip(b'\0')
+            if not b_unit is None and r_unit != b_unit: continue
+            recs.append(Record(ts, r_unit.decode('utf-8', errors='replace'), action.rstrip(b'\0').decode('utf-8', errors='replace')
+                              ,duration, outcome, w_before, w_after))
+        return recs
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Appends a record for a command. History is best effort and never fails the command
+def record(unit:str, action:str, duration:float, outcome:int, workers_before:int=0, workers_after:int=0):
+    try:
+        with History() as h:
+            h.append(unit, action, duration, outcome, workers_before, workers_after)
+    except Exception as ex:
+        util.pc(f"(history not recorded: {util.getClassName(ex)}: {ex})")
+
+
+# Records a successful command whose change needs a reload. When the reload is deferred in a
+# session (util.reload_deferred) the record is held until flush_deferred gives the reload outcome
+def record_after_reload(unit:str, action:str, duration:float, workers_before:int=0, workers_after:int=0):
+    if not util.reload_deferred():
+        record(unit, action, duration, OK, workers_before, workers_after)
+        return
+    C_.SESSION.deferred_records.setdefault(C_.INSTANCE, []).append((unit, action, duration, workers_before))
+
+
+# Writes the records held for the deferred reload of the current instance with the outcome of that
+# reload. Its duration is added to theirs
+def flush_deferred(outcome:int, duration:float=0.0, workers_after:int=0):
+    if C_.SESSION is None: return
+    for (unit, action, r_duration, workers_before) in C_.SESSION.deferred_records.pop(C_.INSTANCE, []):
+        record(unit, action, r_duration + duration, outcome, workers_before, workers_after)
+
+
+# (unit, action) -> (count, failed, p50, p90, p99, max) over successful runs
+def stats(recs:list) -> OrderedDict:
+    groups = OrderedDict()
+    for r in recs:
+        groups.setdefault((r.unit, r.action), []).append(r)
+    res = OrderedDict()
+    for key in sorted(groups.keys()):
+        rows = groups[key]
+        durations = sorted([r.duration for r in rows if r.outcome == OK])
+        failed = len(rows) - len(durations)
+        if len(durations) == 0:
+            res[key] = (len(rows), failed, None, None, None, None)
+        else:
+            res[key] = (len(rows), failed, util.percentile(durations, 50), util.percentile(durations, 90)
+                       ,util.percentile(durations, 99), durations[-1])
+    return res
+
+
+def _fmt_s(v) -> str:
+    return '-' if v is None else f"{v:.3f}s"
+
+
+def main_history(args:list):
+    unit = util.pop_opt(args, '--unit')
+    bStats = util.pop_flag(args, '--stats')
+    limit = int(util.pop_opt(args, '--limit', default=str(C_.HISTORY_LIMIT)))
+    assert limit > 0, f"--limit must be > 0. Got: {limit}"
+    assert len(args) == 0, f"Unexpected args for history: {args}"
+
+    with History() as h:
+        recs = h.records(unit)
+
+    if len(recs) == 0:
+        util.pc(f"No history recorded{'' if unit is None else f' for {unit}'}")
+        return
+
+    if bStats:
+        table = util.build_grid(['Unit', 'Action', 'Runs', 'Failed', 'p50', 'p90', 'p99', 'Max']
+                               ,['l'   , 'l'     , 'r'   , 'r'     , 'r'  , 'r'  , 'r'  , 'r'])
+        for (r_unit, action), (count, failed, p50, p90, p99, mx) in stats(recs).items():
+            table.add_row([r_unit, action, str(count), str(failed), _fmt_s(p50), _fmt_s(p90), _fmt_s(p99), _fmt_s(mx)])
+        util.pc(f"\n{table.draw()}\n")
+        util.pc(f"{len(recs)} records since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(recs[0].ts))}")
+        return
+
+    table = util.build_grid(['Time', 'Unit', 'Action', 'Duration', 'Result', 'Workers']
+                           ,['l'   , 'l'   , 'l'     , 'r'       , 'c'     , 'r'])
+    for r in recs[-limit:]:
+        table.add_row([time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r.ts)), r.unit, r.action
+                      ,_fmt_s(r.duration), OUTCOMES.get(r.outcome, str(r.outcome)), f"{r.workers_before} -> {r.workers_after}"])
+    util.pc(f"\n{table.draw()}\n")
@@ -0,0 +1,211 @@
+#########################################
+# .: precompress.py :.
+# Precompress static files of a site for gzip_static / brotli_static
+#
+# % pynx <site> precompress [--parallel <n>]
+#
+# Document roots are the `root` of the server block and the `root` / `alias` of its
+# locations (SiteConfig.roots): a location root serves `<root><location>`, so only that
+# part of the root is walked. Paths with variables are skipped. The trees are walked with
+# os.scandir and files with an extension in C_.PRECOMPRESS_EXT of at least
+# C_.PRECOMPRESS_MIN_SIZE bytes are compressed to `<file>.gz` (and `<file>.br` when the
+# `brotli` package is installed) in a process pool. Compressed files get the mtime of
+# their source (nginx sends it as Last-Modified), so a sibling with an mtime not older
+# than the source is up to date and skipped: reruns only compress new and changed files.
+# Results that save less than 1 - C_.PRECOMPRESS_MAX_RATIO of the size are not kept. Such
+# files are listed with their mtime and size in C_.FILE_PRECOMPRESS (pynx cache dir) and
+# skipped until they change, so incompressible files are not compressed again every run.
+#########################################
+import io
+import os
+import gzip
+import time
+import multiprocessing
+import concurrent.futures
+from collections import OrderedDict
+from . import util
+from .util import pc, C_
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZ = '.gz'
+BR = '.br'
+
+
+# [(label, dir or file)] to precompress and [(label, reason)] skipped
+def get_roots(site_cfg) -> tuple:
+    assert not site_cfg is None and site_cfg.parse_ok, "Site config could not be parsed"
+    roots = []
+    skipped = []
+    for (loc, modifier, kind, path) in (site_cfg.roots or []):
+        label = f"{kind} {path}" if loc is None else f"location {(modifier + ' ') if modifier else ''}{loc} {kind} {path}"
+        if path.find('$') > -1:
+            skipped.append((label, 'has variables'))
+            continue
+        if not os.path.isabs(path):
+            skipped.append((label, 'relative to the nginx prefix'))
+            continue
+        if kind == 'root' and not loc is None and modifier in ('', '^~', '='):
+            path = os.path.join(path, loc.lstrip('/'))
+            if modifier == '=' and not os.path.isdir(path): path = os.path.dirname(path)
+        path = os.path.normpath(path)
+        if not os.path.exists(path):
+            skipped.append((label, f"{path} not found"))
+            continue
+        roots.append((label, path))
+
+    # Trees inside another root are walked with it
+    res = []
+    for (label, path) in sorted(roots, key=lambda r: r[1]):
+        if any([path == p or path.find(p.rstrip('/') + '/') == 0 for (l, p) in res]): continue
+        res.append((label, path))
+    return (res, skipped)
+
+
+def _eligible(name:str, size:int) -> bool:
+    return size >= C_.PRECOMPRESS_MIN_SIZE and os.path.splitext(name)[1].lower() in C_.PRECOMPRESS_EXT
+
+
+# Walks a root (dir or file). skip: path -> [mtime_ns, size, formats not worth it] of
+# incompressible files. Returns (files checked, up to date, [(path, mtime_ns, formats to
+# write)], {path: skip record still valid})
+def scan(root:str, formats:tuple, skip:dict=None) -> tuple:
+    skip = {} if skip is None else skip
+    res = [0, 0, [], {}]
+    def _check(entries:dict, only:str=None):
+        for name, entry in entries.items():
+            if not only is None and name != only: continue
+            if not entry.is_file() or entry.is_dir(follow_symlinks=False): continue
+            st = entry.stat()
+            if not _eligible(name, st.st_size): continue
+            res[0] += 1
+            rec = skip.get(entry.path)
+            if not rec is None and (rec[0], rec[1]) == (st.st_mtime_ns, st.st_size):
+                res[3][entry.path] = rec
+            else:
+                rec = None
+            need = []
+            for ext in formats:
+                if not rec is None and ext in rec[2]: continue # not worth it, unchanged since
+                sib = entries.get(name + ext) # siblings come from the same scandir, no extra lookups
+                try:
+                    if sib is None or sib.stat().st_mtime_ns < st.st_mtime_ns: need.append(ext)
+                except OSError:
+                    need.append(ext)
+            if len(need) == 0: res[1] += 1
+            else: res[2].append((entry.path, st.st_mtime_ns, tuple(need)))
+
+    if os.path.isfile(root):
+        with os.scandir(os.path.dirname(root)) as it:
+            _check({e.name: e for e in it}, only=os.path.basename(root))
+        return tuple(res)
+    stack = [root]
+    while len(stack) > 0:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = {e.name: e for e in it}
+        except OSError:
+            continue
+        stack += [e.path for e in entries.values() if e.is_dir(follow_symlinks=False)]
+        _check(entries)
+    return tuple(res)
+
+
+# gzip with a fixed header mtime so unchanged content gives identical files
+def _gzip(data:bytes) -> bytes:
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+# Runs in pool workers. Returns (path, original size, {ext: size kept or None}, error)
+def compress(path:str, mtime_ns:int, formats:tuple) -> tuple:
+    sizes = {}
+    try:
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        for ext in formats:
+            out = _gzip(data) if ext == GZ else brotli.compress(data, quality=11)
+            target = path + ext
+            if len(out) > len(data) * C_.PRECOMPRESS_MAX_RATIO:
+                # not worth serving. Drop an outdated sibling so nginx does not serve stale content
+                if os.path.lexists(target): os.remove(target)
+                sizes[ext] = None
+                continue
+            tmp = f"{target}.pynx-{os.getpid()}"
+            with open(tmp, 'wb') as fp:
+                fp.write(out)
+            st = os.stat(path)
+            os.chmod(tmp, st.st_mode & 0o777)
+            os.utime(tmp, ns=(st.st_atime_ns, mtime_ns))
+            os.replace(tmp, target)
+            sizes[ext] = len(out)
+        return (path, len(data), sizes, None)
+    except Exception as ex:
+        return (path, 0, sizes, f"{util.getClassName(ex)}: {ex}")
+
+
+def main_precompress(site_info, parallel:int=None):
+    site_cfg = site_info.site_cfg
+    (roots, skipped) = get_roots(site_cfg)
+    for (label, reason) in skipped: pc(f"skipped {label}: {reason}")
+    assert len(roots) > 0, f"No root or alias found for {site_info.name}"
+    formats = (GZ,) if brotli is None else (GZ, BR)
+    parallel = min(parallel or os.cpu_count() or 1, os.cpu_count() or 1)
+
+    t0 = time.monotonic()
+    skip_path = util.get_state_path(C_.FILE_PRECOMPRESS, cache=True)
+    skip = util.read_json_file(skip_path, default={})
+    # records of other sites are kept, those under the scanned roots are rebuilt
+    skip_after = {p: rec for p, rec in skip.items()
+                  if not any([p == root or p.find(root.rstrip('/') + '/') == 0 for (label, root) in roots])}
+    stats = OrderedDict() # root -> [checked, current, compressed, {ext: bytes saved}, label]
+    todo = []
+    for (label, root) in roots:
+        (checked, current, files, valid) = scan(root, formats, skip)
+        stats[root] = [checked, current, 0, {ext: 0 for ext in formats}, label]
+        todo += [(root, f) for f in files]
+        skip_after.update(valid)
+
+    errors = []
+    if len(todo) > 0:
+        args = [(path, mtime_ns, need) for (root, (path, mtime_ns, need)) in todo]
+        if parallel == 1 or len(todo) == 1:
+            results = [compress(*a) for a in args]
+        else:
+            ctx = multiprocessing.get_context('fork')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(parallel, len(todo)), mp_context=ctx) as pool:
+                chunksize = max(1, len(todo) // (parallel * 8))
+                results = list(pool.map(compress, *zip(*args), chunksize=chunksize))
+        for (root, (f_path, mtime_ns, need)), (path, size, sizes, error) in zip(todo, results):
+            if not error is None:
+                errors.append((path, error))
+                continue
+            s = stats[root]
+            s[2] += 1
+            for ext, n in sizes.items():
+                if not n is None: s[3][ext] += size - n
+            futile = [ext for ext, n in sizes.items() if n is None]
+            if len(futile) > 0:
+                prev = skip_after.get(path, [None, None, []])
+                skip_after[path] = [mtime_ns, size, sorted(set(futile + prev[2]))]
+    if skip_after != skip: util.write_json_file(skip_path, skip_after)
+
+    table = util.build_grid(['Root', 'Files', 'Up to date', 'Compressed'] + [f"Saved {ext}" for ext in formats]
+                           ,['l'   , 'r'    , 'r'         , 'r'] + ['r' for ext in formats])
+    for root, (checked, current, compressed, saved, label) in stats.items():
+        table.add_row([f"{root}\n({label})", str(checked), str(current), str(compressed)] + [util.fmt_size(saved[ext]) for ext in formats])
+    pc(f"\n{table.draw()}\n")
+    for (path, error) in errors: pc(f"failed {path}: {error}")
+    saved = {ext: sum([s[3][ext] for s in stats.values()]) for ext in formats}
+    pc(f"{site_info.name}: {sum([s[2] for s in stats.values()])} files compressed, "
+       f"{sum([s[1] for s in stats.values()])} up to date, {len(errors)} failed. Saved "
+       f"{', '.join([f'{util.fmt_size(n)} ({ext})' for ext, n in saved.items()])} in {time.monotonic() - t0:.2f}s")
+    if brotli is None: pc(f"no .br files: install the `brotli` package (pip install pynx[brotli])")
+    lines = ' '.join(site_cfg.config_lines)
+    if lines.find('gzip_static') == -1:
+        pc(f"note: {site_info.name} has no `gzip_static on;` (may be set in nginx.conf)")
@@ -16,22 +16,88 @@
 # [.] Write readme.md
 #########################################
 import sys
+import time
 import getpass
+import shlex
+import multiprocessing
+import concurrent.futures
 from . import util
-from .util import pc, noop, C_
+from . import fleet
+from . import export
+from . import history
+from . import complete
+from . import conns
+from . import warmup
+from . import audit
+from . import certs
+from . import tail
+from . import snapshot
+from . import tune
+from . import precompress
+from . import cache
+from . import bench
+from .util import pc, C_
+from collections import OrderedDict
 
 assert sys.version_info >= (3, 7, 9), f"Minimum python version supported is 3.7.9. Current version is: {sys.version}"
 
+# Prints help and msg (a usage error) and exits. Exit status is 2 for usage errors, 0 for help
 def print_cli(msg:str = None):
+    if not C_.SESSION is None and not msg is None: # batch / shell: no help page for each bad line
+        print(msg)
+        sys.exit(2)
+
     print("""pynx - python nginx manager
  Server commands (pynx <cmd>):
     status - Show status of nginx daemon
       list - List all available and enabled sites
+             --where '<expr>': eg. 'port=443 and enabled and not name=dev_*'
+                 keys: name=<glob>, port(=,!=,<,>,<=,>=)<n>, server_name=<glob>, socket=<glob>
+                 flags: enabled, available, bad, pending, wsgi, default_server, parse_ok
+             --sort <keys>: name, status, server_name, port. `-` prefix for descending
+             --limit <n>: show first n sites only
+             --stream: print rows as they are rendered with column widths from the first 100 rows
+             --conns: add established/time-wait/syn-recv/accept queue counts per listen and wsgi socket
       test - Verify site configs
      start - Start nginx daemon
       stop - Stop nginx daemon
     reload - Reload nginx daemon
    restart - Restart nginx daemon
+    export - Write nginx, site and wsgi state in Prometheus text format to stdout
+             --textfile <path>: write atomically to path (eg. node_exporter textfile dir)
+ conflicts - Show enabled sites with duplicate listen+server_name or default_server
+ who <query> - Show sites for a port, addr:port, unix socket path or server name
+   history - Show recent start/stop/reload/restart/enable/disable durations
+             --unit <unit>: only nginx, a wsgi unit or site:<site>
+             --stats: runs, failures and p50/p90/p99/max duration per unit and action
+             --limit <n>: show last n records (default 20)
+     audit [site ...] - Run gixy analysis plugins on all (or the given) site configs, grouped by severity
+             --ndjson: one json finding per line. --parallel <n>: processes (default cpu count)
+             Findings are cached per config content, so only changed sites are analyzed again
+     certs - List ssl_certificate files of all sites with expiry, key type and SANs, soonest expiry first
+             Flags expired/expiring certs and server_names not covered by the cert. --ndjson: one json cert per line
+      tune - Compare worker_processes/cpu_affinity/connections/rlimit_nofile and upstream keepalive with
+             cpus, worker sockets and fd limits from /proc and upstream TIME_WAIT churn. Prints evidence per check
+             --duration <s>: sample worker sockets for s seconds (default 2). Peaks are kept per nginx master
+     cache [zone] - Size, files and age distribution of proxy_cache_path (fastcgi/uwsgi/scgi) zones. --parallel <n>
+     cache purge [zone] --key-pattern <glob> [--dry-run] - Delete the cache entries whose key matches
+             (keys as built by proxy_cache_key, eg. 'httpsGETexample.com/api/*'). A key without wildcards is found by md5
+  rollback [id] - Restore sites-enabled links and sites-available files of a snapshot, check with nginx -t and reload
+             Without id: the newest snapshot that differs from now. --list: show snapshots and what restoring changes
+             Snapshots are taken before site enable/disable/start/stop and nginx start/reload/restart
+ Instances (when defined in /etc/pynx/pynx.conf):
+   --instance <name> - Run command against instance (default: [pynx] default_instance or first defined)
+   --all-instances   - Run command against every instance. list, status and test run concurrently
+ Fleet (run pynx on many hosts through agents. Shared secret: [fleet] secret_file, default /etc/pynx/fleet.secret):
+     agent [--listen tcp:<host>:<port>|unix:<path>] [--secret-file <path>] - Serve pynx commands
+     fleet <hosts-file> <cmd ...> [--parallel 16] [--timeout 30] [--ndjson] [--secret-file <path>]
+           hosts-file: one `[name] <host:port|unix:/path>` per line
+ Batch (run many commands in one process, sharing site scans, unit status and version detection):
+     batch <file|-> - Run commands from file (one per line, `#` comments). Stops at the first error
+     shell          - Interactive prompt. `exit` or ctrl-d to leave
+     Site start/stop reloads are deferred to the next `reload` line or the end of the batch/shell
+ Shell completion:
+     completion bash|zsh - Print completion script. eg. pynx completion bash > /etc/bash_completion.d/pynx
  Site commands (pynx <site> <cmd>):
     status - Show status for site
      start - Enables site if not enabled an reload nginx
@@ -39,11 +105,27 @@ def print_cli(msg:str = None):
     enable - Enables site> if not enabled. Will prompt for reload
    disable - Disables site if enabled. Will prompt for reload
     config - Prints config summary for site
- WSGI commands (pynx <cmd> wsgi:<site>):
+     conns - Show live connections per listen port and wsgi socket (from /proc/net)
+      tail - Follow the site's access log (path from its access_log). Survives logrotate
+             --stats: rolling 1s/10s/60s req/s, status class mix and $request_time p50/p90/p99
+ precompress - Write .gz (and .br with the brotli package) next to static files under the site's root/alias
+             for gzip_static/brotli_static. Only new and changed files are compressed. --parallel <n>: processes (max cpu count)
+     bench - HTTP keep-alive load test of the site on its first local listen (Host: its server_name). Prints req/s and
+             latency percentiles, compared with the last run. -c <n>: connections (default 16), -d <s>: seconds (default 5)
+             --path <uri> (default /), --listen <addr:port|port>: another listen of the site, --wsgi: the wsgi socket instead
+ WSGI commands (pynx wsgi:<site> <cmd>):
+   (<site> is mapped to its unit via the site's proxy_pass unix socket. Unmapped names are used as unit names)
+   (wsgi:<site>,<site>,... or wsgi:* for units of all enabled sites run status/start/stop/restart concurrently
+     --parallel <n>: units at a time (default 8), --timeout <s>: per unit (default 60))
     status - Show status for site wsgi
      start - Starts site wsgi if stopped
       stop - Stops site wsgi if started
    restart - Restart site wsgi
+             start/restart send warm-up requests to the wsgi socket when [warmup:<site>] is configured
+             (paths, concurrency, threshold_ms, max_requests) and print the latency curve. --no-warmup to skip
+      logs - Show new journal entries for site wsgi since last call
+             --follow: keep streaming new entries
+             --summary: per minute counts of errors, warnings and start/stop/restarts
  """)
 
     if not isinstance(msg, str) or msg.strip() == '':
@@ -54,25 +136,531 @@ def print_cli(msg:str = None):
 
     if not msg is None: print(msg)
 
-    sys.exit(0)
+    sys.exit(0 if msg is None else 2)
+
+
+def _get_status() -> tuple:
+    (status, out, summary, data) = util.get_sytemd_nginx_status()
+    gen = util.LoadedGeneration()
+    pending = gen.reasons + [f'{n} ({r})' for n, r in gen.pending.items()]
+    return (status, out, summary, dict(data), pending)
+
+def _print_status(res:tuple, name:str='nginx'):
+    (status, out, summary, data, pending) = res
+    if status in ('active', 'inactive'):
+        pc(f"{name} status:")
+        pc(f"  status: {summary}")
+        pc(f"     pid: {data.get('Main PID', '-')}")
+        pc(f"  memory: {data.get('Memory', '-')}")
+        pc(f"   tasks: {data.get('Tasks', '-')}")
+        pc(f"     cli: {data.get('CLI', '-')}")
+        if len(pending) > 0:
+            pc(f" pending: {', '.join(pending)}")
+            pc(f"          run `pynx reload` to apply")
+            
+    else:
+        if out is None:
+            pc(f"{status} - {name} status is not ok because: {summary}")
+        else:
+            pc(f"{status} - {name} status is {summary}\n\n {util.pre(out)}")
+
 
+def _get_test() -> tuple:
+    nginx = util.Nginx()
+    return (nginx.ok, nginx.badrows, nginx.reason)
 
-def main(args):
+def _print_test(res:tuple, name:str='nginx'):
+    (ok, badrows, reason) = res
+    if ok:
+        pc(f"Pass - {name} and site configs ok")
+
+    else:
+        pc(f"{name} config issues:")
+        for row in badrows:
+            pc(f"  {row}")
+
+        if not reason is None:
+            pc(f"  (pynx parsing Issue: {reason}")
+
+
+# Pops --where, --sort, --limit from args
+def _get_query(args:list):
+    try:
+        where = util.pop_opt(args, '--where')
+        sort = util.pop_opt(args, '--sort')
+        limit = util.pop_opt(args, '--limit')
+        limit = None if limit is None else int(limit)
+        return util.SiteQuery(where=where, sort=sort, limit=limit)
+    except (AssertionError, ValueError) as ex:
+        print_cli(f"Invalid list query: {ex}")
+
+# Yields the rows of `pynx list` as they are built, so --stream can print each one right away.
+# Rows are lists as in util.site_row with a Conns cell before Notes when net (conns.NetStats)
+# is passed. Pending reload reasons are appended to reasons
+def _iter_list(query, reasons:list, net=None):
+    scan = util.get_scan()
+    gen = util.LoadedGeneration(scan)
+    reasons += gen.reasons
+    for site_info in query.run(util.Sites(scan), gen):
+        if site_info.status & util.BAD:
+            row = util.bad_site_row(site_info)
+            if not net is None: row.insert(4, '-')
+        else:
+            row = util.site_row(site_info, gen.site_note(site_info.name))
+            if not net is None: row.insert(4, conns.site_cell(net, site_info.site_cfg))
+        yield row
+
+
+# Returns (rows, reasons) for `pynx list`
+def _get_list(query, net=None) -> tuple:
+    reasons = []
+    rows = list(_iter_list(query, reasons, net))
+    return (rows, reasons)
+
+
+# Runs list, status or test for one instance in a worker process. query is the list query parsed by the parent
+def _collect_instance(inst, args:list, net=None, query=None) -> tuple:
+    util.use_instance(inst)
     util.init()
-    
-    if len(args) == 0 or  args[0] == '-h' or args[0] == '--help': print_cli()
+    cmd = args[0]
+    if cmd == 'status': return _get_status()
+    if cmd == 'test': return _get_test()
+    if cmd == 'list': return _get_list(query, net)
+    if cmd == 'export': return export.collect()
+    raise Exception(f"Unexpected command for instances: {cmd}")
+
+
+def _export(metrics, textfile:str):
+    if textfile is None:
+        print(metrics.format(), end='')
+    else:
+        export.write_textfile(textfile, metrics.format())
+
+
+# Appends a state change to history. wait_res is the wait_service_state result or None if the command failed
+def _record(unit:str, action:str, t0:float, wait_res:tuple, workers_before:int, data_after:dict=None):
+    if wait_res is None:
+        (outcome, elapsed) = (history.FAILED, time.monotonic() - t0)
+    else:
+        (ok, state, elapsed) = wait_res
+        outcome = history.OK if ok else (history.TIMEOUT if state in C_.SYSTEMD_TRANSIENT else history.FAILED)
+    workers_after = 0 if data_after is None else util.count_workers(data_after.get('Main PID'))
+    history.record(unit, action, elapsed, outcome, workers_before, workers_after)
+    if unit == C_.NGINX_UNIT and action in ('start', 'reload', 'restart'): # applies deferred site changes
+        history.flush_deferred(outcome, elapsed, workers_after)
+
+
+# Snapshot for `pynx rollback` before a state change. Never blocks the command
+def _snapshot(cmd:str):
+    try:
+        snapshot.take(cmd)
+    except (AssertionError, OSError, ValueError) as ex:
+        pc(f"(snapshot not taken: {util.getClassName(ex)}: {ex})")
+
+
+# `a,b,c` or `*` (units of all enabled sites) -> unit -> [sites mapped to it]
+def _get_wsgi_units(spec:str) -> OrderedDict:
+    index = util.SiteIndex()
+    topology = util.Topology(index)
+    units = OrderedDict()
+    if spec == '*':
+        for name, site_info in index.sites.items():
+            if site_info.status != util.ENABLED: continue
+            for unit in topology.units(name): units.setdefault(unit, []).append(name)
+    else:
+        for name in [n.strip() for n in spec.split(',') if n.strip() != '']:
+            unit = topology.resolve_unit(name)
+            units.setdefault(unit, [])
+            if unit != name: units[unit].append(name)
+    return units
+
+
+# Warm-up ([warmup:<site>]) of a started/restarted unit. Returns a note for the done message or None
+def _warmup(name:str, unit:str) -> str:
+    try:
+        return warmup.warm_unit(name, unit)
+    except (AssertionError, ValueError) as ex:
+        pc(f"warm-up of {unit} failed: {ex}")
+        return "warm-up failed"
+
+
+# Returns (ok, reason). ok is False if any unit failed or timed out
+def _run_wsgi_units(units:OrderedDict, cmd:str, parallel:int, timeout:float, bWarmup:bool=True) -> tuple:
+    if len(units) == 0:
+        pc(f"No wsgi units found")
+        return (False, "no wsgi units found")
+    names = list(units.keys())
+
+    if cmd == 'status':
+        table = util.build_grid(['Unit', 'Sites', 'State', 'PID'], ['l', 'l', 'l', 'r'])
+        for unit, d in util.get_units_props(names, ['ActiveState', 'SubState', 'MainPID']).items():
+            table.add_row([unit, ', '.join(units[unit]) or '-', f"{d.get('ActiveState')} ({d.get('SubState')})", d.get('MainPID', '-')])
+        pc(f"\n{table.draw()}\n")
+        return (True, None)
+
+    t0 = time.monotonic()
+    results = util.run_units_action(names, cmd, parallel, timeout)
+    after = util.get_units_props(names, ['ActiveState', 'SubState', 'MainPID'])
+    table = util.build_grid(['Unit', 'Sites', 'Result', 'State', 'Time', 'Notes'], ['l', 'l', 'c', 'l', 'r', 'l'])
+    counts = OrderedDict()
+    for unit, (result, state, elapsed, note, workers) in results.items():
+        d = after[unit]
+        if result != 'skipped':
+            outcome = {'ok': history.OK, 'timeout': history.TIMEOUT}.get(result, history.FAILED)
+            history.record(unit, cmd, elapsed, outcome, workers, util.count_workers(int(d.get('MainPID') or '0')))
+        table.add_row([unit, ', '.join(units[unit]) or '-', result, f"{d.get('ActiveState')} ({d.get('SubState')})"
+                      ,f"{elapsed:.3f}s", '-' if note is None else note])
+        counts[result] = counts.get(result, 0) + 1
+    pc(f"\n{table.draw()}\n")
+    if bWarmup and cmd in ('start', 'restart'):
+        for unit, (result, state, elapsed, note, workers) in results.items():
+            if result != 'ok': continue
+            note = _warmup(unit, unit)
+            if not note is None: pc(f"{unit}: {note}")
+    pc(f"{cmd} of {len(names)} units done in {time.monotonic() - t0:.3f}s - {', '.join([f'{n} {r}' for r, n in counts.items()])}")
+    failed = [unit for unit, res in results.items() if not res[0] in ('ok', 'skipped')]
+    if len(failed) > 0: return (False, f"{cmd} failed for {', '.join(failed)}")
+    return (True, None)
+
+
+def _shell_lines():
+    try:
+        import readline # line editing and history when available
+    except ImportError:
+        pass
+    lineno = 0
+    while True:
+        lineno += 1
+        try:
+            line = input('pynx*> ' if len(C_.SESSION.reload_pending) > 0 else 'pynx> ')
+        except EOFError:
+            print()
+            return
+        except KeyboardInterrupt:
+            print()
+            continue
+        yield (lineno, line)
+
+
+# Applies reloads deferred by site start/stop. Returns False if any is still pending
+def _run_deferred_reloads() -> bool:
+    instances = util.get_instances()
+    for name in sorted(C_.SESSION.reload_pending, key=lambda n: '' if n is None else n):
+        if not name is None: util.use_instance(instances[name])
+        pc(f"deferred reload{'' if name is None else f' ({name})'}:")
+        try:
+            run(['reload'])
+        except SystemExit:
+            pass
+    if len(C_.SESSION.reload_pending) == 0: return True
+    pc(f"nginx reload still pending for: {', '.join([str(n or 'nginx') for n in C_.SESSION.reload_pending])}")
+    return False
+
+
+# History records still held at the end of a session: their reload did not run or failed before _record
+def _flush_unreloaded():
+    instances = util.get_instances()
+    for name in list(C_.SESSION.deferred_records.keys()):
+        if not name is None: util.use_instance(instances[name])
+        history.flush_deferred(history.FAILED)
+
+
+# pynx batch / pynx shell: runs (lineno, line) commands in this process with a util.Session
+# Returns (ok, reason). ok is False if a line failed or a deferred reload is still pending
+def _run_session(lines, interactive:bool=False) -> tuple:
+    C_.SESSION = util.Session()
+    t0 = time.monotonic()
+    (count, failed, stopped, reloaded) = (0, 0, False, True)
+    try:
+        for (lineno, line) in lines:
+            try:
+                args = shlex.split(line, comments=True)
+            except ValueError as ex:
+                args = None
+                err = f"line {lineno}: {ex}"
+            if not args is None:
+                if len(args) == 0: continue
+                if args[0] == 'pynx': args = args[1:]
+                if interactive and args[0] in ('exit', 'quit'): break
+                if interactive and args[0] in ('help', '-h', '--help'):
+                    try:
+                        print_cli()
+                    except SystemExit:
+                        pass
+                    continue
+                err = f"line {lineno}: `{args[0]}` cannot be run in a batch" if args[0] in C_.SESSION_DENY_CMD else None
+
+            if err is None:
+                if not interactive: pc(f"pynx {' '.join(args)}")
+                count += 1
+                if interactive: C_.SESSION.units.clear() # unit state may have changed while typing
+                try:
+                    (ok, reason) = main(args)
+                    if ok: continue
+                    err = f"line {lineno}: {reason}"
+                except SystemExit: # print_cli, eg. bad usage
+                    err = f"line {lineno}: not run"
+                except KeyboardInterrupt:
+                    if not interactive: raise
+                    err = f"interrupted"
+                except Exception as ex:
+                    err = f"line {lineno}: {util.getClassName(ex)}: {ex}"
+
+            failed += 1
+            pc(f"failed - {err}")
+            if not interactive:
+                stopped = True
+                break
+
+        if stopped:
+            if len(C_.SESSION.reload_pending) > 0:
+                pc(f"deferred reload not run because the batch stopped. Run `pynx reload` to apply site changes")
+        else:
+            reloaded = _run_deferred_reloads()
+
+        if not interactive:
+            pc(f"batch: {count} commands in {time.monotonic() - t0:.2f}s{f' - stopped at error' if stopped else ''}")
+    finally:
+        _flush_unreloaded()
+        C_.SESSION = None
+    if failed > 0: return (False, f"{failed} of {count} commands failed")
+    if not reloaded: return (False, "deferred nginx reload failed")
+    return (True, None)
+
+
+# Returns (ok, reason). ok is False if any instance failed
+def _run_instances(instances:list, args:list) -> tuple:
+    cmd = args[0]
+    textfile = util.pop_opt(args, '--textfile')
+    net = None
+    if util.pop_flag(args, '--conns'): # instances share the host: read /proc/net once here
+        net = conns.NetStats()
+        net.load()
+    # parsed here: print_cli in a worker would exit it and abort the parent halfway through the results
+    query = _get_query(args) if cmd == 'list' else None
+    results = OrderedDict()
+    ctx = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(instances), mp_context=ctx) as pool:
+        futures = OrderedDict([(inst.name, pool.submit(_collect_instance, inst, list(args), net, query)) for inst in instances])
+        for name, future in futures.items():
+            try:
+                results[name] = (True, future.result())
+            except Exception as ex:
+                results[name] = (False, f"{util.getClassName(ex)}: {ex}")
+
+    if cmd == 'list':
+        table = util.build_table(instance=True, conns=not net is None)
+        reasons = []
+        for name, (ok, res) in results.items():
+            if not ok:
+                table.add_row([name, '-', '-', '-', '-'] + (['-'] if not net is None else []) + [f"failed: {res}"])
+                continue
+            (rows, inst_reasons) = res
+            for row in rows: table.add_row([name] + row)
+            reasons += [f"{name}: {r}" for r in inst_reasons]
+        pc(f"\n{table.draw()}\n")
+        if len(reasons) > 0:
+            pc(f"pending reload: {', '.join(reasons)}. run `pynx reload` to apply")
+        return _instances_status(results, cmd)
+
+    if cmd == 'export':
+        metrics = export.Metrics()
+        for name, (ok, res) in results.items():
+            if ok:
+                metrics.merge(res)
+            else:
+                pc(f"{name} export failed: {res}")
+        _export(metrics, textfile)
+        return _instances_status(results, cmd)
+
+    for name, (ok, res) in results.items():
+        if not ok:
+            pc(f"{name} {cmd} failed: {res}")
+        elif cmd == 'status':
+            _print_status(res, name)
+        else:
+            _print_test(res, name)
+            if not res[0]: results[name] = (False, "config test failed")
+    return _instances_status(results, cmd)
+
+
+def _instances_status(results:OrderedDict, cmd:str) -> tuple:
+    failed = [name for name, (ok, res) in results.items() if not ok]
+    if len(failed) > 0: return (False, f"{cmd} failed for {', '.join(failed)}")
+    return (True, None)
+
+
+def main(args):
+    args = list(args)
+    if len(args) == 0 or  args[0] == '-h' or args[0] == '--help':
+        util.init()
+        print_cli()
+
+    if args[0] == '--complete': # normally handled in __main__ without importing this module
+        complete.main_complete(args[1:])
+        return (True, None)
+
+    if args[0] == 'completion':
+        if len(args) != 2: print_cli(f"Usage: pynx completion bash|zsh")
+        try:
+            print(complete.script(args[1]), end='')
+        except AssertionError as ex:
+            print_cli(f"completion: {ex}")
+        return (True, None)
+
+    if args[0] == 'fleet': # client side. No root or local nginx needed
+        try:
+            return fleet.main_fleet(args[1:])
+        except (AssertionError, ValueError, OSError) as ex:
+            pc(f"fleet: {ex}")
+            return (False, f"fleet: {ex}")
 
     if getpass.getuser() != 'root': print_cli(f"Must be run as root")
 
-    cmd = site = None
+    if args[0] in ('batch', 'shell') and C_.SESSION is None:
+        if args[0] == 'shell':
+            if len(args) != 1: print_cli(f"Usage: pynx shell")
+            return _run_session(_shell_lines(), interactive=True)
+        else:
+            if len(args) != 2: print_cli(f"Usage: pynx batch <file|->")
+            if args[1] == '-':
+                return _run_session(enumerate(sys.stdin, 1))
+            else:
+                try:
+                    with open(args[1]) as fp:
+                        lines = list(enumerate(fp, 1))
+                except OSError as ex:
+                    print_cli(f"batch: {ex}")
+                return _run_session(lines)
+
+    if args[0] == 'agent':
+        try:
+            fleet.main_agent(args[1:])
+        except (AssertionError, ValueError, OSError) as ex:
+            pc(f"agent: {ex}")
+            return (False, f"agent: {ex}")
+        return (True, None)
+
+    try:
+        instance = util.pop_opt(args, '--instance')
+        bAllInstances = util.pop_flag(args, '--all-instances')
+        instances = util.get_instances()
+        if (not instance is None or bAllInstances) and len(instances) == 0:
+            print_cli(f"No instances are defined in {C_.PATH_CONFIG}")
+        if not instance is None and not instance in instances:
+            print_cli(f"Unknown instance `{instance}`. Defined: {', '.join(instances.keys())}")
+        default = util.get_default_instance()
+    except AssertionError as ex:
+        print_cli(f"Invalid instance config: {ex}")
+
+    try:
+        util.update_names_cache()
+    except OSError as ex:
+        pc(f"(completion names not updated: {ex})")
+
+    if bAllInstances:
+        res_all = (True, None)
+        if len(args) > 0 and args[0] in C_.INSTANCES_PARALLEL_CMD:
+            res_all = _run_instances(list(instances.values()), args)
+        else:
+            for inst in instances.values():
+                util.use_instance(inst)
+                pc(f"[{inst.name}]")
+                res = run(list(args))
+                if not res[0] and res_all[0]: res_all = res
+        return res_all
+
+    if not instance is None:
+        util.use_instance(instances[instance])
+    elif not default is None:
+        util.use_instance(default)
+
+    return run(args)
+
+
+# Returns (ok, reason). Failures are printed here too, reason is for callers like batch
+def run(args):
+    util.init()
+
+    if len(args) > 0 and args[0] == 'history':
+        try:
+            history.main_history(args[1:])
+        except (AssertionError, ValueError) as ex:
+            pc(f"history: {ex}")
+            return (False, f"history: {ex}")
+        return (True, None)
+
+    if len(args) > 0 and args[0] == 'audit':
+        try:
+            audit.main_audit(args[1:])
+        except (AssertionError, ValueError) as ex:
+            pc(f"audit: {ex}")
+            return (False, f"audit: {ex}")
+        return (True, None)
+
+    if len(args) > 0 and args[0] == 'certs':
+        try:
+            certs.main_certs(args[1:])
+        except (AssertionError, ValueError) as ex:
+            pc(f"certs: {ex}")
+            return (False, f"certs: {ex}")
+        return (True, None)
+
+    if len(args) > 0 and args[0] == 'tune':
+        try:
+            tune.main_tune(args[1:])
+        except (AssertionError, ValueError) as ex:
+            pc(f"tune: {ex}")
+            return (False, f"tune: {ex}")
+        return (True, None)
+
+    if len(args) > 0 and args[0] == 'cache':
+        try:
+            cache.main_cache(args[1:])
+        except (AssertionError, ValueError, OSError) as ex:
+            pc(f"cache: {ex}")
+            return (False, f"cache: {ex}")
+        return (True, None)
+
+    if len(args) > 0 and args[0] == 'rollback':
+        try:
+            return snapshot.main_rollback(args[1:])
+        except (AssertionError, ValueError, OSError) as ex:
+            pc(f"rollback: {ex}")
+            return (False, f"rollback: {ex}")
+
+    cmd = site = arg = None
 
     bNginx = bSite = bWsgi = False
+
+    bFollow = util.pop_flag(args, '-f', '--follow')
+    bSummary = util.pop_flag(args, '--summary')
+    bStream = util.pop_flag(args, '--stream')
+    bConns = util.pop_flag(args, '--conns')
+    bStats = util.pop_flag(args, '--stats')
+    bWarmup = not util.pop_flag(args, '--no-warmup')
+    bBenchWsgi = util.pop_flag(args, '--wsgi')
+    textfile = util.pop_opt(args, '--textfile')
+    try:
+        parallel = int(util.pop_opt(args, '--parallel', default=str(C_.WSGI_PARALLEL)))
+        timeout = float(util.pop_opt(args, '--timeout', default=str(C_.WAIT_TIMEOUT)))
+        bench_conns = util.pop_opt(args, '-c', '--connections')
+        bench_duration = util.pop_opt(args, '-d', '--duration')
+        bench_path = util.pop_opt(args, '--path')
+        bench_listen = util.pop_opt(args, '--listen')
+    except (AssertionError, ValueError) as ex:
+        print_cli(f"Invalid option: {ex}")
+    query = _get_query(args)
     
     if len(args) == 1:
         cmd = args[0]
         if not cmd in C_.SERVER_CMD: print_cli(f"Invalid command: `{cmd}`")
         bNginx = True
 
+    elif len(args) == 2 and args[0] in C_.SERVER_ARG_CMD:
+        (cmd, arg) = args
+        bNginx = True
+
     elif len(args) == 2:
         site = args[0]
         cmd = args[1]
@@ -99,59 +687,69 @@ def main(args):
         # % pynx status
         # ================================
         if cmd == 'status':
-            (status, out, summary, data) = util.get_sytemd_nginx_status()
-            if status in ('active', 'inactive'):
-                pc(f"nginx status:")
-                pc(f"  status: {summary}")
-                pc(f"     pid: {data['Main PID']}")
-                pc(f"  memory: {data['Memory']}")
-                pc(f"   tasks: {data['Tasks']}")
-                pc(f"     cli: {data['CLI']}")
-                    
-            else:
-                if out is None:
-                    pc(f"{status} - nginx status is not ok because: {summary}")
-                else:
-                    pc(f"{status} - nginx status is {summary}\n\n {util.pre(out)}")
+            _print_status(_get_status())
 
 
         # ================================
         # % pynx list
         # ================================
         elif cmd == 'list':
+            net = conns.NetStats() if bConns else None
+            table = util.build_table(conns=bConns)
+            if bStream: # column widths from the first rows, then one row at a time
+                reasons = []
+                pc('')
+                table.stream(_iter_list(query, reasons, net))
+                print()
+            else:
+                (rows, reasons) = _get_list(query, net)
+                for row in rows: table.add_row(row)
+                pc(f"\n{table.draw()}\n")
+            if len(reasons) > 0:
+                pc(f"pending reload: {', '.join(reasons)}. run `pynx reload` to apply")
 
-            sites = util.Sites()
 
-            table = util.build_table()
-            for site_info in sites.Enabled.values(): 
-                util.table_add_ok_row(table, site_info)
+        # ================================
+        # % pynx export [--textfile <path>]
+        # ================================
+        elif cmd == 'export':
+            _export(export.collect(), textfile)
 
-            for site_info in sites.Avail.values():
-                util.table_add_ok_row(table, site_info)
 
-            for site_info in sites.Bad.values(): 
-                util.table_add_bad_row(table, site_info)
-            
-            pc(f"\n{table.draw()}\n")
+        # ================================
+        # % pynx who <port|addr:port|socket|server_name>
+        # ================================
+        elif cmd == 'who':
+            sites = util.SiteIndex().who(arg)
+            if len(sites) == 0:
+                pc(f"No sites found for `{arg}`")
+            else:
+                table = util.build_table()
+                for site_info in sites:
+                    util.table_add_ok_row(table, site_info)
+                pc(f"\n{table.draw()}\n")
 
 
         # ================================
-        # % pynx test
+        # % pynx conflicts
         # ================================
-        elif cmd == 'test':
-            nginx = util.Nginx()
-            if nginx.ok:
-                pc(f"Pass - nginx and site configs ok")
-
+        elif cmd == 'conflicts':
+            conflicts = util.SiteIndex().conflicts()
+            if len(conflicts) == 0:
+                pc(f"No listen conflicts found in enabled sites")
             else:
-                pc(f"nginx config issues:")
-                for row in nginx.badrows:
-                    pc(f"  {row}")
+                pc(f"Listen conflicts in enabled sites:")
+                for (issue, key, names) in conflicts:
+                    pc(f"  {issue} - {key}: {', '.join(names)}")
 
-                if not nginx.reason is None:
-                    pc(f"  (pynx parsing Issue: {nginx.reason}")
 
-            noop()
+        # ================================
+        # % pynx test
+        # ================================
+        elif cmd == 'test':
+            res = _get_test()
+            _print_test(res)
+            if not res[0]: return (False, "nginx config test failed")
 
         # ================================
         # % pynx start
@@ -162,16 +760,24 @@ def main(args):
                 pc(f"Server already running ({summary_start})")
 
             elif status == 'inactive':
-                (ok, reason) = util.start_service('nginx')
+                t0 = time.monotonic()
+                _snapshot(cmd)
+                (ok, reason) = util.start_service(C_.NGINX_UNIT)
                 if not ok:
+                    _record(C_.NGINX_UNIT, cmd, t0, None, 0)
                     pc(f"nginx not started because {reason}")
+                    return (False, f"nginx not started because {reason}")
 
                 else:
+                    res = (ok, state, elapsed) = util.wait_service_state(C_.NGINX_UNIT, ('active',), t_start=t0)
                     (status, out, summary, data) = util.get_sytemd_nginx_status()
-                    if status == 'active':
-                        pc(f"done - {summary}")
+                    _record(C_.NGINX_UNIT, cmd, t0, res, 0, data)
+                    if ok:
+                        util.record_loaded_generation()
+                        pc(f"done in {elapsed:.3f}s - {summary}")
                     else:
-                        pc(f"nginx was not started - {summary}")
+                        pc(f"nginx was not started ({state} after {elapsed:.3f}s) - {summary}")
+                        return (False, f"nginx was not started ({state})")
 
 
         # ================================
@@ -183,17 +789,24 @@ def main(args):
                 pc(f"Server already inactive ({summary_start})")
 
             elif status == 'active':
-                (ok, reason) = util.stop_service('nginx')
+                t0 = time.monotonic()
+                workers = util.count_workers(data.get('Main PID'))
+                (ok, reason) = util.stop_service(C_.NGINX_UNIT)
 
                 if not ok:
+                    _record(C_.NGINX_UNIT, cmd, t0, None, workers)
                     pc(f"nginx not stopped because {reason}")
+                    return (False, f"nginx not stopped because {reason}")
 
                 else:
+                    res = (ok, state, elapsed) = util.wait_service_state(C_.NGINX_UNIT, ('inactive',), t_start=t0)
                     (status, out, summary, data) = util.get_sytemd_nginx_status()
-                    if status == 'inactive':
-                        pc(f"done - {summary}")
+                    _record(C_.NGINX_UNIT, cmd, t0, res, workers, data)
+                    if ok:
+                        pc(f"done in {elapsed:.3f}s - {summary}")
                     else:
-                        pc(f"nginx was not stopped - {summary}")
+                        pc(f"nginx was not stopped ({state} after {elapsed:.3f}s) - {summary}")
+                        return (False, f"nginx was not stopped ({state})")
 
 
         # ================================
@@ -204,19 +817,28 @@ def main(args):
             if status == 'inactive':
                 pc(f"Server is inactive ({summary_start})")
                 pc(f"Please use `pynx start`")
+                return (False, "nginx is inactive")
 
             elif status == 'active':
+                t0 = time.monotonic()
+                workers = util.count_workers(data.get('Main PID'))
+                _snapshot(cmd)
                 (ok, reason) = util.reload_nginx()
 
                 if not ok:
+                    _record(C_.NGINX_UNIT, cmd, t0, None, workers)
                     pc(f"nginx not reloaded because {reason}")
+                    return (False, f"nginx not reloaded because {reason}")
 
                 else:
+                    res = (ok, state, elapsed) = util.wait_service_state(C_.NGINX_UNIT, ('active',), t_start=t0)
                     (status, out, summary_after, data) = util.get_sytemd_nginx_status()
-                    if status == 'active':
-                        pc(f"done - {summary_after}")
+                    _record(C_.NGINX_UNIT, cmd, t0, res, workers, data)
+                    if ok:
+                        pc(f"done in {elapsed:.3f}s - {summary_after}")
                     else:
-                        pc(f"nginx was not relaoded - {summary_after}")
+                        pc(f"nginx was not relaoded ({state} after {elapsed:.3f}s) - {summary_after}")
+                        return (False, f"nginx was not reloaded ({state})")
 
 
         # ================================
@@ -227,37 +849,48 @@ def main(args):
             if status == 'inactive':
                 pc(f"Server is inactive ({summary_start})")
                 pc(f"Please use `pynx start`")
+                return (False, "nginx is inactive")
 
             elif status == 'active':
-                (ok, reason) = util.restart_service('nginx')
+                t0 = time.monotonic()
+                workers = util.count_workers(data.get('Main PID'))
+                _snapshot(cmd)
+                (ok, reason) = util.restart_service(C_.NGINX_UNIT)
 
                 if not ok:
+                    _record(C_.NGINX_UNIT, cmd, t0, None, workers)
                     pc(f"nginx not restarted because {reason}")
+                    return (False, f"nginx not restarted because {reason}")
 
                 else:
+                    res = (ok, state, elapsed) = util.wait_service_state(C_.NGINX_UNIT, ('active',), t_start=t0)
                     (status, out, summary_after, data) = util.get_sytemd_nginx_status()
-                    if status == 'active':
-                        pc(f"done - {summary_after}")
+                    _record(C_.NGINX_UNIT, cmd, t0, res, workers, data)
+                    if ok:
+                        util.record_loaded_generation()
+                        pc(f"done in {elapsed:.3f}s - {summary_after}")
                     else:
-                        pc(f"nginx was not restarted - {summary_after}")
+                        pc(f"nginx was not restarted ({state} after {elapsed:.3f}s) - {summary_after}")
+                        return (False, f"nginx was not restarted ({state})")
 
 
     elif bSite: # Site command
 
         def _site_table(site_info):
             table = util.build_table()
-            if site_info.status == util.BAD:
+            if site_info.status & util.BAD:
                 util.table_add_bad_row(table, site_info)
             else:
-                util.table_add_ok_row(table, site_info)
+                util.table_add_ok_row(table, site_info, util.LoadedGeneration(scan).site_note(site_info.name))
 
             return table.draw()
 
-        sites=util.Sites()
-        (ok, site_info) = util.find_site(site)
+        scan = util.get_scan()
+        sites = util.Sites(scan)
+        (ok, site_info) = util.find_site(site, scan)
         if not ok:
             pc(f"Site not found: {site}")
-            return
+            return (False, f"Site not found: {site}")
 
 
         # ================================
@@ -267,26 +900,79 @@ def main(args):
             site_cfg = site_info.site_cfg
             if site_cfg is None:
                 pc(f"Sorry, config for site '{site}' could not be read")
+                return (False, f"config for site {site} could not be read")
             else:
                 pc(f"Config for site {site}:")
                 for line in site_cfg.config_lines:
                     pc(f"  {line}")
-            return
+            return (True, None)
 
 
         if cmd in ('start', 'stop', 'enable', 'disable') and site_info.status == util.BAD:
             pc(f"command {cmd} cannot be run for site")
             for line in _site_table(site_info).split('\n'): pc(f"  {line}")
-            return
+            return (False, f"{cmd} cannot be run for bad site {site}")
             
 
+        # ================================
+        # % pynx <site> conns
+        # ================================
+        if cmd == 'conns':
+            conns.main_conns(site_info)
+            return (True, None)
+
+
+        # ================================
+        # % pynx <site> tail [--stats]
+        # ================================
+        if cmd == 'tail':
+            try:
+                tail.main_tail(site_info, bStats)
+            except (AssertionError, OSError) as ex:
+                pc(f"tail: {ex}")
+                return (False, f"tail: {ex}")
+            return (True, None)
+
+
+        # ================================
+        # % pynx <site> precompress [--parallel <n>]
+        # ================================
+        if cmd == 'precompress':
+            try:
+                precompress.main_precompress(site_info, parallel)
+            except (AssertionError, OSError) as ex:
+                pc(f"precompress: {ex}")
+                return (False, f"precompress: {ex}")
+            return (True, None)
+
+
+        # ================================
+        # % pynx <site> bench [-c <conns>] [-d <s>] [--path <uri>] [--listen <addr:port>] [--wsgi]
+        # ================================
+        if cmd == 'bench':
+            try:
+                bench.main_bench(site_info, bench_conns, bench_duration, bench_path, bench_listen, bBenchWsgi)
+            except (AssertionError, ValueError, OSError) as ex:
+                pc(f"bench: {ex}")
+                return (False, f"bench: {ex}")
+            return (True, None)
+
+
         # ================================
         # % pynx status <site>
         # ================================
         if cmd == 'status':
-            # Maybe more info can be displayed?
             for line in _site_table(site_info).split('\n'): pc(f"  {line}")
 
+            topology = util.Topology(util.SiteIndex(sites))
+            units = topology.units(site)
+            if len(units) > 0:
+                props = util.get_units_props(units, ['ActiveState', 'SubState', 'MainPID'])
+                for (sock, unit, via) in topology.get(site):
+                    d = props[unit]
+                    s_sock = '' if sock is None else f" - socket: {sock}"
+                    pc(f"  wsgi: {unit} - {d.get('ActiveState')} ({d.get('SubState')}) pid: {d.get('MainPID')}{s_sock} (via {via})")
+
 
         # ================================
         # % pynx start|enable <site>
@@ -299,21 +985,31 @@ def main(args):
                     pc(f"run `pynx reload` if site is not running")
             else:
                 assert site_info.status == util.AVAILABLE, f"Unexpected site status: {site_info.status}"
+                t0 = time.monotonic()
+                workers = util.count_workers(util.get_nginx_master_pid())
+                _snapshot(f"{cmd} {site}")
                 (ok, reason) = util.enable_site(site)
                 if not ok:
+                    _record(f"site:{site}", cmd, t0, None, workers)
                     pc(f"site {site} could not be {util.get_cmd_str(cmd, past=True)} because {reason}")
+                    return (False, f"site {site} could not be {util.get_cmd_str(cmd, past=True)} because {reason}")
                 else:
-                    (ok, site_info_after) = util.find_site(site)
+                    scan = util.get_scan() # state changed
+                    (ok, site_info_after) = util.find_site(site, scan)
                     assert ok, f"Site not found: {site} after {cmd}"
 
                     if cmd == 'start':
-                        (ok, reason) = util.reload_nginx()
+                        (ok, reason) = util.request_reload()
                         if not ok:
+                            _record(f"site:{site}", cmd, t0, None, workers)
                             pc(f"site {site} could not be {util.get_cmd_str(cmd, past=True)} because {reason}")
-                            return
-                            
+                            return (False, f"site {site} could not be {util.get_cmd_str(cmd, past=True)} because {reason}")
+
+                    history.record_after_reload(f"site:{site}", cmd, time.monotonic() - t0, workers, util.count_workers(util.get_nginx_master_pid()))
                     pc(f"site {site} {util.get_cmd_str(cmd, past=True)}")
                     for line in _site_table(site_info_after).split('\n'): pc(f"  {line}")
+                    if cmd in ('start', 'stop') and util.reload_deferred():
+                        pc(f"nginx reload deferred to the next `reload` or the end of the session")
 
 
         # ================================
@@ -328,21 +1024,31 @@ def main(args):
 
             else:
                 assert site_info.status == util.ENABLED, f"Unexpected site status: {site_info.status}"
+                t0 = time.monotonic()
+                workers = util.count_workers(util.get_nginx_master_pid())
+                _snapshot(f"{cmd} {site}")
                 (ok, reason) = util.disable_site(site)
                 if not ok:
+                    _record(f"site:{site}", cmd, t0, None, workers)
                     pc(f"site {site} could not be {util.get_cmd_str(cmd, past=True)} because {reason}")
+                    return (False, f"site {site} could not be {util.get_cmd_str(cmd, past=True)} because {reason}")
                 else:
-                    (ok, site_info_after) = util.find_site(site)
+                    scan = util.get_scan() # state changed
+                    (ok, site_info_after) = util.find_site(site, scan)
                     assert ok, f"Site not found: {site} after {cmd}"
 
                     if cmd == 'stop':
-                        (ok, reason) = util.reload_nginx()
+                        (ok, reason) = util.request_reload()
                         if not ok:
+                            _record(f"site:{site}", cmd, t0, None, workers)
                             pc(f"site {site} could not be {util.get_cmd_str(cmd, past=True)} because {reason}")
-                            return
+                            return (False, f"site {site} could not be {util.get_cmd_str(cmd, past=True)} because {reason}")
 
+                    history.record_after_reload(f"site:{site}", cmd, time.monotonic() - t0, workers, util.count_workers(util.get_nginx_master_pid()))
                     pc(f"site {site} {util.get_cmd_str(cmd, past=True)}")
                     for line in _site_table(site_info_after).split('\n'): pc(f"  {line}")
+                    if cmd in ('start', 'stop') and util.reload_deferred():
+                        pc(f"nginx reload deferred to the next `reload` or the end of the session")
 
 
         else:
@@ -351,7 +1057,19 @@ def main(args):
 
 
     elif bWsgi: # WSGI command
-        wsgi = site
+
+        # ================================
+        # % pynx wsgi:<site>,<site>...|* status|start|stop|restart [--parallel <n>] [--timeout <s>]
+        # ================================
+        if site == '*' or site.find(',') > -1:
+            if cmd == 'logs': print_cli(f"logs is only supported for a single wsgi unit")
+            try:
+                return _run_wsgi_units(_get_wsgi_units(site), cmd, parallel, timeout, bWarmup)
+            except AssertionError as ex:
+                print_cli(f"wsgi: {ex}")
+
+        # site name -> unit from wsgi socket mapping. Unmapped names are used as unit names
+        wsgi = util.Topology().resolve_unit(site)
         if cmd == 'status':
             # Eg, if there is a daemon with site name (eg gnunicorn), then detect and show information
             # Check to see if daemon exists by using `sudo systemctl list-unit-files <site>.service`
@@ -375,34 +1093,50 @@ def main(args):
                     pc(f"WSGI is already active ({wsgi} - {summary_start})")
 
                 else: # restart
+                    t0 = time.monotonic()
+                    workers = util.count_workers(data.get('Main PID'))
                     (ok, reason) = util.restart_service(wsgi)
 
                     if not ok:
+                        _record(wsgi, cmd, t0, None, workers)
                         pc(f"WSGI {wsgi} not restarted because {reason}")
+                        return (False, f"WSGI {wsgi} not restarted because {reason}")
 
                     else:
+                        res = (ok, state, elapsed) = util.wait_service_state(wsgi, ('active',), t_start=t0)
                         (status, out, summary_after, data) = util.get_sytemd_wsgi_status(wsgi)
-                        if status == 'active':
-                            pc(f"WSGI {util.get_cmd_str(cmd, past=True)} ({wsgi} - {summary_after})")
+                        _record(wsgi, cmd, t0, res, workers, data)
+                        if ok:
+                            note = _warmup(site, wsgi) if bWarmup else None
+                            pc(f"WSGI {util.get_cmd_str(cmd, past=True)} in {elapsed:.3f}s ({wsgi} - {summary_after}){'' if note is None else f' - {note}'}")
                         else:
-                            pc(f"WSGI was not restarted ({wsgi} - {summary_after})")
+                            pc(f"WSGI was not restarted ({state} after {elapsed:.3f}s) ({wsgi} - {summary_after})")
+                            return (False, f"WSGI {wsgi} was not restarted ({state})")
 
             else:
                 if cmd == 'restart':
                     pc(f"WSGI is inactive ({wsgi} - {summary_start})")
                     pc(f"Please use `pynx WSGI {wsgi} start`")
+                    return (False, f"WSGI {wsgi} is inactive")
 
                 else: # start
+                    t0 = time.monotonic()
                     (ok, reason) = util.start_service(wsgi)
                     if not ok:
+                        _record(wsgi, cmd, t0, None, 0)
                         pc(f"WSGI {wsgi} not started because {reason}")
+                        return (False, f"WSGI {wsgi} not started because {reason}")
 
                     else:
+                        res = (ok, state, elapsed) = util.wait_service_state(wsgi, ('active',), t_start=t0)
                         (status, out, summary_after, data) = util.get_sytemd_wsgi_status(wsgi)
-                        if status == 'active':
-                            pc(f"WSGI {util.get_cmd_str(cmd, past=True)} ({wsgi} - {summary_after})")
+                        _record(wsgi, cmd, t0, res, 0, data)
+                        if ok:
+                            note = _warmup(site, wsgi) if bWarmup else None
+                            pc(f"WSGI {util.get_cmd_str(cmd, past=True)} in {elapsed:.3f}s ({wsgi} - {summary_after}){'' if note is None else f' - {note}'}")
                         else:
-                            pc(f"WSGI {wsgi} was not started ({wsgi} - {summary_after})")
+                            pc(f"WSGI {wsgi} was not started ({state} after {elapsed:.3f}s) ({wsgi} - {summary_after})")
+                            return (False, f"WSGI {wsgi} was not started ({state})")
 
 
 
@@ -412,17 +1146,24 @@ def main(args):
         elif cmd == 'stop':
             (status, out, summary_start, data) = util.get_sytemd_wsgi_status(wsgi)
             if status == 'active':
+                t0 = time.monotonic()
+                workers = util.count_workers(data.get('Main PID'))
                 (ok, reason) = util.stop_service(wsgi)
 
                 if not ok:
+                    _record(wsgi, cmd, t0, None, workers)
                     pc(f"WSGI {wsgi} not stopped because {reason}")
+                    return (False, f"WSGI {wsgi} not stopped because {reason}")
 
                 else:
+                    res = (ok, state, elapsed) = util.wait_service_state(wsgi, ('inactive',), t_start=t0)
                     (status, out, summary_after, data) = util.get_sytemd_wsgi_status(wsgi)
-                    if status == 'inactive':
-                        pc(f"WSGI stopped ({wsgi} - {summary_after})")
+                    _record(wsgi, cmd, t0, res, workers, data)
+                    if ok:
+                        pc(f"WSGI stopped in {elapsed:.3f}s ({wsgi} - {summary_after})")
                     else:
-                        pc(f"WSGI was not stopped - ({wsgi} - {summary_after})")
+                        pc(f"WSGI was not stopped ({state} after {elapsed:.3f}s) - ({wsgi} - {summary_after})")
+                        return (False, f"WSGI {wsgi} was not stopped ({state})")
 
             elif status == 'inactive':
                 pc(f"WSGI already inactive ({wsgi} - {summary_start})")
@@ -432,15 +1173,43 @@ def main(args):
 
 
 
+        # ================================
+        # % pynx wsgi:<site> logs [--follow] [--summary]
+        # ================================
+        elif cmd == 'logs':
+            summary = util.JournalSummary() if bSummary else None
+            if not summary is None: pc(util.JournalSummary.header())
+            try:
+                for entry in util.iter_journal(wsgi, follow=bFollow):
+                    if summary is None:
+                        print(util.fmt_journal_entry(entry), flush=bFollow)
+                        continue
+
+                    minute = summary.add(entry)
+                    if bFollow: # stream completed minutes
+                        for m in summary.minutes:
+                            if m == minute: break
+                            pc(util.JournalSummary.fmt_row(m, summary.pop(m)))
+
+            except KeyboardInterrupt:
+                pass
+
+            if not summary is None:
+                for m in summary.minutes:
+                    pc(util.JournalSummary.fmt_row(m, summary.pop(m)))
+
+
         else:
             print_cli(f"Invalid wsgi command: {cmd}")
 
 
     # main end
+    return (True, None)
 
 
-# Entry point for tool.poetry.scripts
-# WIP
+# Entry point for tool.poetry.scripts. Exit status: 0 ok, 1 failed (eg. nginx -t, reload), 2 usage error
+# `pynx fleet` agents report a command as ok from this status
 def cli(args=None):
     if not args: args = sys.argv[1:]  
-    main(args)
+    (ok, reason) = main(args)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,360 @@
+#########################################
+# .: snapshot.py :.
+# Content addressed snapshots of sites-available / sites-enabled and `pynx rollback`
+#
+# % pynx rollback --list
+# % pynx rollback [id]
+#
+# A snapshot is taken before every state changing pynx command (site enable / disable /
+# start / stop, nginx start / reload / restart and rollback itself). It records the
+# symlinks of sites-enabled (name -> link target) and the content of the files in
+# sites-available. Files are stored once per sha256 (zlib compressed) under
+# C_.DIR_SNAPSHOTS/objects, so unchanged files cost nothing and hundreds of snapshots
+# cost little disk. The manifest of a snapshot is an object too: the snapshot id is the
+# start of its hash and a command that did not change anything adds no snapshot.
+# Hashes of unchanged files are reused by stat key (device, inode, mtime, ctime, size),
+# so taking a snapshot only stats the site files.
+#
+# Rollback writes back the site files that differ (temp file + rename), builds the
+# snapshot's sites-enabled next to the live one and swaps the two directories with
+# renameat2(RENAME_EXCHANGE) so nginx never sees a half built directory. nginx -t then
+# validates the result: on failure the swap and files are reverted, otherwise nginx is
+# reloaded once. Without `id` the newest snapshot that differs from the current state is used.
+# Concurrent pynx commands are serialized on an flock of C_.DIR_SNAPSHOTS/lock, so a prune
+# never removes objects another command is about to reference and no log entry is lost.
+#########################################
+import os
+import json
+import time
+import zlib
+import fcntl
+import errno
+import shutil
+import contextlib
+import ctypes
+import ctypes.util
+import hashlib
+from collections import OrderedDict
+from . import util
+from . import history
+from .util import pc, C_, assertNotBlank
+
+VERSION = 1
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+_lock_depth = 0
+
+# Exclusive lock on the store. Reentrant within the process: rollback holds it around take()
+@contextlib.contextmanager
+def _locked():
+    global _lock_depth
+    if _lock_depth > 0:
+        _lock_depth += 1
+        try:
+            yield
+        finally:
+            _lock_depth -= 1
+        return
+    os.makedirs(_store_path(), exist_ok=True)
+    fd = os.open(_store_path('lock'), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        _lock_depth = 1
+        try:
+            yield
+        finally:
+            _lock_depth = 0
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _store_path(*parts) -> str:
+    return os.path.join(util.get_state_path(C_.DIR_SNAPSHOTS), *parts)
+
+
+def _object_path(h:str) -> str:
+    return _store_path('objects', h[:2], h[2:])
+
+
+def _put_object(h:str, data:bytes):
+    path = _object_path(h)
+    if os.path.exists(path): return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as fp:
+        fp.write(zlib.compress(data))
+    os.replace(tmp, path)
+
+
+def _get_object(h:str) -> bytes:
+    with open(_object_path(h), 'rb') as fp:
+        data = zlib.decompress(fp.read())
+    assert hashlib.sha256(data).hexdigest() == h, f"Snapshot object {h} is corrupt"
+    return data
+
+
+def _read_index() -> dict:
+    index = util.read_json_file(_store_path('index.json'), {})
+    if index.get('version') != VERSION: index = {'version': VERSION, 'stat': {}, 'log': []}
+    return index
+
+
+# Current state: {'enabled': {name: link target}, 'files': {name: [sha256, mode]}}.
+# New file contents are added to the store. stat_cache (name -> [stat key..., hash]) is updated
+def _current(stat_cache:dict) -> dict:
+    enabled = OrderedDict()
+    for entry in util.SiteScan._scandir(C_.PATH_SITES_E):
+        if entry.is_symlink(): enabled[entry.name] = os.readlink(entry.path)
+    files = OrderedDict()
+    seen = set()
+    for entry in util.SiteScan._scandir(C_.PATH_SITES_A):
+        if not entry.is_file(follow_symlinks=False): continue # symlinked site files are not snapshotted
+        st = entry.stat(follow_symlinks=False)
+        key = [st.st_dev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size]
+        hit = stat_cache.get(entry.name)
+        if not hit is None and hit[:-1] == key:
+            h = hit[-1]
+        else:
+            with open(entry.path, 'rb') as fp:
+                data = fp.read()
+            h = hashlib.sha256(data).hexdigest()
+            _put_object(h, data)
+            stat_cache[entry.name] = key + [h]
+        files[entry.name] = [h, st.st_mode & 0o7777]
+        seen.add(entry.name)
+    for name in [n for n in stat_cache if not n in seen]: del stat_cache[name]
+    return {'enabled': enabled, 'files': files}
+
+
+def _manifest_hash(state:dict) -> tuple:
+    data = json.dumps(state, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return (hashlib.sha256(data).hexdigest(), data)
+
+
+def _get_manifest(h:str) -> dict:
+    return json.loads(_get_object(h).decode('utf-8'))
+
+
+# Drops the oldest snapshots beyond C_.SNAPSHOT_KEEP and the objects no snapshot uses.
+# Runs once per C_.SNAPSHOT_PRUNE_BATCH snapshots so the mark and sweep stays rare
+def _prune(index:dict):
+    if len(index['log']) < C_.SNAPSHOT_KEEP + C_.SNAPSHOT_PRUNE_BATCH: return
+    index['log'] = index['log'][-C_.SNAPSHOT_KEEP:]
+    live = set([h for h, *_ in index['log']])
+    for h, *_ in index['log']:
+        live.update([fh for (fh, mode) in _get_manifest(h)['files'].values()])
+    live.update([v[-1] for v in index['stat'].values()])
+    with os.scandir(_store_path('objects')) as dirs:
+        for d in dirs:
+            with os.scandir(d.path) as it:
+                for entry in it:
+                    if not d.name + entry.name in live: os.remove(entry.path)
+
+
+# Snapshots the current state before `cmd`. Returns (hash, added). added is False when the
+# state is the same as in the newest snapshot
+def take(cmd:str) -> tuple:
+    assertNotBlank('cmd', cmd)
+    with _locked():
+        index = _read_index()
+        state = _current(index['stat'])
+        (h, data) = _manifest_hash(state)
+        added = len(index['log']) == 0 or index['log'][-1][0] != h
+        if added:
+            _put_object(h, data)
+            index['log'].append([h, time.time(), cmd])
+            _prune(index)
+        util.write_json_file(_store_path('index.json'), index)
+    return (h, added)
+
+
+# [(hash, ts, cmd)] oldest first
+def get_log() -> list:
+    return [tuple(e) for e in _read_index()['log']]
+
+
+# Full hash of a snapshot id (unique prefix)
+def resolve(snap_id:str) -> str:
+    assertNotBlank('id', snap_id)
+    found = set([h for (h, ts, cmd) in get_log() if h.find(snap_id.lower()) == 0])
+    assert len(found) > 0, f"Snapshot not found: {snap_id}"
+    assert len(found) == 1, f"Snapshot id {snap_id} is ambiguous. Use more characters"
+    return found.pop()
+
+
+# [(+|-|~, what)] to go from state a to state b
+def diff(a:dict, b:dict) -> list:
+    res = []
+    for name in sorted(set(a['enabled']) | set(b['enabled'])):
+        (ta, tb) = (a['enabled'].get(name), b['enabled'].get(name))
+        if ta is None: res.append(('+', f"enable {name}"))
+        elif tb is None: res.append(('-', f"disable {name}"))
+        elif ta != tb: res.append(('~', f"relink {name} -> {tb}"))
+    for name in sorted(set(a['files']) | set(b['files'])):
+        (fa, fb) = (a['files'].get(name), b['files'].get(name))
+        if fb is None: continue # files added after the snapshot are kept
+        if fa is None: res.append(('+', f"restore sites-available/{name}"))
+        elif fa != fb: res.append(('~', f"restore sites-available/{name}"))
+    return res
+
+
+def _write_files(files:dict, current:dict):
+    for name, (h, mode) in files.items():
+        if current.get(name) == [h, mode]: continue
+        path = os.path.join(C_.PATH_SITES_A, name)
+        if os.path.islink(path):
+            pc(f"skipped {path}: is a symlink")
+            continue
+        tmp = os.path.join(C_.PATH_SITES_A, f".{name}.pynx-{os.getpid()}")
+        with open(tmp, 'wb') as fp:
+            fp.write(_get_object(h))
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+
+
+# Builds sites-enabled of a snapshot as a sibling directory of the live one. Entries
+# that are not symlinks are not part of snapshots and are carried over
+def _build_enabled(enabled:dict) -> str:
+    live = os.path.normpath(C_.PATH_SITES_E)
+    path = os.path.join(os.path.dirname(live), f".{os.path.basename(live)}.pynx-{os.getpid()}")
+    if os.path.lexists(path): shutil.rmtree(path)
+    os.mkdir(path)
+    shutil.copymode(live, path)
+    for name, target in enabled.items():
+        os.symlink(target, os.path.join(path, name))
+    for entry in util.SiteScan._scandir(live):
+        if entry.is_file(follow_symlinks=False): shutil.copy2(entry.path, os.path.join(path, entry.name))
+    return path
+
+
+_renameat2 = None
+
+# Swaps two directories atomically with renameat2(RENAME_EXCHANGE). Falls back to three
+# renames (live path briefly missing) on kernels / filesystems / libcs without it
+def exchange(a:str, b:str):
+    global _renameat2
+    if _renameat2 is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _renameat2 = getattr(libc, 'renameat2', False)
+        if _renameat2:
+            _renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    if _renameat2:
+        if _renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0: return
+        e = ctypes.get_errno()
+        if not e in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            raise OSError(e, f"renameat2 {a} <-> {b}: {os.strerror(e)}")
+    side = f"{b}.pynx-swap"
+    os.rename(b, side)
+    os.rename(a, b)
+    os.rename(side, a)
+
+
+# Restores snapshot h. Returns (ok, reason)
+def rollback(h:str) -> tuple:
+    with _locked():
+        return _rollback(h)
+
+
+def _rollback(h:str) -> tuple:
+    target = _get_manifest(h)
+    (before_h, added) = take('rollback')
+    before = _get_manifest(before_h)
+    changes = diff(before, target)
+    if len(changes) == 0: return (True, 'nothing to change')
+
+    for (fh, mode) in target['files'].values():
+        assert os.path.exists(_object_path(fh)), f"Snapshot object {fh} is missing"
+
+    if not C_.SESSION is None: C_.SESSION.scans.pop(C_.INSTANCE, None)
+    _write_files(target['files'], before['files'])
+    staged = _build_enabled(target['enabled']) if target['enabled'] != before['enabled'] else None
+    if not staged is None: exchange(staged, C_.PATH_SITES_E)
+
+    nginx = util.Nginx()
+    if not nginx.ok:
+        if not staged is None: exchange(staged, C_.PATH_SITES_E)
+        _write_files(before['files'], target['files'])
+        for name in [n for n in target['files'] if not n in before['files']]: # restored files that did not exist
+            path = os.path.join(C_.PATH_SITES_A, name)
+            if not os.path.islink(path): os.remove(path)
+        if not staged is None: shutil.rmtree(staged)
+        rows = nginx.badrows if nginx.reason is None else nginx.badrows + [nginx.reason]
+        return (False, 'nginx -t failed, rollback reverted:\n' + '\n'.join([f"  {r}" for r in rows]))
+
+    if not staged is None: shutil.rmtree(staged)
+    for (c, what) in changes: pc(f"  {c} {what}")
+    return (True, None)
+
+
+def _fmt_ts(ts:float) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+
+
+def print_list():
+    log = get_log()
+    if len(log) == 0:
+        pc(f"No snapshots yet. They are taken before state changing pynx commands")
+        return
+    current = _current(_read_index()['stat'])
+    table = util.build_grid(['Id', 'Taken', 'Before', 'Enabled', 'Files', 'Changes to restore']
+                           ,['l' , 'l'    , 'l'     , 'r'      , 'r'    , 'l'])
+    for (h, ts, cmd) in reversed(log):
+        m = _get_manifest(h)
+        changes = diff(current, m)
+        table.add_row([h[:C_.SNAPSHOT_ID_LEN], _fmt_ts(ts), cmd, str(len(m['enabled'])), str(len(m['files']))
+                      ,'(current)' if len(changes) == 0 else '\n'.join([f"{c} {what}" for (c, what) in changes])])
+    pc(f"\n{table.draw()}\n")
+
+
+# hash of the snapshot to restore for `pynx rollback` without id: newest that differs from now
+def get_previous() -> str:
+    current = _current(_read_index()['stat'])
+    for (h, ts, cmd) in reversed(get_log()):
+        if len(diff(current, _get_manifest(h))) > 0: return h
+    return None
+
+
+# Returns (ok, reason). ok is False if the rollback was reverted or nginx was not reloaded
+def main_rollback(args:list) -> tuple:
+    bList = util.pop_flag(args, '--list')
+    assert len(args) <= 1, f"Unexpected args for rollback: {args}"
+    if bList:
+        print_list()
+        return (True, None)
+    h = resolve(args[0]) if len(args) == 1 else get_previous()
+    assert not h is None, "No snapshot differs from the current state"
+    snap_id = h[:C_.SNAPSHOT_ID_LEN]
+
+    t0 = time.monotonic()
+    workers = util.count_workers(util.get_nginx_master_pid())
+    pc(f"rolling back to snapshot {snap_id}:")
+    (ok, reason) = rollback(h)
+    if not ok:
+        history.record(C_.NGINX_UNIT, 'rollback', time.monotonic() - t0, history.FAILED, workers, workers)
+        pc(f"rollback to {snap_id} failed: {reason}")
+        return (False, f"rollback to {snap_id} failed: {reason}")
+    if not reason is None:
+        pc(f"rollback to {snap_id}: {reason}")
+        return (True, None)
+
+    (status, out, summary, data) = util.get_sytemd_nginx_status()
+    if status != 'active':
+        pc(f"rolled back to {snap_id} in {time.monotonic() - t0:.3f}s. nginx is {status}, not reloaded")
+        return (True, None)
+    (ok, reason) = util.request_reload()
+    workers_after = util.count_workers(util.get_nginx_master_pid())
+    if ok:
+        history.record_after_reload(C_.NGINX_UNIT, 'rollback', time.monotonic() - t0, workers, workers_after)
+    else:
+        history.record(C_.NGINX_UNIT, 'rollback', time.monotonic() - t0, history.FAILED, workers, workers_after)
+    if not ok:
+        pc(f"rolled back to {snap_id} but nginx not reloaded because {reason}")
+        return (False, f"rolled back to {snap_id} but nginx not reloaded because {reason}")
+    elif util.reload_deferred():
+        pc(f"rolled back to {snap_id}. nginx reload deferred to the next `reload` or the end of the session")
+    else:
+        pc(f"rolled back to {snap_id} and reloaded nginx in {time.monotonic() - t0:.3f}s")
+    return (True, None)
@@ -0,0 +1,405 @@
+#########################################
+# .: tail.py :.
+# Follow the access log of a site, optionally with rolling request stats
+#
+# % pynx <site> tail [--stats]
+#
+# The log path and its log_format come from the site's access_log (or the one of
+# nginx.conf). The file is followed with inotify (ctypes, no polling): the file watch
+# wakes on writes, the directory watch on logrotate creating or moving in a new file.
+# On inode change the old file is drained and kept open for C_.TAIL_ROTATE_GRACE
+# seconds (nginx writes to it until it reopens its logs), then the new file is read from
+# its start. A shrinking file (copytruncate) is read again from offset 0.
+#
+# --stats keeps one slot per second for the last max(C_.TAIL_WINDOWS) seconds with
+# request count, status class counts and a QuantileSketch of $request_time. Windows are
+# merged from the slots, so memory does not depend on the request rate.
+#########################################
+import os
+import re
+import sys
+import math
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+from . import util
+from .util import pc, C_, assertNotBlank
+from gixy.parser.nginx_parser import NginxParser
+
+COMBINED = '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent"'
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000
+_EVENT = struct.Struct('iIII') # wd, mask, cookie, len (name follows)
+
+
+
+# ==============================================
+# Log location and format
+# ==============================================
+
+# ({format name: format}, [http level access_log args]) from nginx.conf. Includes are not followed
+def get_log_formats() -> tuple:
+    formats = {'combined': COMBINED}
+    access_logs = []
+    try:
+        with open(C_.PATH_NGINX_CONF) as fp:
+            tree = NginxParser(cwd='', allow_includes=False).parse(fp.read())
+    except Exception:
+        return (formats, access_logs)
+
+    def _walk(node, depth):
+        for child in node.children:
+            if child.name == 'log_format' and len(child.args) > 1:
+                # the parser strips the spaces quoted parts end with. compile_format takes any whitespace
+                formats[child.args[0]] = ' '.join([a for a in child.args[1:] if a.find('escape=') != 0])
+            elif child.name == 'access_log' and depth == 1:
+                access_logs.append(list(child.args))
+            if child.is_block and child.name in ('http',): _walk(child, depth + 1)
+    _walk(tree, 0)
+    return (formats, access_logs)
+
+
+# First access_log that is a file: (path, format name). None if logging is off
+def _pick_log(access_logs:list) -> tuple:
+    for args in access_logs:
+        if args[0] == 'off': return None
+        if args[0].find('syslog:') == 0 or args[0].find('$') > -1: continue
+        fmt = args[1] if len(args) > 1 and args[1].find('=') == -1 else 'combined'
+        path = args[0] if os.path.isabs(args[0]) else os.path.join(os.path.dirname(C_.PATH_NGINX_CONF), args[0])
+        return (path, fmt)
+    return ()
+
+
+# (path, format name, format) of the access log of a site
+def resolve_log(site_cfg) -> tuple:
+    assert not site_cfg is None and site_cfg.parse_ok, "Site config could not be parsed"
+    (formats, http_logs) = get_log_formats()
+    for access_logs in (site_cfg.access_logs or [], http_logs):
+        res = _pick_log(access_logs)
+        assert not res is None, f"access_log is off for {site_cfg.name}"
+        if len(res) > 0: break
+    else:
+        res = (C_.DEF_ACCESS_LOG, 'combined')
+    (path, name) = res
+    assert name in formats, f"log_format `{name}` of {path} not found in {C_.PATH_NGINX_CONF}"
+    return (path, name, formats[name])
+
+
+_RE_VAR = re.compile(r'\$(\w+)|\$\{(\w+)\}')
+
+# Regex for lines of a log_format with groups status and request_time (when in the format).
+# Whitespace in the format matches any (or no) whitespace
+def compile_format(fmt:str):
+    assertNotBlank('fmt', fmt)
+    parts = []
+    pos = 0
+    seen = set()
+    for m in _RE_VAR.finditer(fmt):
+        parts.append(_literal(fmt[pos:m.start()]))
+        var = m.group(1) or m.group(2)
+        if var == 'status' and not var in seen:
+            parts.append(r'(?P<status>\d{3})')
+        elif var == 'request_time' and not var in seen:
+            parts.append(r'(?P<request_time>\d+(?:\.\d+)?|-)')
+        else:
+            parts.append('.*?')
+        seen.add(var)
+        pos = m.end()
+    parts.append(_literal(fmt[pos:]))
+    return re.compile('^' + ''.join(parts) + '$')
+
+
+def _literal(s:str) -> str:
+    return r'\s*'.join([re.escape(p) for p in re.split(r'\s+', s)])
+
+
+
+# ==============================================
+# Following
+# ==============================================
+
+class Inotify():
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._init = libc.inotify_init1 # AttributeError where there is no inotify
+        self._add = libc.inotify_add_watch
+        self._rm = libc.inotify_rm_watch
+        self._fd = self._init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+
+    def add(self, path:str, mask:int) -> int:
+        wd = self._add(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm(self, wd:int):
+        self._rm(self._fd, wd)
+
+    # [(wd, mask, name)] of events within timeout seconds
+    def read(self, timeout:float) -> list:
+        if len(self._poll.poll(max(0, int(timeout * 1000)))) == 0: return []
+        try:
+            buf = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        off = 0
+        while off < len(buf):
+            (wd, mask, cookie, size) = _EVENT.unpack_from(buf, off)
+            name = buf[off + _EVENT.size:off + _EVENT.size + size].rstrip(b'\0')
+            events.append((wd, mask, os.fsdecode(name)))
+            off += _EVENT.size + size
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _File():
+    def __init__(self, path:str, from_end:bool):
+        self.fp = open(path, 'rb')
+        st = os.fstat(self.fp.fileno())
+        self.ino = (st.st_dev, st.st_ino)
+        if from_end: self.fp.seek(0, os.SEEK_END)
+        self.buf = b''
+        self.wd = None
+        self.retired = None
+
+
+# Yields new lines of a log file across rotations. Uses Inotify when available, else
+# checks the file every C_.TAIL_POLL seconds
+class LogFollower():
+    def __init__(self, path:str, from_end:bool=True):
+        assertNotBlank('path', path)
+        self._path = path
+        self._name = os.path.basename(path)
+        self._cur = None
+        self._old = []
+        try:
+            self._inotify = Inotify()
+        except (OSError, AttributeError):
+            self._inotify = None
+        if not self._inotify is None:
+            self._inotify.add(os.path.dirname(path) or '.', IN_CREATE | IN_MOVED_TO)
+        if os.path.exists(path): self._open(from_end)
+
+    @property
+    def inotify(self) -> bool:
+        return not self._inotify is None
+
+    def _open(self, from_end:bool):
+        f = _File(self._path, from_end)
+        if not self._inotify is None:
+            f.wd = self._inotify.add(self._path, IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF)
+        self._cur = f
+
+    def _lines(self, f:_File):
+        while True:
+            chunk = f.fp.read(C_.TAIL_READ_SIZE)
+            if not chunk: return
+            lines = (f.buf + chunk).split(b'\n')
+            f.buf = lines.pop()
+            if len(f.buf) > C_.TAIL_READ_SIZE: # no newline in sight. Do not buffer forever
+                lines.append(f.buf)
+                f.buf = b''
+            yield from lines
+
+    # Switches to a new file at path (rotation) or rereads a truncated file
+    def _check(self):
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return # rotated away, new file not created yet
+        if self._cur is None:
+            self._open(False)
+        elif (st.st_dev, st.st_ino) != self._cur.ino:
+            self._cur.retired = time.monotonic()
+            self._old.append(self._cur)
+            self._open(False)
+        elif st.st_size < self._cur.fp.tell():
+            self._cur.fp.seek(0)
+            self._cur.buf = b''
+
+    def _retire(self, f:_File):
+        if not self._inotify is None and not f.wd is None: self._inotify.rm(f.wd)
+        f.fp.close()
+
+    # Waits up to timeout seconds for changes and yields new lines (bytes, without newline)
+    def poll(self, timeout:float):
+        if self._inotify is None:
+            time.sleep(min(timeout, C_.TAIL_POLL))
+            check = True
+        else:
+            events = self._inotify.read(timeout)
+            check = any([mask & ~IN_MODIFY for (wd, mask, name) in events]) \
+                 or (len(events) > 0 and self._cur is None)
+
+        for f in self._old: yield from self._lines(f)
+        if not self._cur is None: yield from self._lines(self._cur)
+        if check or (not self._cur is None and os.fstat(self._cur.fp.fileno()).st_size < self._cur.fp.tell()):
+            self._check()
+            if not self._cur is None: yield from self._lines(self._cur)
+
+        now = time.monotonic()
+        for f in [f for f in self._old if now - f.retired > C_.TAIL_ROTATE_GRACE]:
+            yield from self._lines(f)
+            self._retire(f)
+            self._old.remove(f)
+
+    def close(self):
+        for f in self._old + ([] if self._cur is None else [self._cur]): self._retire(f)
+        if not self._inotify is None: self._inotify.close()
+
+
+
+# ==============================================
+# Stats
+# ==============================================
+
+# Streaming quantiles with relative error `accuracy` (log bucketed histogram like DDSketch).
+# Values map to bucket ceil(log_gamma(v)) so the number of buckets only depends on the
+# range of values (1ms to 1h at 1%: ~750), not on how many are added. Mergeable
+class QuantileSketch():
+    MIN_VALUE = 1e-6
+
+    def __init__(self, accuracy:float=None):
+        accuracy = C_.TAIL_SKETCH_ACCURACY if accuracy is None else accuracy
+        assert 0 < accuracy < 1, f"accuracy must be between 0 and 1. Got: {accuracy}"
+        self._gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._bins = {}
+        self._zero = 0
+        self.count = 0
+
+    def add(self, v:float):
+        self.count += 1
+        if v < self.MIN_VALUE:
+            self._zero += 1
+        else:
+            i = math.ceil(math.log(v) / self._log_gamma)
+            self._bins[i] = self._bins.get(i, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self._zero += other._zero
+        for i, n in other._bins.items(): self._bins[i] = self._bins.get(i, 0) + n
+
+    # Value at quantile q (0..1). None when empty
+    def quantile(self, q:float) -> float:
+        if self.count == 0: return None
+        rank = q * (self.count - 1)
+        seen = self._zero
+        if rank < seen: return 0.0
+        for i in sorted(self._bins.keys()):
+            seen += self._bins[i]
+            if rank < seen: return 2 * self._gamma ** i / (self._gamma + 1)
+        return 2 * self._gamma ** max(self._bins.keys()) / (self._gamma + 1)
+
+
+# Per second slots of count, status classes (index 1-5) and $request_time sketch
+class RollingStats():
+    def __init__(self, windows:tuple=None):
+        self.windows = C_.TAIL_WINDOWS if windows is None else windows
+        self._span = max(self.windows)
+        self._slots = [None] * self._span
+        self._t_start = time.time()
+        self.total = 0
+        self.unparsed = 0
+
+    def _slot(self, sec:int) -> list:
+        slot = self._slots[sec % self._span]
+        if slot is None or slot[0] != sec:
+            slot = self._slots[sec % self._span] = [sec, 0, [0] * 6, QuantileSketch()]
+        return slot
+
+    def add(self, status:int, request_time:float, now:float=None):
+        slot = self._slot(int(time.time() if now is None else now))
+        slot[1] += 1
+        slot[2][min(status // 100, 5)] += 1
+        if not request_time is None: slot[3].add(request_time)
+        self.total += 1
+
+    # (req/s, count, [pct per status class 1-5], sketch) for the last w seconds
+    def window(self, w:int, now:float=None) -> tuple:
+        now = time.time() if now is None else now
+        sec = int(now)
+        count = 0
+        classes = [0] * 6
+        sketch = QuantileSketch()
+        for slot in self._slots:
+            if slot is None or slot[0] <= sec - w or slot[0] > sec: continue
+            count += slot[1]
+            for i in range(6): classes[i] += slot[2][i]
+            sketch.merge(slot[3])
+        span = max(1.0, min(w, now - self._t_start))
+        pct = [100.0 * n / count if count > 0 else 0.0 for n in classes]
+        return (count / span, count, pct, sketch)
+
+
+def _fmt_ms(v) -> str:
+    return '-' if v is None else f"{v * 1000:.0f}ms" if v >= 0.01 else f"{v * 1000:.1f}ms"
+
+
+def render(stats:RollingStats, has_time:bool) -> str:
+    table = util.build_grid(['Window', 'req/s', '2xx', '3xx', '4xx', '5xx', 'p50', 'p90', 'p99']
+                           ,['r'     , 'r'    , 'r'  , 'r'  , 'r'  , 'r'  , 'r'  , 'r'  , 'r'])
+    now = time.time()
+    for w in stats.windows:
+        (rate, count, pct, sketch) = stats.window(w, now)
+        q = [sketch.quantile(p) for p in (0.5, 0.9, 0.99)] if has_time else [None] * 3
+        table.add_row([f"{w}s", f"{rate:.1f}"] + [f"{pct[i]:.1f}%" for i in (2, 3, 4, 5)] + [_fmt_ms(v) for v in q])
+    return table.draw()
+
+
+
+def main_tail(site_info, bStats:bool=False):
+    (path, fmt_name, fmt) = resolve_log(site_info.site_cfg)
+    assert os.path.isdir(os.path.dirname(path)), f"Directory of access log {path} not found"
+    regex = compile_format(fmt)
+    has_time = '(?P<request_time>' in regex.pattern
+    assert bStats is False or '(?P<status>' in regex.pattern, f"log_format `{fmt_name}` has no $status"
+    follower = LogFollower(path)
+    tty = sys.stdout.isatty()
+    pc(f"following {path} (log_format {fmt_name}{'' if follower.inotify else ', no inotify: polling'}). ctrl-c to stop")
+    if bStats and not has_time: pc(f"log_format `{fmt_name}` has no $request_time: no latency percentiles")
+
+    stats = RollingStats()
+    t_next = time.monotonic() + 1
+    try:
+        while True:
+            for line in follower.poll(max(0, t_next - time.monotonic()) if bStats else 1.0):
+                if not bStats:
+                    print(line.decode('utf-8', errors='replace'))
+                    continue
+                m = regex.match(line.decode('utf-8', errors='replace'))
+                if m is None:
+                    stats.unparsed += 1
+                    continue
+                rt = m.group('request_time') if has_time else None
+                stats.add(int(m.group('status')), None if rt is None or rt == '-' else float(rt))
+            sys.stdout.flush()
+
+            if bStats and time.monotonic() >= t_next:
+                t_next = max(t_next + 1, time.monotonic())
+                out = render(stats, has_time)
+                note = f" ({stats.unparsed} unparsed lines)" if stats.unparsed > 0 else ''
+                if tty: sys.stdout.write('\x1b[H\x1b[2J') # redraw in place
+                print(f"{site_info.name} - {path} - {time.strftime('%H:%M:%S')} - {stats.total} requests{note}\n{out}\n", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        follower.close()
@@ -0,0 +1,355 @@
+#########################################
+# .: tune.py :.
+# nginx worker capacity advisor: configured worker limits against measured load
+#
+# % pynx tune [--duration <s>]
+#
+# Directives come from the effective config (`nginx -T`, includes resolved):
+# worker_processes, worker_cpu_affinity, worker_connections, worker_rlimit_nofile,
+# upstream blocks with their keepalive and the proxy_pass targets of all locations.
+# They are compared with what the running workers show in /proc:
+#   . CPUs online and the CPU affinity of master and workers
+#   . sockets per worker (connections count against worker_connections) sampled for
+#     `--duration` seconds. The peak seen by pynx tune since the master started is kept in C_.FILE_TUNE
+#   . open file limits (`Max open files` of /proc/<pid>/limits) and open fds of workers
+#   . established and TIME_WAIT connections to each upstream server (/proc/net/tcp).
+#     TIME_WAIT sockets last 60s on Linux, so count / 60 is the rate of new connections
+# Each finding is printed with the numbers it is based on.
+#########################################
+import os
+import time
+import socket
+from collections import OrderedDict
+from . import util
+from . import conns
+from .util import pc, C_
+
+OK = 'ok'
+INFO = 'info'
+WARN = 'WARN'
+SATURATED = 'SATURATED'
+TIME_WAIT_SECS = 60 # TCP_TIMEWAIT_LEN
+
+
+class Config():
+    def __init__(self):
+        self.worker_processes = None # 'auto' or str(n)
+        self.worker_cpu_affinity = None # [args]
+        self.worker_connections = 512 # nginx default
+        self.worker_rlimit_nofile = None
+        self.upstreams = OrderedDict() # name -> {'servers': [(host, port) | ('unix', path)], 'keepalive': n}
+        self.proxies = [] # (target, http_version, connection header) of each proxy_pass
+
+
+# Worker settings of the effective config
+def get_config() -> Config:
+    tree = util.get_nginx_dump()
+    cfg = Config()
+
+    def _walk(node, ctx):
+        for child in util.dump_children(node):
+            if child.name == 'worker_processes': cfg.worker_processes = child.args[0]
+            elif child.name == 'worker_cpu_affinity': cfg.worker_cpu_affinity = list(child.args)
+            elif child.name == 'worker_rlimit_nofile': cfg.worker_rlimit_nofile = int(child.args[0])
+            elif child.name == 'worker_connections': cfg.worker_connections = int(child.args[0])
+            elif child.name == 'upstream' and child.is_block:
+                up = cfg.upstreams.setdefault(child.args[0], {'servers': [], 'keepalive': None})
+                for d in util.dump_children(child):
+                    if d.name == 'server': up['servers'].append(_parse_server(d.args[0]))
+                    elif d.name == 'keepalive': up['keepalive'] = int(d.args[0])
+            elif child.is_block:
+                sub = dict(ctx)
+                for d in util.dump_children(child):
+                    if d.name == 'proxy_http_version': sub['version'] = d.args[0]
+                    elif d.name == 'proxy_set_header' and len(d.args) > 1 and d.args[0].lower() == 'connection':
+                        sub['connection'] = d.args[1]
+                _walk(child, sub)
+            elif child.name == 'proxy_pass':
+                cfg.proxies.append((child.args[0], ctx.get('version', '1.0'), ctx.get('connection', 'close')))
+    _walk(tree, {})
+    return cfg
+
+
+# `host[:port]` or `unix:/path` of an upstream server / proxy_pass -> (host, port) or ('unix', path).
+# Upstream servers default to port 80 (also behind https://), direct proxy_pass hosts to the scheme's
+def _parse_server(addr:str, default_port:int=80) -> tuple:
+    if addr.find('unix:') == 0: return ('unix', addr[5:].split(':')[0])
+    if addr.find('[') == 0: # [::1]:8000
+        (host, rest) = addr[1:].split(']', 1)
+        return (host, int(rest[1:]) if rest.find(':') == 0 else default_port)
+    (host, sep, port) = addr.partition(':')
+    return (host, int(port) if sep and port.isdigit() else default_port)
+
+
+# proxy_pass target -> upstream name or (host, port) / ('unix', path)
+def _proxy_target(target:str, upstreams:OrderedDict):
+    if target.find('$') > -1: return None
+    default_port = 80
+    for (scheme, port) in (('http://', 80), ('https://', 443)):
+        if target.find(scheme) == 0:
+            (target, default_port) = (target[len(scheme):], port)
+            break
+    if target.find('unix:') == 0: return _parse_server(target)
+    host = target.split('/', 1)[0]
+    return host if host in upstreams else _parse_server(host, default_port)
+
+
+def _resolve(host:str, port:int) -> list:
+    try:
+        return sorted(set([ai[4][0] for ai in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)]))
+    except OSError:
+        return []
+
+
+# ==============================================
+# Measurements
+# ==============================================
+
+def get_workers(master:int) -> list:
+    res = []
+    for pid in util.get_proc_children(master):
+        try:
+            with open(f"/proc/{pid}/cmdline", 'rb') as fp:
+                if fp.read().find(b'worker process') > -1: res.append(pid)
+        except OSError:
+            pass
+    return res
+
+
+# (soft, hard) Max open files of a process
+def get_nofile(pid:int) -> tuple:
+    try:
+        with open(f"/proc/{pid}/limits") as fp:
+            for line in fp:
+                if line.find('Max open files') == 0:
+                    (soft, hard) = line[len('Max open files'):].split()[:2]
+                    return tuple([None if v == 'unlimited' else int(v) for v in (soft, hard)])
+    except (OSError, ValueError):
+        pass
+    return (None, None)
+
+
+# (open fds, sockets) of a process
+def count_fds(pid:int) -> tuple:
+    fd_dir = f"/proc/{pid}/fd"
+    fds = socks = 0
+    try:
+        with os.scandir(fd_dir) as it:
+            for entry in it:
+                fds += 1
+                try:
+                    if os.readlink(entry.path).find('socket:') == 0: socks += 1
+                except OSError:
+                    pass
+    except OSError:
+        return (0, 0)
+    return (fds, socks)
+
+
+def get_affinity(pid:int) -> set:
+    try:
+        return os.sched_getaffinity(pid)
+    except OSError:
+        return set()
+
+
+# {pid: (max fds, max sockets)} over `duration` seconds
+def sample_workers(workers:list, duration:float) -> dict:
+    res = {pid: (0, 0) for pid in workers}
+    t_end = time.monotonic() + duration
+    while True:
+        for pid in workers:
+            (fds, socks) = count_fds(pid)
+            res[pid] = (max(res[pid][0], fds), max(res[pid][1], socks))
+        if time.monotonic() + C_.TUNE_INTERVAL > t_end: break
+        time.sleep(C_.TUNE_INTERVAL)
+    return res
+
+
+# Peak sockets per worker since the master started, updated with this run's sample
+def update_peak(master:int, peak_now:int, fds_now:int) -> dict:
+    path = util.get_state_path(C_.FILE_TUNE)
+    master_start = util.get_proc_start_time(master)
+    rec = util.read_json_file(path, {})
+    if rec.get('master_pid') != master or rec.get('master_start') != master_start:
+        rec = {'master_pid': master, 'master_start': master_start, 'socks': 0, 'fds': 0, 'ts': None}
+    if peak_now >= rec['socks']:
+        (rec['socks'], rec['ts']) = (peak_now, time.time())
+    rec['fds'] = max(rec['fds'], fds_now)
+    util.write_json_file(path, rec)
+    return rec
+
+
+# ==============================================
+# Checks
+# ==============================================
+
+def _pct(n:int, of:int) -> str:
+    return f"{n / of * 100:.0f}%" if of else '-'
+
+
+def _level(used:int, limit:int) -> str:
+    if not limit: return OK
+    if used >= limit * C_.TUNE_SATURATED: return SATURATED
+    if used >= limit * C_.TUNE_WARN: return WARN
+    return OK
+
+
+# [(check, configured, measured, status, evidence)]
+def analyze(cfg:Config, master:int, workers:list, samples:dict, peak:dict, net) -> list:
+    rows = []
+    n_cpu = os.cpu_count() or 1
+    cpus = get_affinity(master) or set(range(n_cpu))
+    n_workers = len(workers)
+
+    # worker_processes
+    conf_wp = cfg.worker_processes or '1'
+    expected = len(cpus) if conf_wp == 'auto' else int(conf_wp)
+    evidence = [f"{n_cpu} cpus online, master may run on {len(cpus)}: {_fmt_cpus(cpus)}", f"{n_workers} worker processes running"]
+    if n_workers != expected:
+        status = WARN
+        evidence.append(f"config gives {expected} workers: reload pending or workers still exiting")
+    elif n_workers > len(cpus):
+        status = WARN
+        evidence.append(f"{n_workers - len(cpus)} more workers than usable cpus: workers compete for cpu. Use `auto`")
+    elif n_workers < len(cpus):
+        status = INFO
+        evidence.append(f"{len(cpus) - n_workers} usable cpus without a worker. `auto` uses all")
+    else:
+        status = OK
+    rows.append(('worker_processes', conf_wp, f"{n_workers} workers / {len(cpus)} cpus", status, evidence))
+
+    # worker_cpu_affinity
+    pins = OrderedDict([(pid, get_affinity(pid)) for pid in workers])
+    pinned = [pid for pid, s in pins.items() if s != cpus]
+    evidence = [f"worker {pid}: cpus {_fmt_cpus(s)}" for pid, s in pins.items()][:C_.TUNE_EVIDENCE]
+    shared = OrderedDict()
+    for pid in pinned:
+        for cpu in pins[pid]: shared.setdefault(cpu, []).append(pid)
+    shared = OrderedDict([(cpu, pids) for cpu, pids in shared.items() if len(pids) > 1])
+    if len(shared) > 0:
+        status = WARN
+        evidence.append(f"cpus pinned to more than one worker: {', '.join([f'{c} ({len(p)} workers)' for c, p in shared.items()])}")
+    else:
+        status = OK if len(pinned) in (0, n_workers) else INFO
+    rows.append(('worker_cpu_affinity', ' '.join(cfg.worker_cpu_affinity or ['-'])
+                ,f"{len(pinned)} of {n_workers} workers pinned", status, evidence))
+
+    # worker_connections
+    wc = cfg.worker_connections
+    socks = [s for (f, s) in samples.values()]
+    cur_max = max(socks) if len(socks) > 0 else 0
+    busiest = sorted(samples.items(), key=lambda kv: -kv[1][1])[:C_.TUNE_EVIDENCE]
+    evidence = [f"worker {pid}: {s} sockets ({_pct(s, wc)})" for pid, (f, s) in busiest]
+    evidence.append(f"peak {peak['socks']} sockets in one worker seen by pynx tune since master start"
+                    f"{'' if peak['ts'] is None else ' (' + time.strftime('%Y-%m-%d %H:%M', time.localtime(peak['ts'])) + ')'}")
+    evidence.append(f"capacity {wc * n_workers} connections over {n_workers} workers, {sum(socks)} in use"
+                    f", headroom {max(0, wc - peak['socks'])} per worker at peak")
+    status = _level(peak['socks'], wc)
+    if status != OK: evidence.append(f"raise worker_connections (and worker_rlimit_nofile) or add workers")
+    rows.append(('worker_connections', str(wc), f"{cur_max} now / {peak['socks']} peak per worker ({_pct(peak['socks'], wc)})"
+                , status, evidence))
+
+    # open files
+    proxied = len(cfg.proxies) > 0
+    need = wc * 2 if proxied else wc # a proxied request holds a client and an upstream connection
+    limits = OrderedDict([(pid, get_nofile(pid)) for pid in workers])
+    softs = [s for (s, h) in limits.values() if not s is None]
+    soft = min(softs) if len(softs) > 0 else None
+    fds_max = max([f for (f, s) in samples.values()]) if len(samples) > 0 else 0
+    evidence = [f"workers: soft limit {soft}, up to {fds_max} fds open now, {peak['fds']} peak"]
+    if cfg.worker_rlimit_nofile is None: evidence.append(f"worker_rlimit_nofile not set: workers inherit the limit of the nginx unit")
+    if soft is None:
+        status = OK if n_workers > 0 else INFO
+    elif soft < wc:
+        status = SATURATED
+        evidence.append(f"limit {soft} < worker_connections {wc}: workers hit EMFILE before worker_connections")
+    elif soft < need:
+        status = WARN
+        evidence.append(f"proxied requests use 2 fds: {wc} connections need up to {need} fds, limit is {soft}")
+    else:
+        status = _level(peak['fds'], soft)
+    rows.append(('worker_rlimit_nofile', '-' if cfg.worker_rlimit_nofile is None else str(cfg.worker_rlimit_nofile)
+                ,'-' if soft is None else f"{soft} soft limit, {fds_max} open ({_pct(fds_max, soft)})", status, evidence))
+
+    # upstreams
+    targets = OrderedDict() # label -> (servers, keepalive, [(version, connection)])
+    for (target, version, connection) in cfg.proxies:
+        t = _proxy_target(target, cfg.upstreams)
+        if t is None: continue
+        if isinstance(t, str):
+            up = cfg.upstreams[t]
+            entry = targets.setdefault(f"upstream {t}", (up['servers'], up['keepalive'], []))
+        else:
+            entry = targets.setdefault(f"{t[0]}:{t[1]}" if t[0] != 'unix' else f"unix:{t[1]}", ([t], None, []))
+        entry[2].append((version, connection))
+    for label, (servers, keepalive, uses) in targets.items():
+        est = tw = 0
+        evidence = []
+        for (host, port) in servers:
+            if host == 'unix': continue
+            (s_est, s_tw) = (0, 0)
+            for ip in _resolve(host, port):
+                (e, t) = net.remote(ip, port)
+                s_est += e
+                s_tw += t
+            est += s_est
+            tw += s_tw
+            evidence.append(f"{host}:{port}: {s_est} established, {s_tw} time-wait")
+        tcp = len([h for (h, p) in servers if h != 'unix']) > 0
+        rate = tw / TIME_WAIT_SECS
+        no_reuse = [u for u in uses if u[0] != '1.1' or u[1] != '']
+        status = OK
+        if not tcp:
+            evidence.append('unix socket: no TIME_WAIT, churn not measured')
+        else:
+            evidence.append(f"~{rate:.1f} new connections/s (time-wait / {TIME_WAIT_SECS}s)")
+            if keepalive is None:
+                if rate >= C_.TUNE_CHURN_WARN:
+                    status = WARN
+                    evidence.append(f"no keepalive: every request opens a connection"
+                                    f"{'. Define an upstream block with keepalive' if label.find('upstream ') != 0 else ''}")
+            elif len(no_reuse) > 0:
+                status = WARN if rate >= C_.TUNE_CHURN_WARN else INFO
+                evidence.append(f"keepalive {keepalive} is unused by {len(no_reuse)} proxy_pass without "
+                                f"`proxy_http_version 1.1` and `proxy_set_header Connection \"\"`")
+            elif rate >= C_.TUNE_CHURN_WARN:
+                status = WARN
+                evidence.append(f"keepalive {keepalive} idle connections per worker do not absorb the churn: raise keepalive")
+        rows.append((label, '-' if keepalive is None else f"keepalive {keepalive}"
+                    , f"{est} est, {tw} tw" if tcp else '-', status, evidence))
+    return rows
+
+
+def _fmt_cpus(cpus:set) -> str:
+    cpus = sorted(cpus)
+    ranges = []
+    for c in cpus:
+        if len(ranges) > 0 and ranges[-1][1] == c - 1: ranges[-1][1] = c
+        else: ranges.append([c, c])
+    return ','.join([f"{a}" if a == b else f"{a}-{b}" for (a, b) in ranges])
+
+
+def main_tune(args:list):
+    duration = float(util.pop_opt(args, '--duration', default=str(C_.TUNE_DURATION)))
+    assert duration >= 0, f"--duration must be >= 0. Got: {duration}"
+    assert len(args) == 0, f"Unexpected args for tune: {args}"
+    master = util.get_nginx_master_pid()
+    assert not master is None, f"nginx is not running (no master pid in {C_.PATH_NGINX_PID})"
+
+    cfg = get_config()
+    workers = get_workers(master)
+    assert len(workers) > 0, f"No worker processes found for nginx master {master}"
+    samples = sample_workers(workers, duration)
+    peak = update_peak(master, max([s for (f, s) in samples.values()]), max([f for (f, s) in samples.values()]))
+    rows = analyze(cfg, master, workers, samples, peak, conns.NetStats())
+
+    table = util.build_grid(['Check', 'Configured', 'Measured', 'Status', 'Evidence']
+                           ,['l'    , 'l'         , 'l'       , 'l'     , 'l'])
+    for (check, configured, measured, status, evidence) in rows:
+        table.add_row([check, configured, measured, status, '\n'.join(evidence)])
+    pc(f"\n{table.draw()}\n")
+    counts = OrderedDict()
+    for row in rows: counts[row[3]] = counts.get(row[3], 0) + 1
+    issues = ', '.join([f"{counts[s]} {s.lower()}" for s in (SATURATED, WARN) if s in counts]) or 'no issues'
+    pc(f"tune: {len(rows)} checks, {issues} ({len(workers)} workers sampled for {duration:.1f}s)")
@@ -1,25 +1,78 @@
 import os
+import re
 import sys
+import time
+import select
+import shutil
+import tempfile
 import typing
 import traceback
 import subprocess
 import copy
+import fnmatch
+import configparser
+import concurrent.futures
 import json
-import texttable as tt
+import textwrap
+import unicodedata
 from gixy.parser.nginx_parser import NginxParser
+from gixy.directives.directive import Directive
 from enum import Flag
 from collections import OrderedDict
 from pathlib import Path
 from decimal import Decimal
+from . import complete
 
 
 # Constants
 class C_():
-    SERVER_CMD = ('status','list', 'test', 'start', 'stop', 'reload', 'restart')
-    SITE_CMD = ('enable', 'disable', 'start', 'stop', 'config', 'status')
-    WSGI_CMD = ('status', 'start', 'stop', 'restart')
-    PATH_SITES_A = '/etc/nginx/sites-available'
-    PATH_SITES_E = '/etc/nginx/sites-enabled'
+    SERVER_CMD = ('status','list', 'test', 'start', 'stop', 'reload', 'restart', 'conflicts', 'export')
+    SERVER_ARG_CMD = ('who',)
+    INSTANCES_PARALLEL_CMD = ('list', 'status', 'test', 'export')
+    SITE_CMD = ('enable', 'disable', 'start', 'stop', 'config', 'status', 'conns', 'tail', 'precompress', 'bench')
+    WSGI_CMD = ('status', 'start', 'stop', 'restart', 'logs')
+    DEF_SITES_A = '/etc/nginx/sites-available'
+    DEF_SITES_E = '/etc/nginx/sites-enabled'
+    DEF_NGINX_CONF = '/etc/nginx/nginx.conf'
+    DEF_NGINX_PID = '/run/nginx.pid'
+    PATH_SITES_A = DEF_SITES_A
+    PATH_SITES_E = DEF_SITES_E
+    PATH_CONFIG = '/etc/pynx/pynx.conf'
+    CONFIG = None
+    INSTANCES = None
+    INSTANCE = None
+    NGINX_UNIT = 'nginx'
+    NGINX_BIN = 'nginx'
+    NGINX_CONF = None
+    PATH_NGINX_CONF = DEF_NGINX_CONF
+    PATH_NGINX_PID = DEF_NGINX_PID
+    PATH_STATE = '/var/lib/pynx'
+    PATH_CACHE = '/var/cache/pynx'
+    PATH_PROC_NET = '/proc/net'
+    FILE_JOURNAL_CURSORS = 'journal_cursors.json'
+    FILE_SITE_INDEX = 'site_index.json'
+    FILE_TOPOLOGY = 'topology.json'
+    FILE_LOADED_GENERATION = 'loaded_generation.json'
+    FILE_NGINX_TEST = 'nginx_test.json'
+    FILE_HISTORY = 'history.bin'
+    FILE_NAMES = 'names.bin'
+    FILE_AUDIT = 'audit.json'
+    FILE_CERTS = 'certs.json'
+    DIR_SNAPSHOTS = 'snapshots'
+    FILE_TUNE = 'tune.json'
+    FILE_BENCH = 'bench.json'
+    FILE_PRECOMPRESS = 'precompress.json'
+    OTHER_CMD = ('history', 'audit', 'certs', 'rollback', 'tune', 'cache', 'agent', 'fleet', 'completion')
+    CLI_FLAGS = ('--all-instances', '--conns', '--dry-run', '--follow', '--help', '--list', '--ndjson', '--no-warmup', '--stats', '--stream', '--summary', '--wsgi')
+    # Options that take a value: pop_opt only accepts these and completion reads them from the names file
+    CLI_VALUE_OPTIONS = ('-c', '--connections', '-d', '--duration', '--instance', '--key-pattern', '--limit', '--listen', '--parallel', '--path'
+                        ,'--secret-file', '--sort', '--textfile', '--timeout', '--unit', '--where')
+    CLI_OPTIONS = tuple(sorted(CLI_FLAGS + tuple([o for o in CLI_VALUE_OPTIONS if o.find('--') == 0])))
+    HISTORY_CAPACITY = 16384
+    HISTORY_LIMIT = 20
+    TOPOLOGY_NEG_TTL = 300
+    PATHS_SYSTEMD_UNITS = ['/etc/systemd/system', '/run/systemd/system', '/lib/systemd/system', '/usr/lib/systemd/system']
+    JOURNAL_FIRST_LINES = 200
     TYPES_PRIMITIVE = {str, int, float, complex, bool, bytes, bytearray, memoryview, Decimal}
     TYPES_PRIMITIVE_STR = {'str', 'int', 'float', 'complex', 'bool', 'bytes', 'bytearray', 'memoryview', 'Decimal'}
     TYPES_COMPLEX = {list, tuple, range, dict, set, frozenset}
@@ -28,17 +81,232 @@ class C_():
     NGINX_VER = None
     PERL_VER = None
     NGINX_RELOAD_BROKEN = False
+    BOOT_TIME = None
+    RELOAD_SLACK = 2.0
+    RELOAD_WORKERS_TIMEOUT = 10.0
+    NGINX_TEST_TTL = 300.0 # export re-runs `nginx -t` at least this often (certs, files outside the include list)
+    WAIT_TIMEOUT = 60.0
+    WAIT_POLL_MIN = 0.02
+    WAIT_POLL_MAX = 1.0
+    SYSTEMD_TRANSIENT = ('activating', 'deactivating', 'reloading')
+    WSGI_PARALLEL = 8
+    TABLE_MAX_WIDTH = 250
+    TABLE_STREAM_SAMPLE = 100
+    CERTS_PARALLEL = 8
+    CERTS_WARN_DAYS = 30
+    OPENSSL_BIN = 'openssl'
+    SNAPSHOT_KEEP = 500
+    SNAPSHOT_PRUNE_BATCH = 50
+    SNAPSHOT_ID_LEN = 12
+    TUNE_DURATION = 2.0
+    TUNE_INTERVAL = 0.25
+    TUNE_WARN = 0.7
+    TUNE_SATURATED = 0.9
+    TUNE_CHURN_WARN = 10.0
+    TUNE_EVIDENCE = 4
+    PRECOMPRESS_EXT = ('.css', '.csv', '.eot', '.htm', '.html', '.ico', '.js', '.json', '.map', '.md', '.mjs', '.otf', '.svg'
+                      ,'.ttf', '.txt', '.wasm', '.webmanifest', '.xml')
+    PRECOMPRESS_MIN_SIZE = 256
+    PRECOMPRESS_MAX_RATIO = 0.9
+    CACHE_HEADER_READ = 4096
+    CACHE_HEADER_MAX = 65536
+    CACHE_SHOW_KEYS = 10
+    DEF_ACCESS_LOG = '/var/log/nginx/access.log'
+    TAIL_READ_SIZE = 1024 * 1024
+    TAIL_ROTATE_GRACE = 5.0
+    TAIL_POLL = 0.25
+    TAIL_SKETCH_ACCURACY = 0.01
+    TAIL_WINDOWS = (1, 10, 60)
+    WARMUP_CONCURRENCY = 4
+    WARMUP_THRESHOLD_MS = 200.0
+    WARMUP_MAX_REQUESTS = 200
+    WARMUP_SETTLE = 3
+    WARMUP_TIMEOUT = 10.0
+    WARMUP_BAR = 30
+    BENCH_CONNS = 16
+    BENCH_DURATION = 5.0
+    BENCH_TIMEOUT = 10.0
+    BENCH_ERROR_DELAY = 0.05
+    BENCH_PERCENTILES = (50, 90, 99)
+    BENCH_NOISE_PCT = 5.0
+    BENCH_CPU_BUSY = 0.9
+    UNITS_ACTION_STATES = {'start': ('active',), 'stop': ('inactive',), 'restart': ('active',)}
+    FLEET_PORT = 7801
+    FLEET_LISTEN = 'unix:/run/pynx.sock'
+    FLEET_SECRET_FILE = '/etc/pynx/fleet.secret'
+    FLEET_PARALLEL = 16
+    FLEET_TIMEOUT = 30.0
+    FLEET_TIMEOUT_SLACK = 2.0
+    FLEET_REQUEST_TIMEOUT = 10.0
+    FLEET_MAX_SKEW = 60
+    FLEET_MAX_REQUEST = 65536
+    FLEET_MAX_RESPONSE = 16 * 1024 * 1024
+    FLEET_DENY_CMD = ('agent', 'fleet')
+    SESSION = None # Session while running pynx batch / shell
+    SESSION_DENY_CMD = ('batch', 'shell', 'agent')
 
 def init():
     # pc(f" nginx ver: {get_nginx_ver()}")
     # pc(f" perl ver: {get_perl_ver()}")
 
+    if not C_.SESSION is None and C_.INSTANCE in C_.SESSION.versions:
+        (C_.NGINX_VER, C_.PERL_VER, C_.NGINX_RELOAD_BROKEN) = C_.SESSION.versions[C_.INSTANCE]
+        return
+
     if get_nginx_ver() == '1.23.1':
         if get_perl_ver() == '5.30.0':
             # Cannot do reload of nginx because it will segfalt due to bug:
             #   . https://github.com/Perl/perl5/issues/17154
             C_.NGINX_RELOAD_BROKEN = True
 
+    if not C_.SESSION is None:
+        C_.SESSION.versions[C_.INSTANCE] = (C_.NGINX_VER, C_.PERL_VER, C_.NGINX_RELOAD_BROKEN)
+
+
+# State shared by the commands of one `pynx batch` or `pynx shell` run (C_.SESSION).
+# Entries are dropped by the functions that change what they describe:
+#   . scans - SiteScan per instance (get_scan). Dropped by enable_site / disable_site
+#   . units - `systemctl status` results per unit. Dropped by start/stop/restart/reload of the unit
+#   . versions - nginx / perl version detection of init() per instance
+#   . reload_pending - instances with site changes waiting for a reload (request_reload).
+#     Cleared by record_loaded_generation after a reload, start or restart
+#   . deferred_records - history records per instance held until its deferred reload ran
+#     (history.record_after_reload). Written by history.flush_deferred
+class Session():
+    def __init__(self):
+        self.scans = {}
+        self.units = {}
+        self.versions = {}
+        self.reload_pending = set()
+        self.deferred_records = {}
+
+    def drop_unit(self, name:str):
+        self.units.pop(name, None)
+
+
+# SiteScan for the current command. Shared by all commands of a session until sites change
+def get_scan():
+    if C_.SESSION is None: return SiteScan()
+    scan = C_.SESSION.scans.get(C_.INSTANCE)
+    if scan is None:
+        scan = C_.SESSION.scans[C_.INSTANCE] = SiteScan()
+    return scan
+
+
+def _drop_unit_status(name:str):
+    if not C_.SESSION is None: C_.SESSION.drop_unit(name)
+
+
+# Reload for site changes. In a session it is deferred to the next explicit `reload` or the end of the batch
+def request_reload() -> tuple:
+    if C_.SESSION is None: return reload_nginx()
+    C_.SESSION.reload_pending.add(C_.INSTANCE)
+    return (True, None)
+
+
+def reload_deferred() -> bool:
+    return not C_.SESSION is None and C_.INSTANCE in C_.SESSION.reload_pending
+
+
+
+# nginx instance definition. Instances are defined in C_.PATH_CONFIG (ini):
+#   [pynx]
+#   default_instance = public
+#   [instance:public]
+#   sites_available = /etc/nginx/sites-available
+#   sites_enabled = /etc/nginx/sites-enabled
+#   unit = nginx
+#   binary = /usr/sbin/nginx
+#   conf = /etc/nginx/nginx.conf
+#   pid_file = /run/nginx.pid
+# Missing keys default to the single instance defaults in C_
+class Instance():
+    KEYS = ('sites_available', 'sites_enabled', 'unit', 'binary', 'conf', 'pid_file')
+
+    def __init__(self, name:str, sites_available:str=None, sites_enabled:str=None, unit:str=None
+                ,binary:str=None, conf:str=None, pid_file:str=None):
+        assertNotBlank('name', name)
+        self.name = name
+        self.sites_available = C_.DEF_SITES_A if sites_available is None else sites_available
+        self.sites_enabled = C_.DEF_SITES_E if sites_enabled is None else sites_enabled
+        self.unit = 'nginx' if unit is None else unit
+        self.binary = 'nginx' if binary is None else binary
+        self.conf = conf
+        self.pid_file = C_.DEF_NGINX_PID if pid_file is None else pid_file
+
+    def __str__(self):
+        return f"Instance: {self.name} ({self.unit} - {self.sites_available})"
+    def __repr__(self):
+        return self.__str__()
+
+
+# Instances from C_.PATH_CONFIG in file order. Empty if there is no config file
+def get_instances() -> OrderedDict:
+    if C_.INSTANCES is None:
+        C_.INSTANCES = OrderedDict()
+        cfg = get_config()
+        for section in cfg.sections():
+            if section.find('instance:') != 0: continue
+            name = section[9:].strip()
+            assertNotBlank(f"instance name in [{section}]", name)
+            unknown = [k for k in cfg[section].keys() if not k in Instance.KEYS]
+            assert len(unknown) == 0, f"Unknown keys in [{section}] of {C_.PATH_CONFIG}: {unknown}"
+            C_.INSTANCES[name] = Instance(name, **dict(cfg[section].items()))
+    return C_.INSTANCES
+
+
+def get_config() -> configparser.ConfigParser:
+    if C_.CONFIG is None:
+        C_.CONFIG = configparser.ConfigParser(interpolation=None)
+        C_.CONFIG.read(C_.PATH_CONFIG)
+    return C_.CONFIG
+
+
+# Instance used when --instance is not passed. None if no instances are configured
+def get_default_instance() -> Instance:
+    instances = get_instances()
+    if len(instances) == 0: return None
+    name = get_config().get('pynx', 'default_instance', fallback=None)
+    if name is None: return list(instances.values())[0]
+    assert name in instances, f"default_instance `{name}` is not defined in {C_.PATH_CONFIG}"
+    return instances[name]
+
+
+# Points paths, unit and binary in C_ at instance. State and cache files go into a
+# subdirectory per instance
+def use_instance(inst:Instance):
+    assert isinstance(inst, Instance), f"inst must be an Instance. Got: {getClassName(inst)}"
+    C_.INSTANCE = inst.name
+    C_.PATH_SITES_A = inst.sites_available
+    C_.PATH_SITES_E = inst.sites_enabled
+    C_.NGINX_UNIT = inst.unit
+    C_.NGINX_BIN = inst.binary
+    C_.NGINX_CONF = inst.conf
+    C_.PATH_NGINX_CONF = C_.DEF_NGINX_CONF if inst.conf is None else inst.conf
+    C_.PATH_NGINX_PID = inst.pid_file
+    C_.NGINX_VER = None
+    C_.NGINX_RELOAD_BROKEN = False
+
+
+# Commands and site dirs for shell completion (see complete.py). Only writes when they changed
+def update_names_cache():
+    instances = {} # plain types only, the file is marshal data
+    for name, inst in get_instances().items():
+        instances[name] = {'dirs': [inst.sites_available, inst.sites_enabled]
+                          ,'topology': os.path.join(C_.PATH_CACHE, name, C_.FILE_TOPOLOGY)}
+    if len(instances) == 0:
+        instances[''] = {'dirs': [C_.PATH_SITES_A, C_.PATH_SITES_E], 'topology': os.path.join(C_.PATH_CACHE, C_.FILE_TOPOLOGY)}
+    commands = {'server': sorted(C_.SERVER_CMD + C_.SERVER_ARG_CMD + C_.OTHER_CMD), 'site': list(C_.SITE_CMD)
+               ,'wsgi': list(C_.WSGI_CMD), 'options': list(C_.CLI_OPTIONS), 'value_options': list(C_.CLI_VALUE_OPTIONS)}
+    os.makedirs(C_.PATH_CACHE, exist_ok=True)
+    complete.update_spec(os.path.join(C_.PATH_CACHE, C_.FILE_NAMES), commands, instances)
+
+
+# nginx command line for the current instance
+def get_nginx_cmd(*args) -> list:
+    cmd = [C_.NGINX_BIN]
+    if not C_.NGINX_CONF is None: cmd += ['-c', C_.NGINX_CONF]
+    return cmd + list(args)
 
 
 def get_cmd_str(cmd, past:bool=False):
@@ -86,18 +354,19 @@ class SiteStatus(Flag):
 AVAILABLE, ENABLED, BAD = (1,2,4)
 
 class Site():
-    def __init__(self, name, status:SiteStatus, bsi:BadSiteInfo=None):
+    def __init__(self, name, status:SiteStatus, bsi:BadSiteInfo=None, site_cfg=None):
         self.name = name
         self.status = status
         self.bsi = bsi
         self.site_name = None
+        self._site_cfg = site_cfg
 
-        if self.status & BAD:
-            self.site_cfg = None
-
-        else:
-            # Read config
-            self.site_cfg = SiteConfig(self.name)
+    # Config is read on first access so that scanning sites does not parse every config
+    @property
+    def site_cfg(self):
+        if self._site_cfg is None and not self.status & BAD:
+            self._site_cfg = SiteConfig(self.name)
+        return self._site_cfg
 
 
 class SiteConfig():
@@ -109,6 +378,10 @@ class SiteConfig():
         self.locations = []
         self.wsgi_sockets = []
         self.server_name = None
+        self.server_names = []
+        self.ssl_certificates = []
+        self.access_logs = [] # access_log args (path, format, options) of the server block
+        self.roots = [] # (location path or None, location modifier, 'root' | 'alias', dir)
 
         _config_path = f"{C_.PATH_SITES_A}/{self.name}"
         with open(_config_path) as fp:
@@ -139,10 +412,12 @@ class SiteConfig():
                         location = node
                         self.locations.append(location.path)
                         for l_node in location.children:
+                            if l_node.name in ('root', 'alias'):
+                                self.roots.append((location.path, location.modifier or '', l_node.name, l_node.args[0]))
                             if l_node.name == 'proxy_pass':
                                 proxy_pass = l_node.args[0]
                                 if proxy_pass.find('http://unix:') > -1:
-                                    socket_path = proxy_pass[12:]
+                                    socket_path = proxy_pass[12:].split(':')[0] # strip `:/uri`
                                     self.wsgi_sockets.append((socket_path, os.path.isfile(socket_path)))
 
                     continue
@@ -152,6 +427,16 @@ class SiteConfig():
 
                 elif node.name == 'server_name':
                     self.server_name = node.args[0]
+                    self.server_names = list(node.args)
+
+                elif node.name == 'ssl_certificate':
+                    self.ssl_certificates.append(node.args[0])
+
+                elif node.name == 'access_log':
+                    self.access_logs.append(list(node.args))
+
+                elif node.name == 'root':
+                    self.roots.append((None, '', 'root', node.args[0]))
 
 
         except Exception as ex:
@@ -166,51 +451,145 @@ class SiteConfig():
         noop()
 
 
-def find_site(site) -> tuple:
-    sites=Sites(site_find=site)
+# Host header for requests to a site: its first server_name that is a plain name
+def get_site_host(site_cfg) -> str:
+    names = [] if site_cfg is None else site_cfg.server_names
+    names = [n for n in names if n != '_' and n.find('*') == -1 and n.find('~') != 0]
+    return names[0] if len(names) > 0 else 'localhost'
+
+
+def find_site(site, scan=None) -> tuple:
+    sites = Sites(get_scan() if scan is None else scan)
     if site in sites._enab: return (True, sites._enab[site])
     if site in sites._avail: return (True, sites._avail[site])
     if site in sites._bad: return (True, sites._bad[site])
     return (False, None)
+
+
+# Snapshot of sites-available and sites-enabled taken with one os.scandir pass over each
+# directory. Uses the DirEntry type and stat data (one readlink + stat per enabled link, no
+# calls for plain files in sites-available) and classifies enabled entries in the same pass:
+#   . Broken Link - link target does not exist
+#   . Foreign Link - link does not point to the same name in sites-available
+#   . Not a Link - regular file in sites-enabled
+# Create one per command and pass it to Sites / find_site / SiteIndex to avoid rescans
+class SiteScan():
+    def __init__(self):
+        self._avail = OrderedDict()  # name -> DirEntry
+        self._enab = OrderedDict()   # name -> (DirEntry, target, os.stat_result)
+        self._bad = OrderedDict()    # name -> (status, BadSiteInfo)
+        self._included = OrderedDict() # name -> (target, mtime_ns, size) of every sites-enabled entry, bad ones too
+
+        for entry in self._scandir(C_.PATH_SITES_A):
+            if entry.is_symlink():
+                try:
+                    entry.stat()
+                except OSError:
+                    self._bad[entry.name] = (AVAILABLE|BAD, BadSiteInfo(C_.PATH_SITES_A, self._readlink(entry), entry.name, "Broken Link"))
+                    continue
+            elif not entry.is_file(follow_symlinks=False):
+                continue
+            self._avail[entry.name] = entry
+
+        path_a = os.path.normpath(C_.PATH_SITES_A)
+        for entry in self._scandir(C_.PATH_SITES_E):
+            if not entry.is_symlink():
+                if entry.is_file(follow_symlinks=False):
+                    self._bad[entry.name] = (ENABLED|BAD, BadSiteInfo(C_.PATH_SITES_E, entry.path, entry.name, "Not a Link"))
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        self._included[entry.name] = (None, st.st_mtime_ns, st.st_size)
+                    except OSError:
+                        pass
+                continue
+
+            target = self._readlink(entry)
+            try:
+                st = entry.stat()
+            except OSError:
+                self._bad[entry.name] = (ENABLED|BAD, BadSiteInfo(C_.PATH_SITES_E, target, entry.name, "Broken Link"))
+                self._included[entry.name] = (target, None, None)
+                continue
+            self._included[entry.name] = (target, st.st_mtime_ns, st.st_size)
+
+            target_abs = os.path.normpath(os.path.join(C_.PATH_SITES_E, target))
+            if target_abs != os.path.join(path_a, entry.name) \
+                    and os.path.realpath(target_abs) != os.path.realpath(os.path.join(path_a, entry.name)):
+                self._bad[entry.name] = (ENABLED|BAD, BadSiteInfo(C_.PATH_SITES_E, target, entry.name, "Foreign Link"))
+                continue
+
+            if not entry.name in self._avail: continue # sites-available entry is bad
+            self._enab[entry.name] = (entry, target, st)
+
+    @staticmethod
+    def _scandir(path:str) -> list:
+        try:
+            with os.scandir(path) as it:
+                return sorted(it, key=lambda e: e.name)
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _readlink(entry) -> str:
+        try:
+            return os.readlink(entry.path)
+        except OSError:
+            return None
+
+    # name -> (target, mtime_ns, size) of all sites-enabled entries nginx includes, bad ones too.
+    # target is None for regular files, mtime and size are None for broken links
+    @property
+    def included(self) -> OrderedDict:
+        return self._included
+
+    # name -> status for all sites. Enabled first, then available, then bad
+    @property
+    def sites(self) -> OrderedDict:
+        result = OrderedDict()
+        for name in self._enab: result[name] = ENABLED
+        for name in self._avail:
+            if not name in result: result[name] = AVAILABLE
+        for name, (status, bsi) in self._bad.items():
+            if not name in result: result[name] = status
+        return result
+
+    @property
+    def enabled(self) -> OrderedDict:
+        return self._enab
+
+    def bad_info(self, name:str) -> BadSiteInfo:
+        bad = self._bad.get(name)
+        return None if bad is None else bad[1]
+
+    # stat of the config in sites-available (cached by DirEntry). None if not available
+    def stat(self, name:str) -> os.stat_result:
+        entry = self._avail.get(name)
+        if entry is None: return None
+        try:
+            return entry.stat()
+        except OSError:
+            return None
             
 
 class Sites():
-    def __init__(self, site_find:str=None):
-        (a_sites, a_sites_bad) = self._get_sites(AVAILABLE, site_find=site_find)
-        (e_sites, e_sites_bad) = self._get_sites(ENABLED, site_find=site_find)
+    def __init__(self, scan:SiteScan=None):
+        self._scan = get_scan() if scan is None else scan
         
         self._enab = OrderedDict()
         self._avail = OrderedDict()
         self._bad = OrderedDict()
-        self._site_find = site_find
-
-        for name in e_sites:
-            site = Site(name, ENABLED)
-            self._enab[name] = site
-
-        for name in a_sites:
-            if not name in self._enab:
-                site = Site(name, AVAILABLE)
-                self._avail[name] = site
-
-        for badlink in e_sites_bad:
-            assert not badlink.Name in e_sites, f"FATAL - bad enabled site should not be also in e_sites!"
-            site = Site(badlink.Name, ENABLED|BAD, badlink)
-            self._bad[name] = site
-
-        for badlink in a_sites_bad:
-            assert not badlink.Name in a_sites, f"FATAL - bad available site should not be also in a_sites!"
-            site = Site(badlink.Name, AVAILABLE|BAD, badlink)
-            self._bad[name] = site
-        
-        # a_sites_use = []
-        # for a_site in a_sites:
-        #     if not a_site in e_sites:
-        #         a_sites_use.append(a_site)
-            
-        # self._avail = a_sites_use
-        # self._enab = e_sites
-        # self._bad = a_sites_bad + e_sites_bad
+
+        for name, status in self._scan.sites.items():
+            if status & BAD:
+                self._bad[name] = Site(name, status, self._scan.bad_info(name))
+            elif status == ENABLED:
+                self._enab[name] = Site(name, ENABLED)
+            else:
+                self._avail[name] = Site(name, AVAILABLE)
+
+    @property
+    def scan(self) -> SiteScan:
+        return self._scan
 
     @property
     def Avail(self) -> OrderedDict:
@@ -224,29 +603,10 @@ class Sites():
     def Bad(self) -> OrderedDict:
         return self._bad
 
-    def _get_sites(self, type:SiteStatus, site_find:str=None):
-        if type == AVAILABLE:
-            dir = C_.PATH_SITES_A
-        elif type == ENABLED:
-            dir = C_.PATH_SITES_E
-        else:
-            raise Exception(f"Invalid type: {type}")
-
-        _path = Path(dir)
-        good = []
-        bad = []
-        for fname in _path.rglob(site_find if isinstance(site_find, str) else '*'):
-            if fname.is_symlink():
-                full_path = fname._str
-                if os.path.exists(full_path):
-                    good.append(fname.name)
-                else:
-                    bad.append(BadSiteInfo(full_path, os.path.realpath(full_path), fname.name, "Broken Link"))
+    @property
+    def All(self) -> list:
+        return list(self._enab.values()) + list(self._avail.values()) + list(self._bad.values())
 
-            elif fname.is_file():
-                good.append(fname.name)
-        
-        return (good, bad)
 
 class Nginx():
     def __init__(self):
@@ -254,7 +614,7 @@ class Nginx():
         self._bad_rows = []
         self._reason = None
 
-        with PExec(['nginx', '-t']) as p:
+        with PExec(get_nginx_cmd('-t')) as p:
             if p.code > 1:
                 raise Exception("Err occured while running `nginx -t`: {}. Code: {}, stdout: {}".format(p.err, p.code, p.out))
             elif len(p.out):
@@ -273,7 +633,7 @@ class Nginx():
 
             if len(rows) < 2:
                 self._status_ok = False
-                self._reason =  f"Got unexpected output from % nginx -t . rows:\n'{pre(rows, 6)}'"
+                self._reason =  f"Got unexpected output from % nginx -t . rows:\n'{pre(out, 6)}'"
                 return
 
             a_bad_rows = []
@@ -315,13 +675,863 @@ class Nginx():
 
 
 
-def build_table():
-    table = tt.Texttable(max_width=250)
-    table.header(        ['Site', 'Enabled', 'Name','Listens', 'Notes'])
-    table.set_cols_align(['l'   , 'c'      ,'l'    ,'l'      , 'l'])
-    table.set_cols_dtype(['t'   , 't'      ,'t'    ,'t'      , 't'])
-    table.set_deco(table.VLINES)
-    return table
+# Parses `listen` args into (addr, port, default_server). addr '*' is any ipv4 address.
+# For unix sockets addr is `unix:<path>` and port is None
+def parse_listen(args:list) -> tuple:
+    assertNotBlank('args', args)
+    spec = args[0]
+    ds = 'default_server' in args[1:] or 'default' in args[1:]
+    if spec.find('unix:') == 0: return (spec, None, ds)
+
+    if spec.find('[') == 0:
+        iF = spec.find(']')
+        (addr, rest) = (spec[:iF+1], spec[iF+1:])
+        port = rest[1:] if rest.find(':') == 0 else '80'
+    elif spec.isdigit():
+        (addr, port) = ('*', spec)
+    elif spec.find(':') > -1:
+        (addr, port) = spec.rsplit(':', 1)
+    else:
+        (addr, port) = (spec, '80')
+
+    if addr == '0.0.0.0': addr = '*'
+    try:
+        port = int(port)
+    except ValueError:
+        port = -1 # variable or otherwise unparsable
+    return (addr, port, ds)
+
+
+# nginx server_name matching: exact, *.example.com, .example.com, www.example.* and ~regex
+def server_name_matches(pattern:str, host:str) -> bool:
+    (pattern, host) = (pattern.lower(), host.lower())
+    if pattern.find('~') == 0:
+        try:
+            return not re.search(pattern[1:], host) is None
+        except re.error:
+            return False
+    if pattern.find('*.') == 0: return host.endswith(pattern[1:])
+    if pattern.find('.') == 0: return host == pattern[1:] or host.endswith(pattern)
+    if pattern.endswith('.*'): return host.find(pattern[:-1]) == 0
+    return pattern == host
+
+
+# Parse results of a SiteConfig as stored in the site index cache.
+# Same attributes as SiteConfig. config_lines are read from disk when asked for
+class CachedSiteConfig():
+    FIELDS = ('parse_ok', 'listens', 'locations', 'wsgi_sockets', 'server_name', 'server_names', 'ssl_certificates', 'access_logs', 'roots')
+
+    def __init__(self, name:str, data:dict):
+        self.name = name
+        for k in self.FIELDS: setattr(self, k, data.get(k))
+        self.wsgi_sockets = [tuple(a) for a in self.wsgi_sockets]
+
+    @property
+    def config_lines(self) -> list:
+        return SiteConfig(self.name).config_lines
+
+    @staticmethod
+    def to_dict(site_cfg) -> dict:
+        return {k: getattr(site_cfg, k) for k in CachedSiteConfig.FIELDS}
+
+
+# Index over all sites for reverse lookups and conflict detection.
+# Parse results are cached in C_.PATH_CACHE keyed by config file mtime and size
+# so only new or changed site configs are parsed. If names is passed, only those
+# sites are loaded (cache entries of other sites are kept as is).
+class SiteIndex():
+    VERSION = 4 # 2: ssl_certificates, 3: access_logs, 4: roots
+
+    def __init__(self, sites=None, names:set=None):
+        self._sites = Sites() if sites is None else sites
+        self._names = names
+        self._entries = OrderedDict()
+        self._by_listen = {}  # (addr, port, server_name) -> [site]
+        self._by_port = {}    # port -> [site]
+        self._by_name = {}    # server_name -> [site]
+        self._by_socket = {}  # unix socket path -> [site]
+        self._defaults = {}   # (addr, port) -> [site] with default_server
+        self._load()
+        self._build()
+
+    def _load(self):
+        path = get_state_path(C_.FILE_SITE_INDEX, cache=True)
+        cache = read_json_file(path, {})
+        cached = cache.get('sites', {}) if cache.get('version') == self.VERSION else {}
+        fresh = {} if self._names is None else dict(cached)
+        dirty = False
+        for site in self._sites.All:
+            if not self._names is None and not site.name in self._names: continue
+            if site.status & BAD:
+                self._entries[site.name] = site
+                continue
+
+            st = self._sites.scan.stat(site.name)
+            key = None if st is None else [st.st_mtime_ns, st.st_size]
+
+            entry = cached.get(site.name)
+            if entry is None or entry['key'] != key:
+                dirty = True
+                cfg = None if key is None else site.site_cfg
+                entry = {'key': key, 'cfg': None if cfg is None else CachedSiteConfig.to_dict(cfg)}
+
+            fresh[site.name] = entry
+            cfg = None if entry['cfg'] is None else CachedSiteConfig(site.name, entry['cfg'])
+            self._entries[site.name] = Site(site.name, site.status, site.bsi, site_cfg=cfg)
+
+        if dirty or len(fresh) != len(cached):
+            write_json_file(path, {'version': self.VERSION, 'sites': fresh})
+
+    def _build(self):
+        def _add(d, k, name):
+            names = d.setdefault(k, [])
+            if not name in names: names.append(name)
+
+        for name, site in self._entries.items():
+            if site.status & BAD: continue
+            cfg = site.site_cfg
+            if cfg is None or not cfg.parse_ok: continue
+            server_names = cfg.server_names if cfg.server_names else ['']
+            for sn in cfg.server_names: _add(self._by_name, sn.lower(), name)
+            for (sock, exists) in cfg.wsgi_sockets: _add(self._by_socket, sock, name)
+            for largs in cfg.listens:
+                (addr, port, ds) = parse_listen(largs)
+                if port is None:
+                    _add(self._by_socket, addr[5:], name)
+                    continue
+                _add(self._by_port, port, name)
+                for sn in server_names: _add(self._by_listen, (addr, port, sn.lower()), name)
+                if ds: _add(self._defaults, (addr, port), name)
+
+    @property
+    def sites(self) -> OrderedDict:
+        return self._entries
+
+    def get(self, name:str) -> Site:
+        return self._entries.get(name)
+
+    # Sites matching a port (9101), addr:port (127.0.0.1:9101), unix socket path or server name
+    def who(self, query:str) -> list:
+        assertNotBlank('query', query)
+        q = query.strip()
+        if q.isdigit():
+            names = self._by_port.get(int(q), [])
+
+        elif q.find('unix:') == 0 or q.find('/') == 0:
+            names = self._by_socket.get(q[5:] if q.find('unix:') == 0 else q, [])
+
+        elif q.find(':') > -1 and q.rsplit(':', 1)[1].isdigit():
+            (addr, port, ds) = parse_listen([q])
+            names = []
+            for (l_addr, l_port, sn), l_names in self._by_listen.items():
+                if l_port == port and (l_addr == addr or l_addr == '*' or (l_addr == '[::]' and addr.find('[') == 0)):
+                    names += [n for n in l_names if not n in names]
+
+        else:
+            names = list(self._by_name.get(q.lower(), []))
+            for sn, sn_names in self._by_name.items():
+                if sn != q.lower() and server_name_matches(sn, q):
+                    names += [n for n in sn_names if not n in names]
+
+        return [self._entries[n] for n in self._entries if n in names]
+
+    # Returns list of (issue, key, [site]) for enabled sites:
+    #   . same listen address + server_name defined in more than one site
+    #   . more than one default_server for a listen address
+    def conflicts(self) -> list:
+        def _enabled(names):
+            return [n for n in names if self._entries[n].status == ENABLED]
+
+        result = []
+        for (addr, port, sn), names in self._by_listen.items():
+            names = _enabled(names)
+            if len(names) > 1:
+                result.append(('duplicate listen+server_name', f"{addr}:{port} {sn if sn else '(none)'}", names))
+
+        for (addr, port), names in self._defaults.items():
+            names = _enabled(names)
+            if len(names) > 1:
+                result.append(('multiple default_server', f"{addr}:{port}", names))
+
+        return result
+
+
+def list_units(unit_type:str) -> list:
+    assertNotBlank('unit_type', unit_type)
+    cmd = ['systemctl', 'list-units', f"--type={unit_type}", '--all', '--plain', '--no-legend', '--no-pager']
+    with PExec(cmd) as p:
+        if p.code > 1:
+            raise Exception("Err occured while running `{}`: {}. Code: {}, stdout: {}".format(' '.join(cmd), p.err, p.code, p.out))
+        return [row.split()[0] for row in p.out.strip().split('\n') if row.strip() != '']
+
+
+# Unit name from /proc/<pid>/cgroup. eg. `0::/system.slice/app1.service` -> app1.service
+def get_pid_unit(pid:int) -> str:
+    try:
+        with open(f"/proc/{pid}/cgroup") as fp:
+            for line in fp:
+                for part in reversed(line.strip().split(':', 2)[-1].split('/')):
+                    if part.endswith('.service') or part.endswith('.socket'): return part
+    except OSError:
+        pass
+    return None
+
+
+# Maps listening unix socket paths to the pids that hold them open via /proc/net/unix and /proc/<pid>/fd
+def get_unix_socket_owners(paths:list) -> dict:
+    inodes = {}
+    try:
+        with open('/proc/net/unix') as fp:
+            next(fp)
+            for line in fp:
+                cols = line.split()
+                # Num RefCount Protocol Flags Type St Inode Path. 00010000 = __SO_ACCEPTCON (listening)
+                if len(cols) < 8 or cols[3] != '00010000': continue
+                if cols[7] in paths: inodes[f"socket:[{cols[6]}]"] = cols[7]
+    except OSError:
+        return {}
+
+    owners = {}
+    if len(inodes) == 0: return owners
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit(): continue
+        try:
+            for fd in os.scandir(f"/proc/{pid}/fd"):
+                try:
+                    path = inodes.get(os.readlink(fd.path))
+                except OSError:
+                    continue
+                if not path is None: owners.setdefault(path, []).append(int(pid))
+        except OSError:
+            continue
+    return owners
+
+
+# site -> wsgi unit -> socket graph.
+# Socket paths come from SiteConfig.wsgi_sockets and are matched (in order) against
+# systemd socket units Listen=, service ExecStart= and owners of listening sockets in
+# /proc/net/unix. Sites without sockets fall back to a `<site>.service` unit if one exists.
+# The graph is cached in C_.PATH_CACHE and is rebuilt when site sockets, unit dirs or
+# mapped unit files change. Unresolved sockets are retried after C_.TOPOLOGY_NEG_TTL seconds
+class Topology():
+    VERSION = 2
+
+    def __init__(self, index:SiteIndex=None):
+        self._index = SiteIndex() if index is None else index
+        self._sites = OrderedDict() # site -> [(socket, unit, via)]
+        self._load()
+
+    def _site_sockets(self) -> OrderedDict:
+        result = OrderedDict()
+        for name, site in self._index.sites.items():
+            cfg = None if site.status & BAD else site.site_cfg
+            result[name] = [] if cfg is None else sorted(set([sock for (sock, exists) in cfg.wsgi_sockets]))
+        return result
+
+    @staticmethod
+    def _mtimes(paths:list) -> dict:
+        result = {}
+        for path in paths:
+            try:
+                result[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                result[path] = None
+        return result
+
+    def _load(self):
+        path = get_state_path(C_.FILE_TOPOLOGY, cache=True)
+        site_sockets = self._site_sockets()
+        cache = read_json_file(path, {})
+        if cache.get('version') == self.VERSION \
+                and cache.get('site_sockets') == site_sockets \
+                and cache.get('mtimes') == self._mtimes(list(cache.get('mtimes', {}).keys())) \
+                and (cache.get('unresolved', 0) == 0 or time.time() - cache.get('ts', 0) < C_.TOPOLOGY_NEG_TTL):
+            for site, rows in cache['sites'].items(): self._sites[site] = [tuple(r) for r in rows]
+            return
+
+        (fragments, unresolved) = self._discover(site_sockets)
+        write_json_file(path, {'version': self.VERSION, 'ts': time.time(), 'site_sockets': site_sockets
+                              ,'mtimes': self._mtimes(C_.PATHS_SYSTEMD_UNITS + sorted(fragments))
+                              ,'unresolved': unresolved, 'sites': self._sites})
+
+    # Argument values of an ExecStart (`{ path=... ; argv[]=... }`) for exact socket path matching:
+    # `--bind=unix:/run/app.sock`, `'unix:/run/app.sock'` and `/run/app.sock` all give /run/app.sock
+    @staticmethod
+    def _exec_start_args(exec_start:str) -> set:
+        res = set()
+        for tok in exec_start.split():
+            if tok.find('--') == 0 and tok.find('=') > -1: tok = tok.split('=', 1)[1]
+            tok = tok.strip('\'";')
+            if tok.find('unix:') == 0: tok = tok[5:]
+            res.add(tok)
+        return res
+
+    def _discover(self, site_sockets:OrderedDict) -> tuple:
+        sockets = set([sock for socks in site_sockets.values() for sock in socks])
+        found = {} # socket -> (unit, via)
+        fragments = set()
+
+        socket_units = list_units('socket')
+        if len(sockets) > 0 and len(socket_units) > 0:
+            for unit, d in get_units_props(socket_units, ['Listen', 'Triggers', 'FragmentPath']).items():
+                for row in d.get('Listen', '').split('\n'):
+                    sock = row.split(' (')[0]
+                    if sock in sockets and not sock in found:
+                        triggers = d.get('Triggers', '').split()
+                        found[sock] = (triggers[0] if len(triggers) > 0 else unit, 'socket unit')
+                        if d.get('FragmentPath'): fragments.add(d['FragmentPath'])
+
+        services = list_units('service')
+        svc_props = get_units_props(services, ['ExecStart', 'FragmentPath']) if len(services) > 0 else {}
+        for unit, d in svc_props.items():
+            exec_args = self._exec_start_args(d.get('ExecStart', ''))
+            for sock in sockets:
+                if not sock in found and sock in exec_args:
+                    found[sock] = (unit, 'ExecStart')
+                    if d.get('FragmentPath'): fragments.add(d['FragmentPath'])
+
+        missing = [sock for sock in sockets if not sock in found]
+        if len(missing) > 0:
+            for sock, pids in get_unix_socket_owners(missing).items():
+                for pid in pids:
+                    unit = get_pid_unit(pid)
+                    if not unit is None:
+                        found[sock] = (unit, 'socket owner')
+                        break
+
+        unresolved = 0
+        for site, socks in site_sockets.items():
+            rows = []
+            for sock in socks:
+                if sock in found:
+                    rows.append((sock, found[sock][0], found[sock][1]))
+                else:
+                    unresolved += 1
+            if len(socks) == 0 and f"{site}.service" in svc_props:
+                rows.append((None, f"{site}.service", 'name'))
+                if svc_props[f"{site}.service"].get('FragmentPath'): fragments.add(svc_props[f"{site}.service"]['FragmentPath'])
+            self._sites[site] = rows
+
+        return (fragments, unresolved)
+
+    @property
+    def sites(self) -> OrderedDict:
+        return self._sites
+
+    # [(socket, unit, via)] for site
+    def get(self, site:str) -> list:
+        return self._sites.get(site, [])
+
+    def units(self, site:str) -> list:
+        result = []
+        for (sock, unit, via) in self.get(site):
+            if not unit in result: result.append(unit)
+        return result
+
+    # Unit for `wsgi:<name>`. Sites mapped to exactly one unit resolve to it, anything else is taken as a unit name
+    def resolve_unit(self, name:str) -> str:
+        units = self.units(name)
+        return units[0] if len(units) == 1 else name
+
+
+# gixy reads the contents of upstream (and map) blocks as hash values and drops them
+class DumpParser(NginxParser):
+    def _get_directive_class(self, parsed_type, parsed_name):
+        if parsed_type == 'hash_value': return Directive
+        return super()._get_directive_class(parsed_type, parsed_name)
+
+
+# Effective config tree from `nginx -T` (all includes). gixy switches to dump mode on the
+# `# configuration file` lines. Walk it with dump_children to see into includes
+def get_nginx_dump():
+    cmd = get_nginx_cmd('-T')
+    with PExec(cmd) as p:
+        assert p.code == 0 and p.out.strip() != '', \
+            f"`{' '.join(cmd)}` failed ({p.code}): {p.err.strip().split(chr(10))[-1]}"
+        return DumpParser(cwd='', allow_includes=True).parse(p.out)
+
+
+def dump_children(node):
+    for child in node.children:
+        if child.name == 'include': yield from dump_children(child)
+        else: yield child
+
+
+def get_nginx_master_pid() -> int:
+    try:
+        with open(C_.PATH_NGINX_PID) as fp:
+            pid = int(fp.read().strip())
+    except (OSError, ValueError):
+        return None
+    return pid if os.path.exists(f"/proc/{pid}") else None
+
+
+def get_boot_time() -> float:
+    if C_.BOOT_TIME is None:
+        with open('/proc/stat') as fp:
+            for line in fp:
+                if line.find('btime ') == 0:
+                    C_.BOOT_TIME = float(line.split()[1])
+                    break
+    return C_.BOOT_TIME
+
+
+# Process start time (epoch seconds) from /proc/<pid>/stat
+def get_proc_start_time(pid:int) -> float:
+    try:
+        with open(f"/proc/{pid}/stat") as fp:
+            stat = fp.read()
+    except OSError:
+        return None
+    # comm (field 2) may contain spaces so split after the closing paren. starttime is field 22
+    fields = stat[stat.rfind(')')+2:].split()
+    return get_boot_time() + int(fields[19]) / os.sysconf('SC_CLK_TCK')
+
+
+def get_proc_children(pid:int) -> list:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as fp:
+            return [int(c) for c in fp.read().split()]
+    except (OSError, ValueError):
+        return []
+
+
+# Worker processes of a master (nginx, gunicorn, uwsgi ...). 0 when pid is not known
+def count_workers(pid) -> int:
+    return len(get_proc_children(pid)) if isinstance(pid, int) and pid > 0 else 0
+
+
+# Stat based fingerprint of what nginx would load: nginx.conf and every sites-enabled entry
+# (links + targets, also bad ones: nginx includes foreign links and regular files as well)
+def get_config_fingerprint(scan:SiteScan=None) -> dict:
+    scan = get_scan() if scan is None else scan
+    enabled = {}
+    for name, (target, mtime, size) in scan.included.items():
+        enabled[name] = [target, mtime, size]
+    try:
+        conf_mtime = os.stat(C_.PATH_NGINX_CONF).st_mtime_ns
+    except OSError:
+        conf_mtime = None
+    return {'conf': conf_mtime, 'enabled': enabled}
+
+
+# Call after pynx reloads, starts or restarts nginx
+def record_loaded_generation(scan:SiteScan=None):
+    if not C_.SESSION is None: C_.SESSION.reload_pending.discard(C_.INSTANCE)
+    pid = get_nginx_master_pid()
+    write_json_file(get_state_path(C_.FILE_LOADED_GENERATION)
+                   ,{'ts': time.time(), 'master_pid': pid
+                    ,'master_start': None if pid is None else get_proc_start_time(pid)
+                    ,'fingerprint': get_config_fingerprint(scan)})
+
+
+# Detects sites changed on disk after the running nginx loaded its config.
+# Compares against the fingerprint recorded by pynx at its last reload/start if that
+# was for the current master process and its workers are not newer than the record.
+# Otherwise (nginx reloaded/started outside pynx)
+# falls back to comparing mtimes with the start time of the oldest current worker
+# (workers are replaced on reload) or of the master process.
+class LoadedGeneration():
+    def __init__(self, scan:SiteScan=None):
+        self._pending = OrderedDict() # site -> reason
+        self._reasons = []
+        self._loaded_at = None
+        self._mode = None
+
+        pid = get_nginx_master_pid()
+        if pid is None: return # nothing loaded
+        master_start = get_proc_start_time(pid)
+        starts = [get_proc_start_time(c) for c in get_proc_children(pid)]
+        starts = [t for t in starts if not t is None]
+        workers_start = min(starts) if len(starts) > 0 else None
+
+        rec = read_json_file(get_state_path(C_.FILE_LOADED_GENERATION), {})
+        fp_now = get_config_fingerprint(scan)
+        if rec.get('master_pid') == pid and rec.get('master_start') == master_start \
+                and (workers_start is None or workers_start <= rec['ts'] + C_.RELOAD_SLACK):
+            self._mode = 'recorded'
+            self._loaded_at = rec['ts']
+            fp_then = rec['fingerprint']
+            if fp_now['conf'] != fp_then['conf']: self._reasons.append(f"{C_.PATH_NGINX_CONF} changed")
+            (e_now, e_then) = (fp_now['enabled'], fp_then['enabled'])
+            for name, val in e_now.items():
+                if not name in e_then:
+                    self._pending[name] = 'enabled'
+                elif val != e_then[name]:
+                    self._pending[name] = 'modified'
+            for name in e_then:
+                if not name in e_now: self._pending[name] = 'disabled'
+
+        else:
+            self._mode = 'process start'
+            self._loaded_at = master_start if workers_start is None else workers_start
+            if self._loaded_at is None: return
+            # mtimes are in ns. Process start times have clock tick resolution
+            loaded_ns = int((self._loaded_at + 1.0 / os.sysconf('SC_CLK_TCK')) * 1e9)
+            if not fp_now['conf'] is None and fp_now['conf'] > loaded_ns:
+                self._reasons.append(f"{C_.PATH_NGINX_CONF} changed")
+            try:
+                if os.stat(C_.PATH_SITES_E).st_mtime_ns > loaded_ns:
+                    self._reasons.append(f"sites enabled or disabled")
+            except OSError:
+                pass
+            for name, (target, mtime, size) in fp_now['enabled'].items():
+                if not mtime is None and mtime > loaded_ns:
+                    self._pending[name] = 'modified'
+                    continue
+                try:
+                    if os.lstat(f"{C_.PATH_SITES_E}/{name}").st_ctime_ns > loaded_ns:
+                        self._pending[name] = 'enabled'
+                except OSError:
+                    pass
+
+    @property
+    def pending(self) -> OrderedDict:
+        return self._pending
+
+    @property
+    def reasons(self) -> list:
+        return self._reasons
+
+    @property
+    def loaded_at(self) -> float:
+        return self._loaded_at
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    @property
+    def any(self) -> bool:
+        return len(self._pending) > 0 or len(self._reasons) > 0
+
+    def site_note(self, name:str) -> str:
+        reason = self._pending.get(name)
+        return None if reason is None else f"pending reload ({reason})"
+
+
+# Filter / sort / limit for `pynx list`.
+#   where: predicates joined with and, or, not and (). eg. `port=443 and enabled and not name=dev_*`
+#   sort: comma separated keys, `-` prefix for descending. eg. `-status,name`
+# Scan predicates (name, enabled, available, bad, pending) are evaluated first. Config
+# predicates are only evaluated for sites the scan predicates did not already decide,
+# using the SiteIndex parse cache. Only matching sites have their config loaded.
+class SiteQuery():
+    SCAN_KEYS = ('name', 'enabled', 'available', 'bad', 'pending')
+    CFG_KEYS = ('port', 'server_name', 'wsgi', 'has-wsgi', 'socket', 'default_server', 'parse_ok')
+    FLAG_KEYS = ('enabled', 'available', 'bad', 'pending', 'wsgi', 'has-wsgi', 'default_server', 'parse_ok')
+    SORT_KEYS = ('name', 'status', 'server_name', 'port')
+    OPS = ('!=', '>=', '<=', '=', '>', '<')
+    _UNKNOWN = object()
+
+    def __init__(self, where:str=None, sort:str=None, limit:int=None):
+        self._tree = None
+        self._sort = []
+        self._limit = limit
+        if isStr(where) and where.strip() != '':
+            self._tokens = re.findall(r'\(|\)|[^\s()]+', where)
+            self._pos = 0
+            self._tree = self._parse_or()
+            assert self._pos == len(self._tokens), f"Unexpected `{self._tokens[self._pos]}` in where clause"
+
+        if isStr(sort):
+            for key in sort.split(','):
+                key = key.strip()
+                desc = key.find('-') == 0
+                key = key[1:] if desc else key
+                assert key in self.SORT_KEYS, f"Invalid sort key `{key}`. Valid: {', '.join(self.SORT_KEYS)}"
+                self._sort.append((key, desc))
+
+        assert limit is None or limit >= 0, f"limit must be >= 0. Got: {limit}"
+
+
+    def _peek(self) -> str:
+        return self._tokens[self._pos].lower() if self._pos < len(self._tokens) else None
+
+    def _parse_or(self):
+        node = self._parse_and()
+        while self._peek() == 'or':
+            self._pos += 1
+            node = ('or', node, self._parse_and())
+        return node
+
+    def _parse_and(self):
+        node = self._parse_not()
+        while self._peek() == 'and':
+            self._pos += 1
+            node = ('and', node, self._parse_not())
+        return node
+
+    def _parse_not(self):
+        if self._peek() == 'not':
+            self._pos += 1
+            return ('not', self._parse_not())
+        return self._parse_atom()
+
+    def _parse_atom(self):
+        tok = self._peek()
+        assert not tok is None, "Unexpected end of where clause"
+        if tok == '(':
+            self._pos += 1
+            node = self._parse_or()
+            assert self._peek() == ')', "Missing `)` in where clause"
+            self._pos += 1
+            return node
+
+        tok = self._tokens[self._pos]
+        self._pos += 1
+        for op in self.OPS:
+            iF = tok.find(op)
+            if iF > 0:
+                (key, val) = (tok[:iF].lower(), tok[iF+len(op):])
+                assert key in self.SCAN_KEYS or key in self.CFG_KEYS, f"Unknown key `{key}` in where clause"
+                assert val != '', f"Missing value for `{key}` in where clause"
+                if key == 'port':
+                    assert val.isdigit(), f"port must be a number. Got: {val}"
+                    val = int(val)
+                else:
+                    assert op in ('=', '!='), f"Operator {op} is only valid for port"
+                return ('pred', key, op, val)
+
+        key = tok.lower()
+        assert key in self.FLAG_KEYS, f"Unknown flag `{tok}` in where clause. Valid: {', '.join(self.FLAG_KEYS)}"
+        return ('pred', key, None, None)
+
+
+    # Returns True, False or None (undecided because config is not loaded yet)
+    def _eval(self, node, site, cfg, gen):
+        kind = node[0]
+        if kind == 'and':
+            (a, b) = (self._eval(node[1], site, cfg, gen), self._eval(node[2], site, cfg, gen))
+            if a is False or b is False: return False
+            return True if a and b else None
+        if kind == 'or':
+            (a, b) = (self._eval(node[1], site, cfg, gen), self._eval(node[2], site, cfg, gen))
+            if a or b: return True
+            return False if a is False and b is False else None
+        if kind == 'not':
+            a = self._eval(node[1], site, cfg, gen)
+            return None if a is None else not a
+
+        (key, op, val) = node[1:]
+        if key in self.SCAN_KEYS:
+            if key == 'name': return (op == '=') == fnmatch.fnmatchcase(site.name, val)
+            if key == 'enabled': return bool(site.status & ENABLED) and not site.status & BAD
+            if key == 'available': return site.status == AVAILABLE
+            if key == 'bad': return bool(site.status & BAD)
+            if key == 'pending': return not gen is None and not gen.site_note(site.name) is None
+
+        if cfg is self._UNKNOWN: return None
+        if cfg is None or not cfg.parse_ok: return False if op is None or op == '=' else True
+        if key == 'parse_ok': return cfg.parse_ok
+        if key in ('wsgi', 'has-wsgi'): return len(cfg.wsgi_sockets) > 0
+        if key == 'default_server': return any([parse_listen(a)[2] for a in cfg.listens])
+        if key == 'socket':
+            found = any([fnmatch.fnmatchcase(sock, val) for (sock, exists) in cfg.wsgi_sockets])
+            return found == (op == '=')
+        if key == 'server_name':
+            found = any([fnmatch.fnmatchcase(sn.lower(), val.lower()) for sn in cfg.server_names])
+            return found == (op == '=')
+        if key == 'port':
+            ports = [parse_listen(a)[1] for a in cfg.listens]
+            ports = [p for p in ports if not p is None]
+            if op == '!=': return not val in ports
+            return any([(p == val if op == '=' else p > val if op == '>' else p < val if op == '<' \
+                         else p >= val if op == '>=' else p <= val) for p in ports])
+        raise Exception(f"Unexpected key: {key}")
+
+    def _sort_key(self, site, key):
+        if key == 'name': return site.name
+        if key == 'status': return 0 if site.status == ENABLED else 1 if site.status == AVAILABLE else 2
+        cfg = site.site_cfg
+        if cfg is None or not cfg.parse_ok: return '' if key == 'server_name' else -1
+        if key == 'server_name': return '' if cfg.server_name is None else cfg.server_name
+        ports = [parse_listen(a)[1] for a in cfg.listens]
+        ports = [p for p in ports if not p is None]
+        return min(ports) if len(ports) > 0 else -1
+
+    # Returns matching sites (with configs loaded from the SiteIndex) in scan or sort order
+    def run(self, sites=None, gen=None) -> list:
+        sites = Sites() if sites is None else sites
+        matched = []
+        undecided = []
+        for site in sites.All:
+            res = True if self._tree is None else self._eval(self._tree, site, self._UNKNOWN, gen)
+            if res is None:
+                undecided.append(site)
+            elif res:
+                matched.append(site)
+
+        if len(undecided) == 0 and len(self._sort) == 0 and not self._limit is None:
+            matched = matched[:self._limit] # no config needed to decide, only load what is shown
+
+        undecided = set([s.name for s in undecided])
+        index = SiteIndex(sites, names=set([s.name for s in matched]) | undecided)
+        result = []
+        for site in sites.All:
+            if not site.name in index.sites: continue
+            site = index.get(site.name)
+            if site.name in undecided and not self._eval(self._tree, site, site.site_cfg, gen): continue
+            result.append(site)
+
+        for (key, desc) in reversed(self._sort):
+            result.sort(key=lambda s: self._sort_key(s, key), reverse=desc)
+
+        return result if self._limit is None else result[:self._limit]
+
+
+_WS_TRANS = str.maketrans('\x0b\x0c\r', '   ')
+
+def _text_width(s:str) -> int:
+    if s.isascii(): return len(s)
+    return sum([2 if unicodedata.east_asian_width(c) in 'WF' else (0 if unicodedata.combining(c) else 1) for c in s])
+
+
+# Text table for pynx output. Renders like texttable with VLINES deco (which pynx used before):
+# centered header, ` | ` between columns, no borders, cells split on newlines and wrapped when the
+# table is wider than max_width. Column widths are kept up to date as rows are added so draw()
+# is a single pass over the cells
+class Table():
+    def __init__(self, header:list, align:list=None, max_width:int=None):
+        self._header = self._cell_lines(header)
+        self._align = ['l'] * len(header) if align is None else list(align)
+        assert len(self._align) == len(header), f"header and align must have same length"
+        assert all([a in ('l', 'c', 'r') for a in self._align]), f"align must be l, c or r. Got: {align}"
+        self._max_width = C_.TABLE_MAX_WIDTH if max_width is None else max_width
+        self._widths = [max([_text_width(ln) for ln in lines]) for lines in self._header]
+        self._rows = []
+
+    # cells -> [[line, ...], ...]. Whitespace only lines are kept as empty lines
+    @staticmethod
+    def _cell_lines(row:list) -> list:
+        cells = []
+        for v in row:
+            v = v if isinstance(v, str) else (v.decode('utf-8', errors='replace') if isinstance(v, bytes) else str(v))
+            if v.find('\t') > -1: v = v.expandtabs()
+            if v.find('\n') == -1:
+                cells.append([v.translate(_WS_TRANS)])
+            else:
+                cells.append([ln.translate(_WS_TRANS) for ln in v.split('\n')])
+        return cells
+
+    def add_row(self, row:list):
+        assert len(row) == len(self._widths), f"row should contain {len(self._widths)} elements"
+        cells = self._cell_lines(row)
+        widths = self._widths
+        for i, lines in enumerate(cells):
+            for ln in lines:
+                w = _text_width(ln)
+                if w > widths[i]: widths[i] = w
+        self._rows.append(cells)
+        return self
+
+    @property
+    def widths(self) -> list:
+        return list(self._widths)
+
+    # Too wide: shrink columns round robin to max_width as texttable does
+    def _fit(self, widths:list) -> list:
+        deco = 3 * (len(widths) - 1)
+        if sum(widths) + deco <= self._max_width: return widths
+        assert self._max_width >= len(widths) + deco, "max_width too low to render data"
+        available = self._max_width - deco
+        fit = [0] * len(widths)
+        i = 0
+        while available > 0:
+            if fit[i] < widths[i]:
+                fit[i] += 1
+                available -= 1
+            i = (i + 1) % len(widths)
+        return fit
+
+    @staticmethod
+    def _draw_row(cells:list, widths:list, align:list, out:list):
+        cols = []
+        for (lines, w) in zip(cells, widths):
+            col = []
+            for ln in lines:
+                if ln.strip() == '':
+                    col.append('')
+                elif _text_width(ln) <= w:
+                    col.append(ln.rstrip(' '))
+                else:
+                    col.extend(textwrap.wrap(ln, w))
+            cols.append(col)
+
+        if all([len(col) == 1 for col in cols]): # common case
+            lines = [cols]
+        else:
+            height = max([len(col) for col in cols])
+            lines = [[col[i:i+1] for col in cols] for i in range(height)]
+
+        for line in lines:
+            parts = []
+            for (col, w, a) in zip(line, widths, align):
+                s = col[0] if len(col) > 0 else ''
+                fill = w - _text_width(s)
+                if fill <= 0:
+                    parts.append(s)
+                elif a == 'l':
+                    parts.append(s + ' ' * fill)
+                elif a == 'r':
+                    parts.append(' ' * fill + s)
+                else:
+                    parts.append(' ' * (fill // 2) + s + ' ' * (fill - fill // 2))
+            out.append(' | '.join(parts))
+
+    def draw(self) -> str:
+        widths = self._fit(self._widths)
+        out = []
+        self._draw_row(self._header, widths, ['c'] * len(widths), out)
+        for cells in self._rows:
+            self._draw_row(cells, widths, self._align, out)
+        return '\n'.join(out)
+
+    # Writes header and rows as they come without holding the table. Column widths are `widths`
+    # or sampled from the header and the first `sample` rows. Cells in later rows that are
+    # wider than the sampled width are wrapped
+    def stream(self, rows, fp=None, sample:int=None, widths:list=None):
+        fp = sys.stdout if fp is None else fp
+        sample = C_.TABLE_STREAM_SAMPLE if sample is None else sample
+        rows = iter(rows)
+        if widths is None:
+            for row in rows:
+                self.add_row(row)
+                if len(self._rows) >= sample: break
+            widths = self._fit(self._widths)
+        else:
+            assert len(widths) == len(self._widths), f"widths should contain {len(self._widths)} elements"
+        out = []
+        self._draw_row(self._header, widths, ['c'] * len(widths), out)
+        for cells in self._rows:
+            self._draw_row(cells, widths, self._align, out)
+        self._rows = []
+        fp.write('\n'.join(out) + '\n')
+        for row in rows:
+            assert len(row) == len(widths), f"row should contain {len(widths)} elements"
+            out = []
+            self._draw_row(self._cell_lines(row), widths, self._align, out)
+            fp.write('\n'.join(out) + '\n')
+        fp.flush()
+
+
+# conns: Conns column after Listens (pynx list --conns, cells from conns.site_cell)
+def build_table(instance:bool=False, conns:bool=False) -> Table:
+    header = ['Site', 'Enabled', 'Name', 'Listens'] + (['Conns'] if conns else []) + ['Notes']
+    align = ['l'   , 'c'      , 'l'   , 'l'      ] + (['l'    ] if conns else []) + ['l']
+    if instance: # merged output of several instances
+        return Table(['Instance'] + header, ['l'] + align)
+    return Table(header, align)
+
+# Table with the same look as build_table for other data. align: l, c or r per column
+def build_grid(header:list, align:list) -> Table:
+    return Table(header, align)
+
+# Byte count for table cells: 512B, 1.5KB, ... 2.0TB
+def fmt_size(n:int) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if n < 1024 or unit == 'TB': return f"{n:.0f}{unit}" if unit == 'B' else f"{n:.1f}{unit}"
+        n /= 1024
 
 def _get_site_name_listens(_site):
     if _site.site_cfg is None or not _site.site_cfg.parse_ok: return ('-', '-')
@@ -333,7 +1543,7 @@ def _get_site_name_listens(_site):
     # _lstn = '\n'.join(_lstn) if isinstance(_lstn, list) else '-'
     return (_sn, _lstn)
 
-def table_add_ok_row(table, site):
+def site_row(site, notes:str=None) -> list:
     if site.site_cfg is None or not site.site_cfg.parse_ok:
         _sn, _lstn = ('-', '-')
     else:
@@ -343,12 +1553,18 @@ def table_add_ok_row(table, site):
         _lstn = site.site_cfg.listens
         _lstn = '\n'.join([' '.join(a) for a in (_lstn if isinstance(_lstn, list) else [])])
 
-    table.add_row([site.name, 'x' if site.status == ENABLED else '-', _sn, _lstn, '-'])
+    return [site.name, 'x' if site.status == ENABLED else '-', _sn, _lstn, '-' if notes is None else notes]
 
-def table_add_bad_row(table, site):
+def bad_site_row(site) -> list:
     bsi = site.bsi
-    pad = ' ' * (len(bsi.Reason) + 1)
-    table.add_row([bsi.Name, '(bad)', '-', '-' , f'{bsi.Reason} - {bsi.Path}\n{pad}~~> {bsi.Target}'])
+    pad = ' ' * (len(bsi.reason) + 1)
+    return [bsi.name, '(bad)', '-', '-' , f'{bsi.reason} - {bsi.path}/{bsi.name}\n{pad}~~> {bsi.target}']
+
+def table_add_ok_row(table, site, notes:str=None):
+    table.add_row(site_row(site, notes))
+
+def table_add_bad_row(table, site):
+    table.add_row(bad_site_row(site))
 
 def get_paths(name:str):
     assertNotBlank('name', name)
@@ -363,6 +1579,7 @@ def enable_site(name) -> tuple:
         raise Exception(f"site is not a file or symlink: {_path_avail}")
 
     assert not (Path(_path_enabled)).exists(), f"sites-enabled path exists: {_path_enabled}"
+    if not C_.SESSION is None: C_.SESSION.scans.pop(C_.INSTANCE, None)
 
     cmd = ['ln', '-s', _path_avail, _path_enabled]
     with PExec(cmd) as p:
@@ -387,6 +1604,7 @@ def enable_site(name) -> tuple:
 def start_service(name:str) -> tuple:
     assertNotBlank('name', name)
 
+    _drop_unit_status(name)
     cmd = ['systemctl', 'start', name]
     with PExec(cmd) as p:
         if p.code > 1:
@@ -405,6 +1623,7 @@ def start_service(name:str) -> tuple:
 def stop_service(name:str) -> tuple:
     assertNotBlank('name', name)
 
+    _drop_unit_status(name)
     cmd = ['systemctl', 'stop', name]
     with PExec(cmd) as p:
         if p.code > 1:
@@ -423,6 +1642,7 @@ def stop_service(name:str) -> tuple:
 def restart_service(name:str) -> tuple:
     assertNotBlank('name', name)
 
+    _drop_unit_status(name)
     cmd = ['systemctl', 'restart', name]
     with PExec(cmd) as p:
         if p.code > 1:
@@ -439,21 +1659,32 @@ def restart_service(name:str) -> tuple:
 
 
 def reload_nginx() -> tuple:
+    _drop_unit_status(C_.NGINX_UNIT)
     if C_.NGINX_RELOAD_BROKEN:
         pc(f'nginx could not be reloaded (see pynx -h)')
         yn = input(f"{C_.CHAR_BULLET} Do you want to restart nginx instead (y|N)?")
         if yn.lower() == 'y':
-            (ok, reason) = restart_service('nginx')
+            (ok, reason) = restart_service(C_.NGINX_UNIT)
             if ok:
                 pc(f'nginx restarted')
+                wait_service_state(C_.NGINX_UNIT, ('active',))
+                record_loaded_generation()
             else:
                 return (False, reason)
         else:
-            return (False, f'{C_.CHAR_BULLET} restart skipped. Please run manually: % sudo systemctl restart nginx')
+            return (False, f'{C_.CHAR_BULLET} restart skipped. Please run manually: % sudo systemctl restart {C_.NGINX_UNIT}')
 
         return (True, None)
     
-    cmd = ['systemctl', 'reload', 'nginx']
+    # systemctl reload succeeds even when the master rejects the config on HUP and keeps
+    # its old workers. Test first, then only record the generation once workers were replaced
+    nginx = Nginx()
+    if not nginx.ok:
+        return (False, f"nginx -t failed, config not reloaded: {'; '.join(nginx.badrows) or nginx.reason}")
+    pid = get_nginx_master_pid()
+    workers_before = set(get_proc_children(pid)) if not pid is None else set()
+
+    cmd = ['systemctl', 'reload', C_.NGINX_UNIT]
     with PExec(cmd) as p:
         if p.code > 1:
             raise Exception("Err occured while running `{}`: {}. Code: {}, stdout: {}".format(' '.join(cmd), p.err, p.code, p.out))
@@ -466,19 +1697,197 @@ def reload_nginx() -> tuple:
         if out != '':
             return (False, f"nginx could not be reloaded: {out}")
 
+        if len(workers_before) > 0 and not _wait_workers_replaced(pid, workers_before):
+            return (False, f"nginx master {pid} kept its old workers: the new config was not loaded (see the nginx error log)")
+        record_loaded_generation()
         return (True, None)
 
 
+# Waits for a reloaded master to start new workers. The old ones exit gracefully, later
+def _wait_workers_replaced(pid:int, workers_before:set, timeout:float=None) -> bool:
+    t_end = time.monotonic() + (C_.RELOAD_WORKERS_TIMEOUT if timeout is None else timeout)
+    delay = C_.WAIT_POLL_MIN
+    while True:
+        if get_nginx_master_pid() != pid: return True # restarted meanwhile
+        if len(set(get_proc_children(pid)) - workers_before) > 0: return True
+        if time.monotonic() + delay > t_end: return False
+        time.sleep(delay)
+        delay = min(delay * 2, C_.WAIT_POLL_MAX)
+
+
+def get_units_props(units:list, props:list) -> OrderedDict:
+    assertNotBlank('units', units)
+    assertNotBlank('props', props)
+
+    # One fork for any number of units. `systemctl show` emits one block per unit, in
+    # the order given, separated by a blank line
+    cmd = ['systemctl', 'show', '--no-pager', '-p', ','.join(props)] + list(units)
+    result = OrderedDict()
+    with PExec(cmd) as p:
+        if p.code > 1:
+            raise Exception("Err occured while running `{}`: {}. Code: {}, stdout: {}".format(' '.join(cmd), p.err, p.code, p.out))
+
+        blocks = p.out.strip('\n').split('\n\n')
+        for i, unit in enumerate(units):
+            data = OrderedDict()
+            if i < len(blocks):
+                for row in blocks[i].split('\n'):
+                    iF = row.find('=')
+                    if iF == -1: continue
+                    (k, v) = (row[:iF], row[iF+1:])
+                    data[k] = v if not k in data else f"{data[k]}\n{v}" # eg. multiple Listen=
+            result[unit] = data
+
+    return result
+
+
+def _sd_unit_path(name:str) -> str:
+    # D-Bus object path of a unit, using systemd's escaping (_xx for non alnum chars)
+    unit = name if name.find('.') > -1 else f"{name}.service"
+    esc = ''.join([c if c.isalnum() and c.isascii() else f"_{ord(c):02x}" for c in unit])
+    return f"/org/freedesktop/systemd1/unit/{esc}"
+
+
+# Wakes up on PropertiesChanged signals of a unit via `busctl monitor`.
+# If busctl is not available (or systemd has no subscribers and sends no signals)
+# wait() simply sleeps for the given timeout, so callers must always re-check state.
+class UnitWatch():
+    def __init__(self, name:str):
+        assertNotBlank('name', name)
+        self._p = None
+        busctl = shutil.which('busctl')
+        if busctl is None: return
+        match = f"type='signal',sender='org.freedesktop.systemd1',member='PropertiesChanged',path='{_sd_unit_path(name)}'"
+        try:
+            self._p = subprocess.Popen([busctl, 'monitor', '--system', '--json=short', f"--match={match}"]
+                                      ,stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            self._p = None
+
+    @property
+    def subscribed(self) -> bool:
+        return not self._p is None and self._p.poll() is None
+
+    def wait(self, timeout:float):
+        if not self.subscribed:
+            time.sleep(timeout)
+            return
+        (r, w, x) = select.select([self._p.stdout], [], [], timeout)
+        if r: os.read(self._p.stdout.fileno(), 65536) # drain. content is not needed
+
+    def close(self):
+        if self._p is None: return
+        try:
+            self._p.kill()
+            self._p.wait()
+        except OSError:
+            pass
+        self._p = None
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+
+# Wait for unit `name` to reach one of `states` (ActiveState values).
+# Returns (ok, state, elapsed) where elapsed is seconds from t_start (time.monotonic()) to
+# the state change as recorded by systemd. Gives up early when the unit settles in a state
+# that is not transient and not wanted.
+def wait_service_state(name:str, states:tuple, timeout:float=None, t_start:float=None) -> tuple:
+    assertNotBlank('name', name)
+    assert isinstance(states, tuple) and len(states) > 0, f"states must be a non empty tuple. Got: {states}"
+    timeout = C_.WAIT_TIMEOUT if timeout is None else timeout
+    t_start = time.monotonic() if t_start is None else t_start
+    deadline = time.monotonic() + timeout
+    props = ['ActiveState', 'SubState', 'StateChangeTimestampMonotonic']
+    poll = C_.WAIT_POLL_MIN
+    state = None
+    with UnitWatch(name) as watch:
+        while True:
+            data = get_units_props([name], props)[name]
+            state = data.get('ActiveState')
+            t_now = time.monotonic()
+            if state is None or state in states or not state in C_.SYSTEMD_TRANSIENT:
+                # systemd stamps changes with CLOCK_MONOTONIC, same as time.monotonic() on linux
+                elapsed = t_now - t_start
+                try:
+                    t_change = int(data.get('StateChangeTimestampMonotonic', '0')) / 1e6
+                    if t_start <= t_change <= t_now: elapsed = t_change - t_start
+                except ValueError:
+                    pass
+                return (state in states, state, elapsed)
+
+            if t_now >= deadline:
+                return (False, state, t_now - t_start)
+
+            watch.wait(min(poll, deadline - t_now))
+            poll = min(poll * 2, C_.WAIT_POLL_MAX)
+
+
+def _unit_action(name:str, action:str, before:dict, timeout:float) -> tuple:
+    state = before.get('ActiveState')
+    if action == 'start' and state == 'active': return ('skipped', state, 0.0, 'already active', 0)
+    if action == 'stop' and state in ('inactive', 'failed'): return ('skipped', state, 0.0, f'already {state}', 0)
+    if action == 'restart' and state != 'active': return ('skipped', state, 0.0, f'{state}. use start', 0)
+
+    workers = count_workers(int(before.get('MainPID', '0') or '0'))
+    _drop_unit_status(name)
+    t0 = time.monotonic()
+    try:
+        # systemd keeps running the job if the client is killed at timeout
+        p = subprocess.run(['systemctl', action, name], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        state = get_units_props([name], ['ActiveState'])[name].get('ActiveState')
+        return ('timeout', state, time.monotonic() - t0, f'no result after {timeout:.0f}s', workers)
+
+    if p.returncode != 0:
+        err = (p.stderr.decode('utf-8', errors='replace') + p.stdout.decode('utf-8', errors='replace')).strip()
+        return ('failed', None, time.monotonic() - t0, err.split('\n')[0], workers)
+
+    (ok, state, elapsed) = wait_service_state(name, C_.UNITS_ACTION_STATES[action], timeout=max(0.1, t0 + timeout - time.monotonic()), t_start=t0)
+    if ok: return ('ok', state, elapsed, None, workers)
+    return ('timeout' if state in C_.SYSTEMD_TRANSIENT else 'failed', state, elapsed, None, workers)
+
+
+# Runs start|stop|restart on units concurrently, at most `parallel` at a time, each bounded by `timeout`
+# Returns unit -> (result, state, elapsed, note, workers_before). result: ok, failed, timeout or skipped
+def run_units_action(units:list, action:str, parallel:int=None, timeout:float=None) -> OrderedDict:
+    assertNotBlank('units', units)
+    assert action in C_.UNITS_ACTION_STATES, f"Unsupported action: {action}"
+    parallel = C_.WSGI_PARALLEL if parallel is None else parallel
+    timeout = C_.WAIT_TIMEOUT if timeout is None else timeout
+    assert parallel > 0, f"parallel must be > 0. Got: {parallel}"
+
+    before = get_units_props(units, ['ActiveState', 'MainPID'])
+    results = OrderedDict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(parallel, len(units))) as pool:
+        futures = OrderedDict([(unit, pool.submit(_unit_action, unit, action, before[unit], timeout)) for unit in units])
+        for unit, future in futures.items():
+            try:
+                results[unit] = future.result()
+            except Exception as ex:
+                results[unit] = ('failed', None, 0.0, f"{getClassName(ex)}: {ex}", 0)
+    return results
+
+
 def get_sytemd_wsgi_status(wsgi) -> tuple:
     return _get_sytemd_service_status(wsgi, ['Loaded', 'Main PID', 'Tasks', 'Memory', 'CGroup'])
 
 def get_sytemd_nginx_status() -> tuple:
-    return _get_sytemd_service_status('nginx', ['Loaded', 'Process', 'Main PID', 'Tasks', 'Memory', 'CGroup'])
+    return _get_sytemd_service_status(C_.NGINX_UNIT, ['Loaded', 'Process', 'Main PID', 'Tasks', 'Memory', 'CGroup'])
 
 
 def _get_sytemd_service_status(name, data_keys) -> tuple:
     assertNotBlank('name', name)
     assert isinstance(data_keys, list), f"data_keys must be a list but got {getClassName(data_keys)}"
+    if C_.SESSION is None: return _read_sytemd_service_status(name, data_keys)
+    cached = C_.SESSION.units.setdefault(name, {})
+    key = tuple(data_keys)
+    if not key in cached:
+        cached[key] = _read_sytemd_service_status(name, data_keys)
+    return cached[key]
+
+
+def _read_sytemd_service_status(name, data_keys) -> tuple:
 
     cmd = ['systemctl', 'status', name, '--no-pager']
     data = OrderedDict()
@@ -550,6 +1959,144 @@ def _get_sytemd_service_status(name, data_keys) -> tuple:
             return (active_status, out, active_row, data)
 
 
+# ==============================================
+# journal reading for wsgi units
+# ==============================================
+
+# systemd MESSAGE_ID's for unit lifecycle entries (see sd-messages.h)
+SD_MSG_UNIT_STARTED = '39f53479d3a045ac8e11786248231fbf'
+SD_MSG_UNIT_STOPPED = '9d1aaa27d60140bd96365438aad20286'
+SD_MSG_UNIT_RESTART_SCHEDULED = '5eb03494b6584870a536b337290809b3'
+
+def _journal_msg(entry:dict) -> str:
+    msg = entry.get('MESSAGE', '')
+    if isinstance(msg, list): # journalctl emits non utf-8 messages as byte arrays
+        msg = bytes(msg).decode('utf-8', errors='replace')
+    return '' if msg is None else msg
+
+def get_journal_cursor(unit:str) -> str:
+    assertNotBlank('unit', unit)
+    cursors = read_json_file(get_state_path(C_.FILE_JOURNAL_CURSORS), {})
+    return cursors.get(unit)
+
+def set_journal_cursor(unit:str, cursor:str):
+    assertNotBlank('unit', unit)
+    path = get_state_path(C_.FILE_JOURNAL_CURSORS)
+    cursors = read_json_file(path, {})
+    cursors[unit] = cursor
+    write_json_file(path, cursors)
+
+
+# Yields journal entries (dicts) for unit as journalctl produces them.
+# Only entries after the cursor saved by the previous call are read (or the last
+# C_.JOURNAL_FIRST_LINES on first use). The last cursor seen is saved when the
+# generator finishes, including when a follow is interrupted.
+def iter_journal(unit:str, follow:bool=False):
+    assertNotBlank('unit', unit)
+    cursor = get_journal_cursor(unit)
+    cmd = ['journalctl', '-u', unit, '-o', 'json', '--no-pager']
+    if cursor is None:
+        cmd += ['-n', str(C_.JOURNAL_FIRST_LINES)]
+    else:
+        cmd += ['--after-cursor', cursor]
+    if follow: cmd.append('-f')
+
+    # stderr to a file: an unread pipe fills up on a long follow and blocks journalctl
+    err = tempfile.TemporaryFile()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+    cursor_last = cursor
+    try:
+        for line in p.stdout:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            cursor_last = entry.get('__CURSOR', cursor_last)
+            yield entry
+
+        p.wait()
+        if p.returncode != 0:
+            err.seek(0)
+            s_err = err.read().decode('utf-8', errors='replace').strip().rstrip('.')
+            # exit 1 without a message is an empty result on some journalctl versions
+            if p.returncode > 1 or s_err != '':
+                raise Exception(f"Err occured while running `{' '.join(cmd)}`: {s_err or '(no stderr)'}. Code: {p.returncode}")
+
+    finally:
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+        err.close()
+        if not cursor_last is None and cursor_last != cursor:
+            set_journal_cursor(unit, cursor_last)
+
+
+def fmt_journal_entry(entry:dict) -> str:
+    try:
+        ts = int(entry.get('__REALTIME_TIMESTAMP', '0')) / 1e6
+        s_ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+    except ValueError:
+        s_ts = '-'
+    ident = entry.get('SYSLOG_IDENTIFIER', entry.get('_COMM', '-'))
+    pid = entry.get('_PID')
+    ident = ident if pid is None else f"{ident}[{pid}]"
+    return f"{s_ts} {ident}: {_journal_msg(entry)}"
+
+
+# Per minute counters for journal summary
+class JournalSummary():
+    COLS = ('entries', 'errors', 'warnings', 'starts', 'stops', 'restarts')
+
+    def __init__(self):
+        self._minutes = OrderedDict()
+
+    def add(self, entry:dict) -> str:
+        try:
+            ts = int(entry.get('__REALTIME_TIMESTAMP', '0')) / 1e6
+        except ValueError:
+            ts = 0
+        minute = time.strftime('%Y-%m-%d %H:%M', time.localtime(ts))
+        row = self._minutes.get(minute)
+        if row is None:
+            row = self._minutes[minute] = OrderedDict([(k, 0) for k in self.COLS])
+
+        row['entries'] += 1
+        try:
+            prio = int(entry.get('PRIORITY', '6'))
+        except ValueError:
+            prio = 6
+        if prio <= 3:
+            row['errors'] += 1
+        elif prio == 4:
+            row['warnings'] += 1
+
+        msg_id = entry.get('MESSAGE_ID')
+        if msg_id == SD_MSG_UNIT_STARTED:
+            row['starts'] += 1
+        elif msg_id == SD_MSG_UNIT_STOPPED:
+            row['stops'] += 1
+        elif msg_id == SD_MSG_UNIT_RESTART_SCHEDULED or \
+                (entry.get('_PID') == '1' and _journal_msg(entry).find('Scheduled restart job') > -1):
+            row['restarts'] += 1
+
+        return minute
+
+    @property
+    def minutes(self) -> list:
+        return list(self._minutes.keys())
+
+    def pop(self, minute:str) -> OrderedDict:
+        return self._minutes.pop(minute)
+
+    @staticmethod
+    def header() -> str:
+        return f"{'minute':<16} | " + ' | '.join([f"{k:>8}" for k in JournalSummary.COLS])
+
+    @staticmethod
+    def fmt_row(minute:str, row:OrderedDict) -> str:
+        return f"{minute:<16} | " + ' | '.join([f"{row[k]:>8}" for k in JournalSummary.COLS])
+
+
 def disable_site(site):
     (_path_avail, _path_enabled) = get_paths(site)
 
@@ -557,6 +2104,7 @@ def disable_site(site):
         return (False, f"Symlink in sites-enabled does not exist or is not a symlink: {_path_enabled}")
 
     os.remove(_path_enabled)
+    if not C_.SESSION is None: C_.SESSION.scans.pop(C_.INSTANCE, None)
 
     return (True, None)
 
@@ -569,6 +2117,69 @@ def disable_site(site):
 # ==============================================
 
 
+def get_state_path(name:str, cache:bool=False) -> str:
+    assertNotBlank('name', name)
+    base = C_.PATH_CACHE if cache else C_.PATH_STATE
+    if not C_.INSTANCE is None: base = os.path.join(base, C_.INSTANCE)
+    os.makedirs(base, exist_ok=True)
+    return os.path.join(base, name)
+
+
+def read_json_file(path:str, default=None):
+    assertNotBlank('path', path)
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return default
+    except ValueError:
+        pc(f"Ignoring corrupt json file: {path}")
+        return default
+
+
+# Atomic write (temp file in same dir + rename) so readers never see partial files
+def write_json_file(path:str, data):
+    assertNotBlank('path', path)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as fp:
+        json.dump(data, fp)
+    os.replace(tmp, path)
+
+
+# Removes flag (eg. --follow) from args list. Returns True if it was present
+def pop_flag(args:list, *names) -> bool:
+    found = False
+    for name in names:
+        while name in args:
+            args.remove(name)
+            found = True
+    return found
+
+
+# Removes option and its value (eg. --limit 50 or --limit=50) from args list and returns value
+def pop_opt(args:list, *names, default:str=None) -> str:
+    for name in names:
+        assert name in C_.CLI_VALUE_OPTIONS, f"{name} is missing from C_.CLI_VALUE_OPTIONS (completion)"
+    for name in names:
+        for i, arg in enumerate(args):
+            if arg == name:
+                if i + 1 >= len(args): raise AssertionError(f"Option {name} requires a value")
+                val = args[i+1]
+                del args[i:i+2]
+                return val
+            elif arg.find(f"{name}=") == 0:
+                del args[i]
+                return arg[len(name)+1:]
+    return default
+
+
+# Nearest rank percentile of an ascending sorted list
+def percentile(values:list, p:float):
+    assert len(values) > 0, "values must not be empty"
+    i = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(i, 0), len(values) - 1)]
+
+
 def pc(*args):
     if len(args) == 0: return
     if len(args) == 1: print(f"{C_.CHAR_BULLET} {args[0]}"); return
@@ -584,7 +2195,7 @@ def noop(*args, **kwargs):
 
 def get_nginx_ver():
     if C_.NGINX_VER is None:
-        p = subprocess.Popen(['nginx', '-v'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p = subprocess.Popen([C_.NGINX_BIN, '-v'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         out, err = p.communicate()
         s = err.decode('utf-8')
         a = s.split('nginx/')
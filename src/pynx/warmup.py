@@ -0,0 +1,173 @@
+#########################################
+# .: warmup.py :.
+# Warm up wsgi workers after `pynx wsgi:<site> start|restart` before reporting done
+#
+# /etc/pynx/pynx.conf:
+#   [warmup:<site>]
+#   paths = / /api/health /login
+#   concurrency = 4
+#   threshold_ms = 200
+#   max_requests = 200
+#
+# Once the unit is active, pynx sends rounds of `concurrency` parallel GET requests,
+# cycling through paths, to the site's wsgi unix socket (SiteConfig.wsgi_sockets via
+# Topology). Warm-up is done when the p90 of `settle` consecutive rounds is below
+# threshold_ms without errors, or after max_requests requests (not settled).
+#########################################
+import time
+import socket
+import http.client
+import concurrent.futures
+from . import util
+from .util import pc, C_, assertNotBlank
+
+
+class Spec():
+    KEYS = ('paths', 'concurrency', 'threshold_ms', 'max_requests', 'settle', 'timeout', 'host')
+
+    def __init__(self, site:str, paths:str, concurrency:str=None, threshold_ms:str=None, max_requests:str=None
+                ,settle:str=None, timeout:str=None, host:str=None):
+        assertNotBlank('site', site)
+        self.site = site
+        self.paths = paths.replace(',', ' ').split()
+        assert len(self.paths) > 0, f"paths of [warmup:{site}] is empty"
+        for path in self.paths:
+            assert path.find('/') == 0, f"paths of [warmup:{site}] must start with `/`. Got: {path}"
+        self.concurrency = C_.WARMUP_CONCURRENCY if concurrency is None else int(concurrency)
+        self.threshold_ms = C_.WARMUP_THRESHOLD_MS if threshold_ms is None else float(threshold_ms)
+        self.max_requests = C_.WARMUP_MAX_REQUESTS if max_requests is None else int(max_requests)
+        self.settle = C_.WARMUP_SETTLE if settle is None else int(settle)
+        self.timeout = C_.WARMUP_TIMEOUT if timeout is None else float(timeout)
+        self.host = host
+        assert self.concurrency > 0 and self.max_requests > 0 and self.settle > 0 and self.timeout > 0 \
+            , f"concurrency, max_requests, settle and timeout of [warmup:{site}] must be > 0"
+
+
+# Spec from [warmup:<site>] or None if the site has no warm-up
+def get_spec(site:str) -> Spec:
+    cfg = util.get_config()
+    section = f"warmup:{site}"
+    if not cfg.has_section(section): return None
+    unknown = [k for k in cfg[section].keys() if not k in Spec.KEYS]
+    assert len(unknown) == 0, f"Unknown keys in [{section}] of {C_.PATH_CONFIG}: {unknown}"
+    assert cfg.has_option(section, 'paths'), f"[{section}] of {C_.PATH_CONFIG} has no paths"
+    return Spec(site, **dict(cfg[section].items()))
+
+
+# [(site, socket, spec)] to warm up for a unit. name is what was passed as wsgi:<name>:
+# a site (its own spec) or a unit name (specs of all sites mapped to the unit)
+def get_targets(topology, name:str, unit:str) -> list:
+    sites = [name] if name in topology.sites else [s for s in topology.sites.keys() if unit in topology.units(s)]
+    result = []
+    for site in sites:
+        spec = get_spec(site)
+        if spec is None: continue
+        socks = [sock for (sock, s_unit, via) in topology.get(site) if s_unit == unit and not sock is None]
+        result.append((site, socks[0] if len(socks) > 0 else None, spec))
+    return result
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path:str, timeout:float):
+        super().__init__('localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+# (ok, ms). ok is False on connection errors and 5xx responses
+def _request(sock:str, path:str, host:str, timeout:float) -> tuple:
+    t0 = time.monotonic()
+    conn = _UnixHTTPConnection(sock, timeout)
+    try:
+        conn.request('GET', path, headers={'Host': host, 'User-Agent': 'pynx-warmup', 'Connection': 'close'})
+        resp = conn.getresponse()
+        resp.read()
+        ok = resp.status < 500
+    except (OSError, http.client.HTTPException):
+        ok = False
+    finally:
+        conn.close()
+    return (ok, (time.monotonic() - t0) * 1000)
+
+
+# Waits for the socket to accept connections. The unit may be active before it is bound
+def _wait_socket(sock:str, timeout:float) -> bool:
+    t_end = time.monotonic() + timeout
+    delay = C_.WAIT_POLL_MIN
+    while True:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(sock)
+                return True
+            except OSError:
+                pass
+        if time.monotonic() + delay > t_end: return False
+        time.sleep(delay)
+        delay = min(delay * 2, C_.WAIT_POLL_MAX)
+
+
+# Returns (settled, rounds). rounds: [(requests, errors, p50 ms, p90 ms)]
+def run(sock:str, spec:Spec, host:str) -> tuple:
+    rounds = []
+    sent = 0
+    calm = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=spec.concurrency) as pool:
+        while sent < spec.max_requests:
+            n = min(spec.concurrency, spec.max_requests - sent)
+            paths = [spec.paths[(sent + i) % len(spec.paths)] for i in range(n)]
+            res = list(pool.map(lambda p: _request(sock, p, host, spec.timeout), paths))
+            sent += n
+            ms = sorted([t for (ok, t) in res])
+            errors = len([ok for (ok, t) in res if not ok])
+            rounds.append((n, errors, util.percentile(ms, 50), util.percentile(ms, 90)))
+            calm = calm + 1 if errors == 0 and rounds[-1][3] < spec.threshold_ms else 0
+            if calm >= spec.settle: return (True, rounds)
+    return (False, rounds)
+
+
+def _print_curve(rounds:list):
+    top = max([p90 for (n, errors, p50, p90) in rounds])
+    table = util.build_grid(['Round', 'Requests', 'Errors', 'p50', 'p90', 'Curve (p90)']
+                           ,['r'    , 'r'       , 'r'     , 'r'  , 'r'  , 'l'])
+    total = 0
+    for i, (n, errors, p50, p90) in enumerate(rounds):
+        total += n
+        bar = '#' * max(1, round(p90 / top * C_.WARMUP_BAR)) if top > 0 else '#'
+        table.add_row([str(i + 1), str(total), str(errors), f"{p50:.1f}ms", f"{p90:.1f}ms", bar])
+    for line in table.draw().split('\n'): pc(f"  {line}")
+
+
+# Warms up the sites of a unit that have a [warmup:<site>] spec. Returns a note for the
+# done message or None if there was nothing to warm up
+def warm_unit(name:str, unit:str, topology=None) -> str:
+    topology = util.Topology() if topology is None else topology
+    notes = []
+    for (site, sock, spec) in get_targets(topology, name, unit):
+        if sock is None:
+            pc(f"warm-up {site}: no wsgi socket of {unit} found in site config")
+            notes.append(f"{site} warm-up skipped")
+            continue
+        host = spec.host
+        if host is None:
+            (ok, site_info) = util.find_site(site)
+            host = util.get_site_host(site_info.site_cfg if ok else None)
+
+        t0 = time.monotonic()
+        if not _wait_socket(sock, spec.timeout):
+            pc(f"warm-up {site}: {sock} not accepting connections after {spec.timeout:.0f}s")
+            notes.append(f"{site} warm-up failed")
+            continue
+        pc(f"warm-up {site} via {sock} ({spec.concurrency} concurrent, threshold {spec.threshold_ms:.0f}ms):")
+        (settled, rounds) = run(sock, spec, host)
+        elapsed = time.monotonic() - t0
+        _print_curve(rounds)
+        sent = sum([n for (n, errors, p50, p90) in rounds])
+        if settled:
+            notes.append(f"{site} warmed up in {elapsed:.3f}s ({sent} requests)")
+        else:
+            notes.append(f"{site} warm-up not settled after {sent} requests ({elapsed:.3f}s)")
+    return None if len(notes) == 0 else ', '.join(notes)